@@ -0,0 +1,116 @@
+
+import os
+import sys
+import argparse as arg
+import numpy as np
+
+from tfcommon import sweep, modal_truncation, balanced_truncation, variable_names, select_variables
+from compute_TFs import load_bus_name, input_output_matrices
+
+progname = os.path.basename(sys.argv[0])
+
+
+if __name__ == '__main__':
+
+    parser = arg.ArgumentParser(description = 'Build a reduced-order model from the output of run_PF.py AC', \
+                                formatter_class = arg.ArgumentDefaultsHelpFormatter, \
+                                prog = progname)
+    parser.add_argument('data_file', type=str, action='store', help='AC analysis file')
+    parser.add_argument('-L', '--loads', required=True, type=str, help='comma-separated names of the loads where the inputs enter')
+    parser.add_argument('--P', action='store_true', help='use the active power of the loads as inputs')
+    parser.add_argument('--Q', action='store_true', help='use the reactive power of the loads as inputs')
+    parser.add_argument('--outputs', default='*.speed', type=str, help='comma-separated patterns of the output variables')
+    parser.add_argument('-m', '--method', default='balanced', choices=('balanced', 'modal'), help='reduction method')
+    parser.add_argument('-r', '--order', default=None, type=int, help='order of the reduced model')
+    parser.add_argument('-t', '--tol', default=None, type=float, help='largest error bound, relative to the peak of the frequency response')
+    parser.add_argument('--fmin', default=-3., type=float, help='log10 of the minimum frequency used to check the reduced model')
+    parser.add_argument('--fmax', default=2., type=float, help='log10 of the maximum frequency used to check the reduced model')
+    parser.add_argument('-o', '--outfile', default=None, type=str, help='output file (default: next to the AC analysis file)')
+    parser.add_argument('-f', '--force', action='store_true', help='force overwrite of the output file')
+    args = parser.parse_args(args=sys.argv[1:])
+
+    data_file = args.data_file
+    if not os.path.isfile(data_file):
+        print(f'{progname}: {data_file}: no such file.')
+        sys.exit(1)
+    if not args.P and not args.Q:
+        print(f'{progname}: at least one of --P and --Q must be specified.')
+        sys.exit(1)
+    if (args.order is None) == (args.tol is None):
+        print(f'{progname}: exactly one of --order and --tol must be specified.')
+        sys.exit(1)
+
+    if args.outfile is None:
+        outfile = os.path.splitext(data_file)[0] + '_ROM_{}.npz'.format(args.method)
+    else:
+        outfile = args.outfile
+    if os.path.isfile(outfile) and not args.force:
+        print(f'{progname}: {outfile}: file exists, use -f to overwrite.')
+        sys.exit(1)
+
+    data = np.load(data_file, allow_pickle=True)
+    A,J = data['A'],data['J']
+    vars_idx = data['vars_idx'].item()
+    state_vars = data['state_vars'].item()
+    N_state_vars = np.sum([len(v) for v in state_vars.values()])
+
+    load_buses = data['load_buses'].item()
+    idx,input_names = [],[]
+    for load_name in args.loads.split(','):
+        if load_name not in load_buses:
+            print(f'{progname}: cannot find load `{load_name}`.')
+            sys.exit(1)
+        bus_name = load_bus_name(data, vars_idx, load_name)
+        if args.P:
+            idx.append(vars_idx[bus_name]['ur'])
+            input_names.append(load_name + '.P')
+        if args.Q:
+            idx.append(vars_idx[bus_name]['ui'])
+            input_names.append(load_name + '.Q')
+    idx = np.array(idx) - N_state_vars
+
+    var_names = variable_names(vars_idx)
+    out_idx = select_variables(var_names, args.outputs.split(','))
+    if out_idx.size == 0:
+        print(f'{progname}: no variables match {args.outputs}.')
+        sys.exit(1)
+    var_names = [var_names[i] for i in out_idx]
+    state_out_idx = out_idx[out_idx < N_state_vars]
+    alg_out_idx = out_idx[out_idx >= N_state_vars] - N_state_vars
+
+    Jfy = J[:N_state_vars, N_state_vars:]
+    Jgx = J[N_state_vars:, :N_state_vars]
+    Jgy_inv = np.linalg.inv(J[N_state_vars:, N_state_vars:])
+    B,C,D = input_output_matrices(Jfy, Jgx, Jgy_inv, idx, state_out_idx, alg_out_idx)
+
+    # the frequency response of the full model is used to make the tolerance
+    # relative and to check the reduced model
+    N_freq = int(args.fmax - args.fmin) * 100 + 1
+    F = np.logspace(args.fmin, args.fmax, N_freq)
+    TF = sweep(A, B, F, 'eig', C, D)
+    peak = np.max(np.linalg.norm(TF, ord=2, axis=(1,2)))
+    tol = None if args.tol is None else args.tol * peak
+
+    reduce = balanced_truncation if args.method == 'balanced' else modal_truncation
+    try:
+        (Ar,Br,Cr,Dr),error_bound,sv = reduce(A, B, C, D, order=args.order, tol=tol)
+    except Exception as e:
+        print(f'{progname}: {e}.')
+        sys.exit(1)
+    TFr = sweep(Ar, Br, F, 'eig', Cr, Dr)
+    error = np.max(np.linalg.norm(TF - TFr, ord=2, axis=(1,2)))
+
+    print(f'Full model: {A.shape[0]} states, {B.shape[1]} inputs, {C.shape[0]} outputs.')
+    print(f'Reduced model ({args.method} truncation): {Ar.shape[0]} states.')
+    print(f'Error bound: {error_bound:.4e} ({error_bound/peak*100:.4g}% of the peak response).')
+    print(f'Largest error between 10^{args.fmin:g} and 10^{args.fmax:g} Hz: {error:.4e}.')
+
+    SM_names = [n for n in data['gen_names']]
+    out = {'A': Ar, 'B': Br, 'C': Cr, 'D': Dr, 'method': args.method,
+           'error_bound': error_bound, 'sv': sv, 'N_states': A.shape[0],
+           'input_names': input_names, 'var_names': var_names, 'data_file': data_file,
+           'SM_names': SM_names,
+           'H': np.array([data['H'].item()[name] for name in SM_names]),
+           'S': np.array([data['S'].item()[name] for name in SM_names]),
+           'Htot': data['inertia'], 'Etot': data['energy'], 'Mtot': data['momentum']}
+    np.savez_compressed(outfile, **out)
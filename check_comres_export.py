@@ -0,0 +1,72 @@
+
+import os
+import sys
+import csv
+from types import SimpleNamespace
+import argparse as arg
+import numpy as np
+
+from run_PF import RecordPlan, _read_exported_data
+
+progname = os.path.basename(sys.argv[0])
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'IEEE39_tran_export_sample.csv')
+
+# the 'record' entry of a configuration file that selects some of the columns
+# of the sample file: the load is exported but not recorded
+SAMPLE_RECORD_MAP = {
+    'ElmSym': {'names': '*', 'vars': ['s:xspeed'], 'devs_name': 'gen'},
+    'ElmTerm': {'names': ['Bus 01', 'Bus 02'], 'vars': ['m:ur', 'm:ui', 'm:fe'], 'devs_name': 'bus'}
+}
+SAMPLE_DEVICES = {'ElmSym': ['G 01', 'G 02'], 'ElmTerm': ['Bus 01', 'Bus 02', 'Bus 03']}
+
+
+def check_exported_data(filename, record_map, device_names, verbose=False):
+    """
+    Parses filename, a CSV file exported by ComRes, with the same code used by
+    run_PF._get_data and checks that the result has the same (time, data)
+    layout, i.e., data[key][var_name] is an array with the values of var_name
+    for the devices of key, with one column per device (squeezed if there is
+    only one). The expected values are read from the file with the csv
+    module. device_names contains the names of the devices of each type of
+    record_map, which are matched as if they were in the active project.
+    """
+    devices = {dev_type: [SimpleNamespace(loc_name=name) for name in names]
+               for dev_type,names in device_names.items()}
+    plan = RecordPlan(record_map, devices)
+    time,data = _read_exported_data(plan, filename)
+
+    with open(filename, newline='') as fid:
+        rows = list(csv.reader(fid))
+    elements = [name.strip() for name in rows[0]]
+    variables = [name.split()[0] for name in rows[1]]
+    values = np.array(rows[2:], dtype=float)
+    column = {(elm,var): j for j,(elm,var) in enumerate(zip(elements, variables))}
+
+    if not np.array_equal(time, values[:,0]):
+        raise Exception(f'{filename}: wrong time vector')
+    if sorted(data.keys()) != sorted(plan.slots.keys()):
+        raise Exception(f'{filename}: the keys of the data are {list(data.keys())}')
+    for key,var_slices in plan.slots.items():
+        names = plan.device_names[key]
+        for var_name in var_slices:
+            expected = np.squeeze(values[:, [column[(name, var_name)] for name in names]])
+            x = data[key][var_name]
+            if x.shape != expected.shape or not np.array_equal(x, expected):
+                raise Exception(f'{filename}: wrong values of {key}:{var_name}')
+            if verbose:
+                print(f'{key:>5s} {var_name:10s} {str(x.shape):>10s} {", ".join(names)}')
+    return time, data
+
+
+if __name__ == '__main__':
+
+    parser = arg.ArgumentParser(description = 'Check that a ComRes CSV export is parsed in the layout of run_PF.py', \
+                                formatter_class = arg.ArgumentDefaultsHelpFormatter, \
+                                prog = progname)
+    parser.add_argument('-v', '--verbose', action='store_true', help='be verbose')
+    args = parser.parse_args(args=sys.argv[1:])
+
+    time,data = check_exported_data(SAMPLE_FILE, SAMPLE_RECORD_MAP, SAMPLE_DEVICES, args.verbose)
+    print(f'{os.path.basename(SAMPLE_FILE)}: {time.size} samples of ' +
+          f'{sum(len(var_data) for var_data in data.values())} variables parsed correctly.')
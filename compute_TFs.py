@@ -13,15 +13,28 @@ import numpy as np
 # import matplotlib.pyplot as plt
 # import matplotlib
 # import seaborn as sns
-from tqdm import tqdm
+
+from pfcommon import parse_sparse_matrix_file, content_hash, DiskCache, read_power_flow
+from tfcommon import BACKENDS, sweep, descriptor_sweep, adaptive_sweep, LowRankSweep, \
+    output_covariance, variable_names, select_variables
+
+# 'sparse' works directly on the Jacobian, see tfcommon.descriptor_sweep
+ALL_BACKENDS = BACKENDS + ('sparse',)
 
 progname = os.path.basename(sys.argv[0])
 
+# where Jgy_inv and the responses to each input are cached
+CACHE_DIR = os.environ.get('TF_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'pf_TFs'))
+CACHE_SIZE = 2**30
+
 def usage(exit_code=None):
     print(f'usage: {progname} [-h | --help] [-m | --fmin <value>] [-M | --fmax <value>]')
     prefix = '       ' + ' ' * (len(progname)+1)
-    print(prefix + '[-N | --n-steps <value>] [--save-mat]')
+    print(prefix + '[-N | --n-steps <value>] [--save-mat] [-b | --backend <{}>]'.format('|'.join(ALL_BACKENDS)))
     print(prefix + '[-o | --outfile <value>] [-f | --force] [--tau <value>] ')
+    print(prefix + '[--outputs var1<,var2,...>] [--jacobian <Jacobian.mtl>]')
+    print(prefix + '[-j | --jobs <value>] [--pool <thread|process>] [--adaptive] [--rtol <value>]')
+    print(prefix + '[--covariance] [--no-cache] [--cache-size <MB>]')
     print(prefix + '<--P | --Q | --PQ> <--dP | --sigmaP value1<,value2,...>>')
     print(prefix + '<--dQ | --sigmaQ value1<,value2,...>> <-L | --loads load1<,load2,...>> file')
     if exit_code is not None:
@@ -38,6 +51,267 @@ def save_to_mat(mat_file, data_dict=None, npz_data_file=None):
     savemat(mat_file, out, long_field_names=True)
 
 
+def load_bus_name(data, vars_idx, load_name):
+    # the name of the bus whose ur and ui variables are the inputs of load_name
+    bus_name = data['load_buses'].item()[load_name]
+    if bus_name not in vars_idx:
+        # we have to look through the equivalent terms of bus_name
+        bus_equiv_terms = data['bus_equiv_terms'].item()
+        for equiv_term_name in bus_equiv_terms[bus_name]:
+            if equiv_term_name in vars_idx:
+                print('Load {} is connected to bus {}, which is not among the '.
+                      format(load_name, bus_name) + 
+                      'buses whose ur and ui variables are in the Jacobian, but {} is.'.
+                      format(equiv_term_name))
+                return equiv_term_name
+    return bus_name
+
+
+def input_output_matrices(Jfy, Jgx, Jgy_inv, idx, state_out_idx, alg_out_idx):
+    # only the columns of the inputs and the rows of the outputs are needed:
+    # the state variables are mapped directly onto the outputs, while the
+    # algebraic ones are given by y = C x - Jgy_inv v
+    N_state_vars = Jfy.shape[0]
+    B = -Jfy @ Jgy_inv[:,idx]
+    C = np.concatenate((np.eye(N_state_vars)[state_out_idx],
+                        -Jgy_inv[alg_out_idx] @ Jgx))
+    D = np.concatenate((np.zeros((state_out_idx.size, idx.size)),
+                        -Jgy_inv[np.ix_(alg_out_idx, idx)]))
+    return B,C,D
+
+
+# the base systems used by the low-rank update, so that each one is
+# decomposed only once per process
+_low_rank_bases = {}
+
+def low_rank_base(base_file, F, backend, vars_idx, idx, out_idx, N_state_vars):
+    key = (base_file, F.tobytes(), backend, idx.tobytes(), out_idx.tobytes())
+    if key not in _low_rank_bases:
+        data = np.load(base_file, allow_pickle=True)
+        if data['vars_idx'].item() != vars_idx:
+            raise Exception(f'The variables in {base_file} differ from those of the system')
+        state_out_idx = out_idx[out_idx < N_state_vars]
+        alg_out_idx = out_idx[out_idx >= N_state_vars] - N_state_vars
+        J = data['J']
+        Jfy = J[:N_state_vars, N_state_vars:]
+        Jgx = J[N_state_vars:, :N_state_vars]
+        Jgy_inv = np.linalg.inv(J[N_state_vars:, N_state_vars:])
+        B,C,D = input_output_matrices(Jfy, Jgx, Jgy_inv, idx, state_out_idx, alg_out_idx)
+        _low_rank_bases[key] = LowRankSweep(data['A'], B, F, C, D, backend)
+    return _low_rank_bases[key]
+
+
+def cached_responses(cache, key, idx, compute):
+    # the response to each input is cached separately, so that runs with
+    # different sets of loads share the inputs they have in common, while
+    # the PSDs of the loads are applied afterwards
+    keys = {i: content_hash(key, i) for i in idx}
+    cols = {}
+    for i in keys:
+        entry = cache.load(keys[i])
+        if entry is not None:
+            cols[i] = entry['TF']
+    missing = np.array([i for i in keys if i not in cols], dtype=int)
+    if missing.size > 0:
+        TF = compute(missing)
+        for j,i in enumerate(missing):
+            cols[i] = TF[:,:,j]
+            cache.save(keys[i], TF=cols[i])
+    return np.stack([cols[i] for i in idx], axis=2)
+
+
+def compute_TFs(data_file, load_names, fmin=-6., fmax=2., steps_per_decade=100,
+                use_P_constraint=True, use_Q_constraint=False, dP=(), dQ=(), sigmaP=(), sigmaQ=(),
+                tau=20e-3, backend='eig', output_names=None, jacobian_file=None, n_jobs=1,
+                pool='thread', adaptive=False, rtol=1e-2, base_file=None, covariance=False,
+                cache=None, verbose=True):
+    """
+    compute_TFs computes the transfer functions between the OU processes
+    injected at the loads in load_names and the variables of the system whose
+    linearization is stored in data_file, i.e., a file saved by run_PF.py AC.
+
+    The options have the same meaning as the corresponding command line
+    arguments. If base_file is given, the TFs are computed as a low-rank
+    update of those of the system in base_file (see tfcommon.LowRankSweep),
+    which is worthwhile when the two state matrices differ only in a few
+    rows. If covariance is True, no TFs are computed and the output contains
+    instead the stationary covariance matrix 'cov' of the selected variables,
+    obtained by solving a Lyapunov equation. If cache is a pfcommon.DiskCache,
+    Jgy_inv and the response to each input are looked up in it before being
+    computed. Returns the dictionary that is saved to the output file.
+
+    """
+    if base_file is not None and (backend == 'sparse' or adaptive):
+        raise Exception('The low-rank update cannot be used with the sparse backend or the adaptive grid')
+    if covariance and backend == 'sparse':
+        raise Exception('The covariance cannot be computed with the sparse backend')
+
+    N_freq = int(fmax - fmin) * steps_per_decade + 1
+    F = np.logspace(fmin, fmax, N_freq)    
+
+    data = np.load(data_file, allow_pickle=True)
+    SM_names = [n for n in data['gen_names']]
+    bus_names = [n for n in data['voltages'].item().keys()]
+    H = np.array([data['H'].item()[name] for name in SM_names])
+    S = np.array([data['S'].item()[name] for name in SM_names])
+    PF = read_power_flow(data, 'PF_without_slack')
+    SM_keys = [name if name in PF.index('SMs') else name + '____GEN_____' for name in SM_names]
+    P,Q = PF.get('SMs', 'P', SM_keys), PF.get('SMs', 'Q', SM_keys)
+
+    A = data['A']
+    if jacobian_file is None:
+        J = data['J']
+    else:
+        J = parse_sparse_matrix_file(jacobian_file, sparse=True)
+    vars_idx = data['vars_idx'].item()
+    state_vars = data['state_vars'].item()
+    N_vars = J.shape[0]
+    N_state_vars = np.sum([len(v) for v in state_vars.values()])
+    N_algebraic_vars = N_vars - N_state_vars
+    if cache is not None:
+        J_hash = content_hash(J, N_state_vars)
+    if backend == 'sparse':
+        # neither Jgy_inv nor A are computed in this case
+        from scipy.sparse import csc_matrix
+        J = csc_matrix(J)
+        if J.shape[0] != J.shape[1]:
+            raise Exception(f'The Jacobian matrix has shape {J.shape}')
+    else:
+        Jfx = J[:N_state_vars, :N_state_vars]
+        Jfy = J[:N_state_vars, N_state_vars:]
+        Jgx = J[N_state_vars:, :N_state_vars]
+        Jgy = J[N_state_vars:, N_state_vars:]
+        Jgy_inv = None
+        if cache is not None:
+            entry = cache.load(content_hash('Jgy_inv', J_hash))
+            if entry is not None:
+                Jgy_inv = entry['Jgy_inv']
+        if Jgy_inv is None:
+            Jgy_inv = np.linalg.inv(Jgy)
+            if cache is not None:
+                cache.save(content_hash('Jgy_inv', J_hash), Jgy_inv=Jgy_inv)
+        Atmp = Jfx - Jfy @ Jgy_inv @ Jgx
+        assert np.all(np.abs(A-Atmp) < 1e-8)
+
+    var_names = variable_names(vars_idx)
+    if output_names is None:
+        out_idx = np.arange(N_vars)
+    else:
+        out_idx = select_variables(var_names, output_names)
+        if out_idx.size == 0:
+            raise Exception('No variables match ' + ', '.join(output_names))
+    var_names = [var_names[i] for i in out_idx]
+    state_out_idx = out_idx[out_idx < N_state_vars]
+    alg_out_idx = out_idx[out_idx >= N_state_vars] - N_state_vars
+
+    load_buses = data['load_buses'].item()
+    all_load_names = []
+    all_dP,all_dQ,all_sigmaP,all_sigmaQ = [],[],[],[]
+    def try_append(dst, src, i):
+        try: dst.append(src[i])
+        except: pass
+    for i,load_name in enumerate(load_names):
+        if '*' in load_name:
+            for load in load_buses.keys():
+                if re.match(load_name, load):
+                    all_load_names.append(load)
+                    try_append(all_dP, dP, i)
+                    try_append(all_dQ, dQ, i)
+                    try_append(all_sigmaP, sigmaP, i)
+                    try_append(all_sigmaQ, sigmaQ, i)
+        elif load_name not in load_buses:
+            raise Exception(f'Cannot find load `{load_name}`')
+        else:
+            all_load_names.append(load_name)
+            try_append(all_dP, dP, i)
+            try_append(all_dQ, dQ, i)
+            try_append(all_sigmaP, sigmaP, i)
+            try_append(all_sigmaQ, sigmaQ, i)
+    load_names = all_load_names
+    dP,dQ,sigmaP,sigmaQ = all_dP,all_dQ,all_sigmaP,all_sigmaQ
+    def fix_len(lst1, lst2):
+        if len(lst1) == 1 and len(lst2) > 1:
+            return lst1*len(lst2)
+        return lst1
+    dP = fix_len(dP, load_names)
+    dQ = fix_len(dQ, load_names)
+    sigmaP = fix_len(sigmaP, load_names)
+    sigmaQ = fix_len(sigmaQ, load_names)
+
+    idx = []
+    c,alpha = [], []
+    for i,load_name in enumerate(load_names):
+        keys = []
+        bus_name = load_bus_name(data, vars_idx, load_name)
+        if use_P_constraint:
+            # real part of voltage
+            idx.append(vars_idx[bus_name]['ur'])
+            keys.append('P')
+        if use_Q_constraint:
+            # imaginary part of voltage
+            idx.append(vars_idx[bus_name]['ui'])
+            keys.append('Q')
+        for key in keys:
+            mean = PF.value('loads', load_name, key)
+            if key == 'P':
+                if len(dP) > 0:
+                    stddev = dP[i] * abs(mean)
+                else:
+                    stddev = sigmaP[i]
+            else:
+                if len(dQ) > 0:
+                    stddev = dQ[i] * abs(mean)
+                else:
+                    stddev = sigmaQ[i]
+            c.append(stddev*np.sqrt(2/tau))
+            alpha.append(1/tau)
+
+    idx = np.array(idx) - N_state_vars
+    c,alpha = np.array(c), np.array(alpha)
+    Htot = data['inertia']
+    Etot = data['energy']
+    Mtot = data['momentum']
+    if covariance:
+        B,C,D = input_output_matrices(Jfy, Jgx, Jgy_inv, idx, state_out_idx, alg_out_idx)
+        cov = output_covariance(A, B, c, alpha, C, D)
+        return {'A': A, 'cov': cov,
+                'var_names': var_names, 'SM_names': SM_names, 'bus_names': bus_names,
+                'Htot': Htot, 'Etot': Etot, 'Mtot': Mtot, 'H': H, 'S': S, 'P': P, 'Q': Q,
+                **PF.to_arrays('PF'), 'bus_equiv_terms': data['bus_equiv_terms']}
+
+    def compute(idx):
+        if backend == 'sparse':
+            return descriptor_sweep(J, N_state_vars, F, idx, out_idx, n_jobs, pool, verbose)
+        B,C,D = input_output_matrices(Jfy, Jgx, Jgy_inv, idx, state_out_idx, alg_out_idx)
+        return sweep(A, B, F, backend, C, D, n_jobs=n_jobs, pool=pool, verbose=verbose)
+
+    if base_file is not None:
+        B,C,D = input_output_matrices(Jfy, Jgx, Jgy_inv, idx, state_out_idx, alg_out_idx)
+        base = low_rank_base(base_file, F, backend, vars_idx, idx, out_idx, N_state_vars)
+        TF = base(A, B, C, D, verbose)
+    elif adaptive:
+        # F is replaced by the non-uniform grid
+        B,C,D = input_output_matrices(Jfy, Jgx, Jgy_inv, idx, state_out_idx, alg_out_idx)
+        TF,F = adaptive_sweep(A, B, 10**fmin, 10**fmax, backend, C, D, rtol=rtol,
+                              n_jobs=n_jobs, pool=pool, verbose=verbose)
+    elif cache is not None:
+        TF = cached_responses(cache, (J_hash, out_idx, F, backend), idx, compute)
+    else:
+        TF = compute(idx)
+
+    # TF has shape (N_freq, N_outputs, N_inputs)
+    PSD = np.sqrt((c/alpha)**2 / (1 + (2*np.pi*F[:,np.newaxis]/alpha)**2))
+    TF *= PSD[:,np.newaxis,:]
+    TF = TF.transpose((2,0,1))
+    TF[TF==0] = 1e-20 * (1+1j)
+    
+    out = {'A': A, 'F': F, 'TF': TF,
+           'var_names': var_names, 'SM_names': SM_names, 'bus_names': bus_names,
+           'Htot': Htot, 'Etot': Etot, 'Mtot': Mtot, 'H': H, 'S': S, 'P': P, 'Q': Q,
+           **PF.to_arrays('PF'), 'bus_equiv_terms': data['bus_equiv_terms']}
+    return out
+
+
 if __name__ == '__main__':
 
     # default values    
@@ -47,11 +321,27 @@ if __name__ == '__main__':
     save_mat = False
     outdir, outfile = '', None
     load_names = None
+    # shell-style patterns of the variables whose TFs are computed, e.g., *.speed
+    output_names = None
+    # the Jacobian file saved by PowerFactory, used with the sparse backend
+    jacobian_file = None
     use_P_constraint, use_Q_constraint = False, False
     dP,dQ = [],[]
     sigmaP,sigmaQ = [],[]
     # time constant of the OU process
     tau = 20e-3
+    backend = 'eig'
+    # number of workers among which the frequencies are distributed
+    n_jobs = 1
+    pool = 'thread'
+    # whether to refine the frequency grid around the resonances instead of
+    # using steps_per_decade points per decade
+    adaptive = False
+    rtol = 1e-2
+    # whether to compute the covariance matrix of the outputs instead of the TFs
+    covariance = False
+    use_cache = True
+    cache_size = CACHE_SIZE
 
     i = 1
     n_args = len(sys.argv)
@@ -71,6 +361,9 @@ if __name__ == '__main__':
         elif arg in ('-L', '--loads'):
             i += 1
             load_names = sys.argv[i].split(',')
+        elif arg == '--outputs':
+            i += 1
+            output_names = sys.argv[i].split(',')
         elif arg == '--P':
             use_P_constraint = True
         elif arg == '--Q':
@@ -98,6 +391,30 @@ if __name__ == '__main__':
             outfile = sys.argv[i]
         elif arg == '--save-mat':
             save_mat = True
+        elif arg in ('-b', '--backend'):
+            i += 1
+            backend = sys.argv[i]
+        elif arg == '--jacobian':
+            i += 1
+            jacobian_file = sys.argv[i]
+        elif arg in ('-j', '--jobs'):
+            i += 1
+            n_jobs = int(sys.argv[i])
+        elif arg == '--pool':
+            i += 1
+            pool = sys.argv[i]
+        elif arg == '--adaptive':
+            adaptive = True
+        elif arg == '--rtol':
+            i += 1
+            rtol = float(sys.argv[i])
+        elif arg == '--covariance':
+            covariance = True
+        elif arg == '--no-cache':
+            use_cache = False
+        elif arg == '--cache-size':
+            i += 1
+            cache_size = int(float(sys.argv[i]) * 2**20)
         elif arg in ('-f', '--force'):
             force = True
         elif arg[0] == '-':
@@ -149,8 +466,11 @@ if __name__ == '__main__':
         outdir = os.path.dirname(data_file)
         if outdir == '':
             outdir = '.'
-        outfile = os.path.splitext(os.path.basename(data_file))[0] + \
-            '_TF_{}_{}_{}'.format(fmin, fmax, steps_per_decade) + '.npz'
+        if covariance:
+            outfile = os.path.splitext(os.path.basename(data_file))[0] + '_cov.npz'
+        else:
+            outfile = os.path.splitext(os.path.basename(data_file))[0] + \
+                '_TF_{}_{}_{}'.format(fmin, fmax, 'adaptive' if adaptive else steps_per_decade) + '.npz'
     if os.path.isfile(os.path.join(outdir, outfile)) and not force:
         print(f'{progname}: {os.path.join(outdir, outfile)}: file exists, use -f to overwrite.')
         sys.exit(1)
@@ -161,155 +481,45 @@ if __name__ == '__main__':
     if steps_per_decade <= 0:
         print(f'{progname}: number of steps per decade must be > 0.')
         sys.exit(1)
-
-    if load_names is None:
-        print(f'{progname}: you must specify the name of at least one load where the signal is injected.')
+    if backend not in ALL_BACKENDS:
+        print(f'{progname}: backend must be one of ' + ', '.join(ALL_BACKENDS) + '.')
+        sys.exit(1)
+    if n_jobs <= 0:
+        print(f'{progname}: number of jobs must be > 0.')
         sys.exit(1)
 
-    N_freq = int(fmax - fmin) * steps_per_decade + 1
-    F = np.logspace(fmin, fmax, N_freq)    
+    if pool not in ('thread', 'process'):
+        print(f'{progname}: pool must be one of thread, process.')
+        sys.exit(1)
 
-    data = np.load(data_file, allow_pickle=True)
-    SM_names = [n for n in data['gen_names']]
-    bus_names = [n for n in data['voltages'].item().keys()]
-    H = np.array([data['H'].item()[name] for name in SM_names])
-    S = np.array([data['S'].item()[name] for name in SM_names])
-    PF = data['PF_without_slack'].item()
-    n_SMs = len(SM_names)
-    P,Q = np.zeros(n_SMs), np.zeros(n_SMs)
-    for i,name in enumerate(SM_names):
-        if name in PF['SMs']:
-            key = name
-        else:
-            key = name + '____GEN_____'
-        P[i] = PF['SMs'][key]['P']
-        Q[i] = PF['SMs'][key]['Q']
+    if covariance and (backend == 'sparse' or adaptive):
+        print(f'{progname}: --covariance cannot be used with --adaptive or the sparse backend.')
+        sys.exit(1)
+    if adaptive and backend == 'sparse':
+        print(f'{progname}: --adaptive cannot be used with the sparse backend.')
+        sys.exit(1)
+    if rtol <= 0:
+        print(f'{progname}: relative tolerance must be > 0.')
+        sys.exit(1)
 
-    J,A = data['J'], data['A']
-    vars_idx = data['vars_idx'].item()
-    state_vars = data['state_vars'].item()
-    N_vars = J.shape[0]
-    N_state_vars = np.sum([len(v) for v in state_vars.values()])
-    N_algebraic_vars = N_vars - N_state_vars
-    Jfx = J[:N_state_vars, :N_state_vars]
-    Jfy = J[:N_state_vars, N_state_vars:]
-    Jgx = J[N_state_vars:, :N_state_vars]
-    Jgy = J[N_state_vars:, N_state_vars:]
-    Jgy_inv = np.linalg.inv(Jgy)
-    Atmp = Jfx - Jfy @ Jgy_inv @ Jgx
-    assert np.all(np.abs(A-Atmp) < 1e-8)
+    if jacobian_file is not None and backend != 'sparse':
+        print(f'{progname}: --jacobian can only be used with the sparse backend.')
+        sys.exit(1)
 
-    load_buses = data['load_buses'].item()
-    all_load_names = []
-    all_dP,all_dQ,all_sigmaP,all_sigmaQ = [],[],[],[]
-    def try_append(dst, src, i):
-        try: dst.append(src[i])
-        except: pass
-    for i,load_name in enumerate(load_names):
-        if '*' in load_name:
-            for load in load_buses.keys():
-                if re.match(load_name, load):
-                    all_load_names.append(load)
-                    try_append(all_dP, dP, i)
-                    try_append(all_dQ, dQ, i)
-                    try_append(all_sigmaP, sigmaP, i)
-                    try_append(all_sigmaQ, sigmaQ, i)
-        elif load_name not in load_buses:
-            print(f'{progname}: cannot find load `{load_name}`.')
-            sys.exit(0)
-        else:
-            all_load_names.append(load_name)
-            try_append(all_dP, dP, i)
-            try_append(all_dQ, dQ, i)
-            try_append(all_sigmaP, sigmaP, i)
-            try_append(all_sigmaQ, sigmaQ, i)
-    load_names = all_load_names
-    dP,dQ,sigmaP,sigmaQ = all_dP,all_dQ,all_sigmaP,all_sigmaQ
-    def fix_len(lst1, lst2):
-        if len(lst1) == 1 and len(lst2) > 1:
-            return lst1*len(lst2)
-        return lst1
-    dP = fix_len(dP, load_names)
-    dQ = fix_len(dQ, load_names)
-    sigmaP = fix_len(sigmaP, load_names)
-    sigmaQ = fix_len(sigmaQ, load_names)
+    if load_names is None:
+        print(f'{progname}: you must specify the name of at least one load where the signal is injected.')
+        sys.exit(1)
 
-    PF_loads = data['PF_without_slack'].item()['loads']
-    idx = []
-    c,alpha = [], []
-    for i,load_name in enumerate(load_names):
-        keys = []
-        bus_name = load_buses[load_name]
-        if bus_name not in vars_idx:
-            # we have to look through the equivalent terms of bus_name
-            bus_equiv_terms = data['bus_equiv_terms'].item()
-            for equiv_term_name in bus_equiv_terms[bus_name]:
-                if equiv_term_name in vars_idx:
-                    print('Load {} is connected to bus {}, which is not among the '.
-                          format(load_name, bus_name) + 
-                          'buses whose ur and ui variables are in the Jacobian, but {} is.'.
-                          format(equiv_term_name))
-                    bus_name = equiv_term_name
-                    break
-        if use_P_constraint:
-            # real part of voltage
-            idx.append(vars_idx[bus_name]['ur'])
-            keys.append('P')
-        if use_Q_constraint:
-            # imaginary part of voltage
-            idx.append(vars_idx[bus_name]['ui'])
-            keys.append('Q')
-        for key in keys:
-            mean = PF_loads[load_name][key]
-            if key == 'P':
-                if len(dP) > 0:
-                    stddev = dP[i] * abs(mean)
-                else:
-                    stddev = sigmaP[i]
-            else:
-                if len(dQ) > 0:
-                    stddev = dQ[i] * abs(mean)
-                else:
-                    stddev = sigmaQ[i]
-            c.append(stddev*np.sqrt(2/tau))
-            alpha.append(1/tau)
+    cache = DiskCache(CACHE_DIR, cache_size) if use_cache else None
+    try:
+        out = compute_TFs(data_file, load_names, fmin, fmax, steps_per_decade,
+                          use_P_constraint, use_Q_constraint, dP, dQ, sigmaP, sigmaQ,
+                          tau, backend, output_names, jacobian_file, n_jobs, pool,
+                          adaptive, rtol, covariance=covariance, cache=cache)
+    except Exception as e:
+        print(f'{progname}: {e}.')
+        sys.exit(1)
 
-    idx = np.array(idx) - N_state_vars
-    c,alpha = np.array(c), np.array(alpha)
-    B = -Jfy @ Jgy_inv
-    C = -Jgy_inv @ Jgx
-    
-    N_inputs = c.size
-    I = np.eye(N_state_vars)
-    M = np.zeros((N_freq, N_state_vars, N_state_vars), dtype=complex)
-    TF = np.zeros((N_inputs, N_freq, N_state_vars+N_algebraic_vars), dtype=complex)
-
-    for i in tqdm(range(N_freq), ascii=True, ncols=70):
-        M[i,:,:] = np.linalg.inv(-A + 1j*2*np.pi*F[i]*I)
-        MxB = M[i,:,:] @ B
-        PSD = np.sqrt((c/alpha)**2 / (1 + (2*np.pi*F[i]/alpha)**2))
-        for j,psd in enumerate(PSD):
-            v = np.zeros(N_algebraic_vars, dtype=float)
-            v[idx[j]] = psd
-            tmp = MxB @ v
-            TF[j,i,:N_state_vars] = tmp
-            TF[j,i,N_state_vars:] = (C @ tmp - Jgy_inv @ v)
-    TF[TF==0] = 1e-20 * (1+1j)
-    vars_idx = data['vars_idx'].item()
-    var_names,idx = [],[]
-    for k1,D in vars_idx.items():
-        for k2,v in D.items():
-            var_names.append(k1 + '.' + k2)
-            idx.append(v)
-    var_names = [var_names[i] for i in np.argsort(idx)]
-    
-    Htot = data['inertia']
-    Etot = data['energy']
-    Mtot = data['momentum']
-    out = {'A': A, 'F': F, 'TF': TF,
-           'var_names': var_names, 'SM_names': SM_names, 'bus_names': bus_names,
-           'Htot': Htot, 'Etot': Etot, 'Mtot': Mtot, 'H': H, 'S': S, 'P': P, 'Q': Q,
-           'PF': data['PF_without_slack'], 'bus_equiv_terms': data['bus_equiv_terms']}
     np.savez_compressed(os.path.join(outdir, outfile), **out)
 
     if save_mat:
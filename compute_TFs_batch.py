@@ -0,0 +1,257 @@
+
+import os
+import sys
+import glob
+import time
+import traceback
+import argparse as arg
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from pfcommon import DiskCache, content_hash
+from compute_TFs import compute_TFs, ALL_BACKENDS, CACHE_DIR, CACHE_SIZE
+
+progname = os.path.basename(sys.argv[0])
+
+
+def output_file_name(data_file, outdir, fmin, fmax, steps_per_decade, adaptive):
+    # same naming convention as compute_TFs.py
+    if outdir is None:
+        outdir = os.path.dirname(data_file)
+    outfile = os.path.splitext(os.path.basename(data_file))[0] + \
+        '_TF_{}_{}_{}'.format(fmin, fmax, 'adaptive' if adaptive else steps_per_decade) + '.npz'
+    return os.path.join(outdir, outfile)
+
+
+def parameters_hash(kwargs):
+    # the hash of all the parameters that determine the TFs, which is saved in
+    # each output file: the output name includes only some of them
+    params = {key: value for key,value in kwargs.items() if key not in ('cache', 'verbose')}
+    if params['base_file'] is not None:
+        # the TFs also depend on the contents of the base file
+        params['base_file_mtime'] = os.path.getmtime(params['base_file'])
+    return content_hash('compute_TFs', params)
+
+
+def is_up_to_date(outfile, data_file, params_hash):
+    # the output must be newer than the input and computed with the same parameters
+    if not os.path.isfile(outfile) or os.path.getmtime(outfile) < os.path.getmtime(data_file):
+        return False
+    try:
+        with np.load(outfile) as data:
+            return 'params_hash' in data.files and str(data['params_hash']) == params_hash
+    except Exception:
+        return False
+
+
+def init_worker():
+    # the parallelism is across files: each worker uses one BLAS thread
+    for var in 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS':
+        os.environ[var] = '1'
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=1, user_api='blas')
+    except ImportError:
+        pass
+
+
+def run_one(data_file, outfile, kwargs, params_hash):
+    # runs in a worker process: exceptions are returned instead of raised,
+    # so that a failure does not stop the other files in the batch
+    try:
+        out = compute_TFs(data_file, **kwargs)
+        out['params_hash'] = params_hash
+        # write to a temporary file first, so that an interrupted batch does
+        # not leave behind output files that look up to date
+        tmp_file = outfile[:-4] + '.tmp.npz'
+        np.savez_compressed(tmp_file, **out)
+        os.replace(tmp_file, outfile)
+    except Exception:
+        return data_file, outfile, traceback.format_exc()
+    return data_file, outfile, None
+
+
+def _append(fid, name, x, atom, filters):
+    # appends one row to an extendable array, creating it the first time
+    if name not in fid.root:
+        fid.create_earray(fid.root, name, atom, (0,) + x.shape, filters=filters,
+                          chunkshape=(1,) + x.shape)
+    elif fid.root[name].shape[1:] != x.shape:
+        raise Exception(f'Array "{name}" has shape {x.shape}, expected {fid.root[name].shape[1:]}')
+    fid.root[name].append(x[np.newaxis])
+
+
+def append_to_store(store_file, data_file, outfile):
+    """
+    Appends the TFs saved in outfile to the consolidated store, a HDF5 file with
+    one row per input file in each of its (chunked) arrays. Files that are
+    already in the store are not appended again, and all files must have
+    been computed with the same parameters.
+
+    Returns True if the data were appended.
+    """
+    import tables
+    data = np.load(outfile, allow_pickle=True)
+    filters = tables.Filters(complevel=5, complib='zlib')
+    with tables.open_file(store_file, 'a') as fid:
+        if 'data_files' in fid.root:
+            if data_file in [f.decode('utf-8') for f in fid.root.data_files.read()]:
+                return False
+            if not np.array_equal(fid.root.F.read(), data['F']) or \
+                [n.decode('utf-8') for n in fid.root.var_names.read()] != list(data['var_names']):
+                raise Exception('Frequencies or variables do not match those in the store')
+            if 'params_hash' not in fid.root._v_attrs or \
+                fid.root._v_attrs.params_hash != str(data['params_hash']):
+                raise Exception('The TFs were computed with different parameters from those in the store')
+        else:
+            fid.root._v_attrs.params_hash = str(data['params_hash'])
+            fid.create_array(fid.root, 'F', data['F'])
+            fid.create_array(fid.root, 'var_names', [n.encode('utf-8') for n in data['var_names']])
+            fid.create_array(fid.root, 'SM_names', [n.encode('utf-8') for n in data['SM_names']])
+            fid.create_vlarray(fid.root, 'data_files', tables.VLStringAtom())
+        # the file name is appended last, so that a row is listed only if complete
+        _append(fid, 'TF', data['TF'], tables.ComplexAtom(16), filters)
+        for key in 'H', 'S', 'P', 'Q':
+            _append(fid, key, data[key], tables.Float64Atom(), filters)
+        for key in 'Htot', 'Etot', 'Mtot':
+            _append(fid, key, np.atleast_1d(data[key]).astype(float), tables.Float64Atom(), filters)
+        fid.root.data_files.append(data_file.encode('utf-8'))
+    return True
+
+
+if __name__ == '__main__':
+
+    parser = arg.ArgumentParser(description = 'Compute the TFs of many AC analysis files in parallel', \
+                                formatter_class = arg.ArgumentDefaultsHelpFormatter, \
+                                prog = progname)
+    parser.add_argument('files', type=str, nargs='+', help='AC analysis files or glob patterns, e.g., "sims/*/*_AC.npz"')
+    parser.add_argument('-L', '--loads', required=True, type=str, help='comma-separated names of the loads where the signal is injected')
+    parser.add_argument('-m', '--fmin', default=-6., type=float, help='log10 of the minimum frequency')
+    parser.add_argument('-M', '--fmax', default=2., type=float, help='log10 of the maximum frequency')
+    parser.add_argument('-N', '--n-steps', default=100, type=int, help='number of steps per decade')
+    parser.add_argument('--P', action='store_true', help='inject the signal on the active power')
+    parser.add_argument('--Q', action='store_true', help='inject the signal on the reactive power')
+    parser.add_argument('--dP', default='', type=str, help='comma-separated relative standard deviations of P')
+    parser.add_argument('--dQ', default='', type=str, help='comma-separated relative standard deviations of Q')
+    parser.add_argument('--sigmaP', default='', type=str, help='comma-separated standard deviations of P')
+    parser.add_argument('--sigmaQ', default='', type=str, help='comma-separated standard deviations of Q')
+    parser.add_argument('--tau', default=20e-3, type=float, help='time constant of the OU process')
+    parser.add_argument('-b', '--backend', default='eig', choices=ALL_BACKENDS, help='frequency sweep backend')
+    parser.add_argument('--outputs', default=None, type=str, help='comma-separated patterns of the output variables')
+    parser.add_argument('--adaptive', action='store_true', help='use an adaptive frequency grid')
+    parser.add_argument('--rtol', default=1e-2, type=float, help='relative tolerance of the adaptive grid')
+    parser.add_argument('--base', default=None, type=str, help='AC analysis file of the base system: the TFs of the other '
+                        'files are computed as low-rank updates of those of the base system')
+    parser.add_argument('-j', '--jobs', default=os.cpu_count(), type=int, help='number of worker processes')
+    parser.add_argument('-o', '--output-dir', default=None, type=str, help='output directory (default: next to each input file)')
+    parser.add_argument('-f', '--force', action='store_true', help='recompute outputs that are up to date')
+    parser.add_argument('--store', default=None, type=str, help='HDF5 file where all results are appended')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the cache of Jgy_inv and input responses')
+    parser.add_argument('--cache-size', default=CACHE_SIZE/2**20, type=float, help='maximum size of the cache in MB')
+    parser.add_argument('--log', default=None, type=str, help='file where failures are logged')
+    args = parser.parse_args(args=sys.argv[1:])
+
+    data_files = []
+    for pattern in args.files:
+        # patterns are expanded here since not all shells do it
+        files = sorted(glob.glob(pattern, recursive=True))
+        if len(files) == 0:
+            print(f'{progname}: {pattern}: no such file.')
+        data_files += [f for f in files if f not in data_files]
+    if len(data_files) == 0:
+        sys.exit(1)
+
+    if not args.P and not args.Q:
+        print(f'{progname}: at least one of --P and --Q must be specified.')
+        sys.exit(1)
+    to_list = lambda s: list(map(float, s.split(','))) if s != '' else []
+    dP,dQ = to_list(args.dP),to_list(args.dQ)
+    sigmaP,sigmaQ = to_list(args.sigmaP),to_list(args.sigmaQ)
+    for use,d,sigma,key in (args.P,dP,sigmaP,'P'),(args.Q,dQ,sigmaQ,'Q'):
+        if use and (len(d) > 0) == (len(sigma) > 0):
+            print(f'{progname}: exactly one of --d{key} and --sigma{key} must be specified with --{key}.')
+            sys.exit(1)
+    if args.fmin >= args.fmax:
+        print(f'{progname}: fmin must be < fmax.')
+        sys.exit(1)
+    if args.jobs <= 0:
+        print(f'{progname}: number of jobs must be > 0.')
+        sys.exit(1)
+    if args.adaptive and args.backend == 'sparse':
+        print(f'{progname}: --adaptive cannot be used with the sparse backend.')
+        sys.exit(1)
+    if args.base is not None:
+        if not os.path.isfile(args.base):
+            print(f'{progname}: {args.base}: no such file.')
+            sys.exit(1)
+        if args.adaptive or args.backend == 'sparse':
+            print(f'{progname}: --base cannot be used with --adaptive or the sparse backend.')
+            sys.exit(1)
+    if args.adaptive and args.store is not None:
+        print(f'{progname}: --store requires the same frequencies for all files and cannot be used with --adaptive.')
+        sys.exit(1)
+
+    if args.output_dir is not None and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    kwargs = {'load_names': args.loads.split(','), 'fmin': args.fmin, 'fmax': args.fmax,
+              'steps_per_decade': args.n_steps, 'use_P_constraint': args.P,
+              'use_Q_constraint': args.Q, 'dP': dP, 'dQ': dQ, 'sigmaP': sigmaP,
+              'sigmaQ': sigmaQ, 'tau': args.tau, 'backend': args.backend,
+              'output_names': args.outputs.split(',') if args.outputs is not None else None,
+              'adaptive': args.adaptive, 'rtol': args.rtol, 'base_file': args.base,
+              'cache': None if args.no_cache else DiskCache(CACHE_DIR, int(args.cache_size * 2**20)),
+              'verbose': False}
+
+    outfiles = [output_file_name(data_file, args.output_dir, args.fmin, args.fmax,
+                                 args.n_steps, args.adaptive) for data_file in data_files]
+    if len(set(outfiles)) < len(outfiles):
+        print(f'{progname}: some input files have the same name: do not use --output-dir.')
+        sys.exit(1)
+
+    params_hash = parameters_hash(kwargs)
+    todo,done = [],[]
+    for data_file,outfile in zip(data_files, outfiles):
+        if not args.force and is_up_to_date(outfile, data_file, params_hash):
+            done.append((data_file, outfile))
+        else:
+            todo.append((data_file, outfile))
+    print(f'{len(data_files)} files: {len(done)} up to date, {len(todo)} to process.')
+
+    def log_failure(data_file, msg):
+        print(f'{progname}: {data_file}: failed.')
+        print(msg)
+        if args.log is not None:
+            with open(args.log, 'a') as fid:
+                fid.write(f'{time.strftime("%Y-%m-%d %H:%M:%S")} {data_file}\n{msg}\n')
+
+    failed = []
+    def store(data_file, outfile):
+        if args.store is not None:
+            try:
+                append_to_store(args.store, data_file, outfile)
+            except Exception:
+                failed.append(data_file)
+                log_failure(data_file, traceback.format_exc())
+
+    for data_file,outfile in done:
+        store(data_file, outfile)
+
+    if len(todo) > 0:
+        from tqdm import tqdm
+        with ProcessPoolExecutor(min(args.jobs, len(todo)), initializer=init_worker) as executor:
+            futures = [executor.submit(run_one, data_file, outfile, kwargs, params_hash) for data_file,outfile in todo]
+            for future in tqdm(as_completed(futures), total=len(futures), ascii=True, ncols=70):
+                data_file,outfile,error = future.result()
+                if error is None:
+                    store(data_file, outfile)
+                else:
+                    failed.append(data_file)
+                    log_failure(data_file, error)
+
+    if len(failed) > 0:
+        print(f'{progname}: {len(failed)} of {len(data_files)} files failed:')
+        for data_file in failed:
+            print('    ' + data_file)
+        sys.exit(1)
+
@@ -2,7 +2,9 @@ import os
 import re
 import sys
 import numpy as np
-from tqdm import tqdm
+
+from pfcommon import read_power_flow
+from tfcommon import sweep, variable_names, select_variables
 
 progname = os.path.basename(sys.argv[0])
 
@@ -35,6 +37,12 @@ if __name__ == '__main__':
     sigmaP,sigmaQ = [],[]
     # time constant of the OU process
     tau = 20e-3
+    # see tfcommon.BACKENDS
+    backend = 'eig'
+    # only the TFs of these variables are computed
+    output_names = ['G 01.speed', 'G 02.speed', 'G 03.speed', 
+                    'G 04.speed', 'G 05.speed', 'G 06.speed', 
+                    'G 07.speed', 'G 08.speed', 'G 09.speed', 'G 10.speed']
 
     for sim in list_simulations: #cicliamo tutto ogni file viene salvato quindi se vuoi interrompere basta che metti i giusti punti di inizio
         data_file =os.path.join(directory, sim, file_jacobiano)
@@ -92,7 +100,7 @@ if __name__ == '__main__':
         bus_names = [n for n in data['voltages'].item().keys()]
         H = np.array([data['H'].item()[name] for name in SM_names])
         S = np.array([data['S'].item()[name] for name in SM_names])
-        PF = data['PF_without_slack'].item()
+        PF = read_power_flow(data, 'PF_without_slack')
         n_SMs = len(SM_names)
         P,Q = np.zeros(n_SMs), np.zeros(n_SMs)
         for i,name in enumerate(SM_names):
@@ -152,7 +160,7 @@ if __name__ == '__main__':
         sigmaP = fix_len(sigmaP, load_names)
         sigmaQ = fix_len(sigmaQ, load_names)
 
-        PF_loads = data['PF_without_slack'].item()['loads']
+        PF_loads = PF['loads']
         idx = []
         c,alpha = [], []
         for i,load_name in enumerate(load_names):
@@ -194,55 +202,30 @@ if __name__ == '__main__':
 
         idx = np.array(idx) - N_state_vars
         c,alpha = np.array(c), np.array(alpha)
-        B = -Jfy @ Jgy_inv
-        C = -Jgy_inv @ Jgx
-        
-        N_inputs = c.size
-        I = np.eye(N_state_vars)
-        M = np.zeros((N_freq, N_state_vars, N_state_vars), dtype=complex)
-        TF = np.zeros((N_inputs, N_freq, N_state_vars+N_algebraic_vars), dtype=complex)
-
-        for i in tqdm(range(N_freq), ascii=True, ncols=70):
-            M[i,:,:] = np.linalg.inv(-A + 1j*2*np.pi*F[i]*I)
-            MxB = M[i,:,:] @ B
-            PSD = np.sqrt((c/alpha)**2 / (1 + (2*np.pi*F[i]/alpha)**2))
-            for j,psd in enumerate(PSD):
-                v = np.zeros(N_algebraic_vars, dtype=float)
-                v[idx[j]] = psd
-                tmp = MxB @ v
-                TF[j,i,:N_state_vars] = tmp
-                TF[j,i,N_state_vars:] = (C @ tmp - Jgy_inv @ v)
+        var_names = variable_names(vars_idx)
+        out_idx = select_variables(var_names, output_names)
+        var_names = [var_names[i] for i in out_idx]
+        state_out_idx = out_idx[out_idx < N_state_vars]
+        alg_out_idx = out_idx[out_idx >= N_state_vars] - N_state_vars
+        B = -Jfy @ Jgy_inv[:,idx]
+        C = np.concatenate((np.eye(N_state_vars)[state_out_idx],
+                            -Jgy_inv[alg_out_idx] @ Jgx))
+        D = np.concatenate((np.zeros((state_out_idx.size, idx.size)),
+                            -Jgy_inv[np.ix_(alg_out_idx, idx)]))
+
+        TF = sweep(A, B, F, backend, C, D, verbose=True)
+        PSD = np.sqrt((c/alpha)**2 / (1 + (2*np.pi*F[:,np.newaxis]/alpha)**2))
+        TF *= PSD[:,np.newaxis,:]
+        TF = TF.transpose((2,0,1))
         TF[TF==0] = 1e-20 * (1+1j)
-        vars_idx = data['vars_idx'].item()
-        var_names,idx = [],[]
-        for k1,D in vars_idx.items():
-            for k2,v in D.items():
-                var_names.append(k1 + '.' + k2)
-                idx.append(v)
-        var_names = [var_names[i] for i in np.argsort(idx)]
         
         Htot = data['inertia']
         Etot = data['energy']
         Mtot = data['momentum']
-        interesting_variables = ['G 01.speed', 'G 02.speed', 'G 03.speed', 
-                                 'G 04.speed', 'G 05.speed', 'G 06.speed', 
-                                 'G 07.speed', 'G 08.speed', 'G 09.speed', 'G 10.speed']
-        index = []
-        var_to_save = []
-        for var in var_names:
-            if var in interesting_variables:
-                index.append(True)
-                var_to_save.append(var)
-            else:
-                index.append(False)
-        print(len(var_names))
-        print(len(index))
-        print(TF.shape)
-        TF = TF[:,:,index]
         out = {'A': A, 'F': F, 'TF': TF,
-            'var_names': var_to_save, 'SM_names': SM_names, 'bus_names': bus_names,
+            'var_names': var_names, 'SM_names': SM_names, 'bus_names': bus_names,
             'Htot': Htot, 'Etot': Etot, 'Mtot': Mtot, 'H': H, 'S': S, 'P': P, 'Q': Q,
-            'PF': data['PF_without_slack']}
+            **PF.to_arrays('PF')}
         np.savez_compressed(os.path.join(outdir, outfile), **out)
 
         if save_mat:
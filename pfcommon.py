@@ -8,13 +8,22 @@ __all__ = ['BaseParameters', 'AutomaticVoltageRegulator', 'TurbineGovernor',
            'Load', 'SynchronousMachine', 'PowerPlant', 'Bus', 'Transformer',
            'Line', 'Shunt', 'SeriesCapacitor', 'CommonImpedance',
            'get_simulation_variables', 'get_simulation_time', 'get_simulation_dt',
-           'get_ID', 'get_line_bus_IDs', 'normalize', 'OU', 'OU_2', 'run_power_flow',
+           'find_simulation_columns', 'extract_simulation_data', 'SimulationData',
+           'export_simulation_data', 'read_exported_simulation_data',
+           'get_ID', 'get_line_bus_IDs', 'normalize', 'OU', 'OU_2', 'OU_batch', 'OU_2_batch',
+           'OU_chunks', 'OU_2_chunks', 'spawn_random_states', 'spatial_correlation',
+           'write_measurement_file', 'write_measurement_files', 'write_joint_measurement_files',
+           'LoadProfile', 'read_load_profile',
+           'run_power_flow', 'PowerFlowResults', 'read_power_flow',
+           'AdmittanceMatrix', 'build_admittance_matrix', 'network_admittance_matrix',
+           'NewtonPowerFlow',
            'print_power_flow', 'correct_traces', 'find_element_by_name',
            'is_voltage', 'is_power', 'is_frequency', 'is_current', 
            'compute_generator_inertias', 'sort_objects_by_name', 'get_objects',
-           'make_full_object_name', 'build_network_graph', 'Node', 'Edge',
+           'make_full_object_name', 'build_network_graph', 'network_graph_from_terminals',
+           'Node', 'Edge', 'SNAPSHOT_ATTRIBUTES', 'NetworkSnapshot', 'get_network_snapshot',
            'parse_sparse_matrix_file', 'parse_Amat_vars_file', 'parse_Jacobian_vars_file',
-           'compute_TF']
+           'compute_TF', 'content_hash', 'DiskCache']
 
 
 class BaseParameters (tables.IsDescription):
@@ -25,8 +34,11 @@ class BaseParameters (tables.IsDescription):
 def _bus_name_to_terminal_name(bus):
     return 'bus{}'.format(int(re.findall('\d+', bus)[0]))
 
+def _element_name(loc_name):
+    return re.sub('^[0-9]*', '', loc_name).replace(' ','').replace('-','')
+
 def _read_element_parameters(element, par_names=None, type_par_names=None, bus_names=['bus1']):
-    data = {'name': re.sub('^[0-9]*', '', element.loc_name).replace(' ','').replace('-','')}
+    data = {'name': _element_name(element.loc_name)}
     if bus_names is not None and len(bus_names) > 0:
         data['terminals'] = [element.GetAttribute(bus_name).cterm.loc_name
                              for bus_name in bus_names]
@@ -366,18 +378,30 @@ def find_connected_terminal(term1, conn_elm, attr_names):
 
 
 class Node (object):
+    __slots__ = ('name', 'voltage', 'coords', 'lat', 'lon')
+
     def __init__(self, name, voltage, coords=[0.,0.]):
         self.name = name
         self.voltage = voltage
         self.coords = np.array(coords)
         self.lat, self.lon = coords
 
+    @property
+    def key(self):
+        # two nodes are equal if and only if they have the same key
+        return (self.name, self.voltage, self.lat, self.lon)
+
     def __eq__(self, o):
         return self.name == o.name and self.voltage == o.voltage and \
             self.lat == o.lat and self.lon == o.lon
 
+    def __hash__(self):
+        return hash(self.key)
+
 
 class Edge (object):
+    __slots__ = ('name', 'node1', 'node2', 'length', 'voltage')
+
     def __init__(self, name, node1, node2, length):
         self.name = name
         self.node1 = node1
@@ -385,6 +409,13 @@ class Edge (object):
         self.length = length
         self.voltage = max(node1.voltage, node2.voltage) # somewhat arbitrarily
 
+    @property
+    def key(self):
+        # the same for an edge and for the one with swapped nodes: the voltage
+        # is not part of it, since it depends only on the nodes
+        node_keys = self.node1.key, self.node2.key
+        return (self.name, self.length) + (node_keys if node_keys[0] <= node_keys[1] else node_keys[::-1])
+
     def __str__(self):
         return 'Terminal 1: {} @ ({:.3f},{:.3f})\n'.format(self.node1.name,
                                                            self.node1.lat,
@@ -401,10 +432,21 @@ class Edge (object):
             self.node2 == o.node2 and self.length == o.length and \
             self.voltage == o.voltage
 
+    def __hash__(self):
+        return hash((self.name, self.node1.key, self.node2.key, self.length))
+
 
-def make_edges_from_terminal(term1):
-    term1_name = make_full_object_name(term1)
-    node1 = Node(term1_name, term1.uknom, [term1.GPSlat, term1.GPSlon])
+def _make_node(term, nodes):
+    # equal nodes are shared by all the edges that contain them
+    node = Node(make_full_object_name(term), term.uknom, [term.GPSlat, term.GPSlon])
+    return nodes.setdefault(node.key, node)
+
+
+def make_edges_from_terminal(term1, nodes=None):
+    # nodes is a dictionary of the nodes created so far, indexed by their key
+    if nodes is None:
+        nodes = {}
+    node1 = _make_node(term1, nodes)
     edges = []
     for elm in term1.GetConnectedElements():
         if (elm.HasAttribute('outserv') and elm.outserv) or \
@@ -427,43 +469,42 @@ def make_edges_from_terminal(term1):
         # remove the elements that are None
         other_terms = filter(lambda x: x is not None, other_terms)
         for term2 in other_terms:
-            term2_name = make_full_object_name(term2)
-            node2 = Node(term2_name, term2.uknom, [term2.GPSlat, term2.GPSlon])
+            node2 = _make_node(term2, nodes)
             edge = Edge(elm_name, node1, node2, elm.dline if elm.HasAttribute('dline') else 1e-3)
             edges.append(edge)
 
     return edges
 
 
-def build_network_graph(app, verbose=False):
+def network_graph_from_terminals(terminals, verbose=False):
+    """
+    Builds the graph of the network whose terminals are given, i.e., objects
+    with the attributes and methods of a PowerFactory ElmTerm that are used
+    by make_edges_from_terminal. See build_network_graph.
+    """
     from networkx import MultiGraph
-    
-    terminals = get_objects(app, 'ElmTerm')
 
-    swap_nodes = lambda edge: Edge(edge.name, edge.node2, edge.node1, edge.length)
-    
-    edges = []
+    # each edge is found once from each of its terminals: the duplicates are
+    # detected by their key, which does not depend on the order of the nodes
+    edges,keys,nodes = [],{},{}
     cnt, cnt_swapped = 0, 0
     for term1 in terminals:
-        for edge in make_edges_from_terminal(term1):
-            edge_swapped_nodes = swap_nodes(edge)
-            if edge in edges:
+        for edge in make_edges_from_terminal(term1, nodes):
+            key = edge.key
+            if key not in keys:
+                keys[key] = edge
+                edges.append(edge)
+            elif keys[key].node1 == edge.node1 and keys[key].node2 == edge.node2:
                 cnt += 1
                 if verbose: print('Edge {} already present.'.format(edge))
-            elif edge_swapped_nodes in edges:
-                cnt_swapped += 1
             else:
-                edges.append(edge)
+                cnt_swapped += 1
     if verbose:
         print('Number of edges not added: {}'.format(cnt))
         print('Number of swapped edges not added: {}'.format(cnt_swapped))
 
-    nodes = []
-    for edge in edges:
-        if edge.node1 not in nodes:
-            nodes.append(edge.node1)
-        if edge.node2 not in nodes:
-            nodes.append(edge.node2)
+    # the nodes in the order in which they first appear in the edges
+    nodes = list(dict.fromkeys(node for edge in edges for node in (edge.node1, edge.node2)))
 
     G = MultiGraph()
     for e in edges:
@@ -473,6 +514,255 @@ def build_network_graph(app, verbose=False):
     return G,edges,nodes
 
 
+def build_network_graph(app, verbose=False):
+    return network_graph_from_terminals(get_objects(app, 'ElmTerm'), verbose)
+
+
+# the attributes saved in a network snapshot for each class of elements, i.e.,
+# those read by the classes above: the names that start with 'typ_id.' are
+# attributes of the type of the element and those in _SNAPSHOT_BUS_NAMES are
+# saved as the name of the terminal the element is connected to
+SNAPSHOT_ATTRIBUTES = {
+    'ElmTerm': ['uknom', 'm:u', 'm:phiu', 'GPSlat', 'GPSlon'],
+    'ElmSym':  ['bus1', 'ip_ctrl', 'av_mode', 'pgini', 'usetp', 'Pmax_uc', 'Pmin_uc',
+                'q_min', 'q_max', 'ngnum', 'typ_id.model_inp'] + \
+               ['typ_id.' + name for name in ('sgn', 'ugn', 'cosn', 'h', 'iturbo', 'rstr',
+                                              'dpe', 'xl', 'xd', 'xq', 'xrl', 'xrlq', 'tds0',
+                                              'tqs0', 'xds', 'xqs', 'tdss0', 'tqss0', 'xdss',
+                                              'xqss', 'xstr')],
+    'ElmDsl':  ['typ_id.loc_name', 'Ka', 'Ta', 'Kf', 'Tf', 'Ke', 'Te', 'Tr', 'Vrmin', 'Vrmax',
+                'E1', 'E2', 'Se1', 'Se2', 'K', 'T1', 'T2', 'T3', 'K1', 'K2', 'T5', 'K3', 'K4',
+                'T6', 'K5', 'K6', 'T4', 'T7', 'K7', 'K8', 'Uc', 'Uo', 'Pmin', 'Pmax', 'Tg',
+                'Tp', 'Sigma', 'Delta', 'a11', 'a13', 'a21', 'a23', 'Tw'],
+    'ElmLod':  ['bus1', 'plini', 'qlini'],
+    'ElmLne':  ['bus1', 'bus2', 'dline', 'nlnum', 'typ_id.uline', 'typ_id.rline',
+                'typ_id.xline', 'typ_id.bline'],
+    'ElmScap': ['bus1', 'bus2', 'ucn', 'xcap'],
+    'ElmShnt': ['bus1', 'qcapn', 'ushnm', 'bcap', 'gparac'],
+    'ElmZpu':  ['bus1', 'bus2', 'Sn', 'r_pu', 'x_pu'],
+    'ElmTr2':  ['buslv', 'bushv', 'ntnum', 'nntap', 't:dutap', 'typ_id.r1pu',
+                'typ_id.x1pu', 'typ_id.strn', 'typ_id.utrn_h', 'typ_id.utrn_l']
+}
+
+_SNAPSHOT_BUS_NAMES = ('bus1', 'bus2', 'bushv', 'busmv', 'buslv')
+
+
+def _read_snapshot_attribute(obj, attr_name):
+    # returns None if the attribute does not exist, e.g., the parameters of
+    # an AVR for an ElmDsl that is a governor. Any other error is raised, so
+    # that a snapshot with values that could not be read is never cached
+    try:
+        if attr_name.startswith('typ_id.'):
+            obj = obj.typ_id
+            attr_name = attr_name[7:]
+            if obj is None:
+                return None
+        value = obj.GetAttribute(attr_name)
+    except AttributeError:
+        return None
+    if attr_name in _SNAPSHOT_BUS_NAMES:
+        return '' if value is None or value.cterm is None else value.cterm.loc_name
+    return value
+
+
+def _make_snapshot_table(loc_names, attr_names, rows):
+    # a structured array with one row per element: the columns with only
+    # integers (or booleans) are integers, those with numbers are floats and
+    # the others strings. Missing values are NaN or empty strings
+    columns = [np.array(loc_names, dtype=str)]
+    for j in range(len(attr_names)):
+        col = [row[j] for row in rows]
+        values = [v for v in col if v is not None]
+        if len(values) == len(col) and all(isinstance(v, (bool, int, np.integer)) for v in values):
+            columns.append(np.array(col, dtype=np.int64))
+        elif all(isinstance(v, (bool, int, float, np.number)) for v in values):
+            columns.append(np.array([np.nan if v is None else v for v in col], dtype=float))
+        else:
+            columns.append(np.array(['' if v is None else str(v) for v in col], dtype=str))
+    dtype = [(name, col.dtype) for name,col in zip(['loc_name'] + list(attr_names), columns)]
+    table = np.empty(len(loc_names), dtype=dtype)
+    for (name,_),col in zip(dtype, columns):
+        table[name] = col
+    return table
+
+
+class _SnapshotObject (object):
+    # a read-only stand-in for a PowerFactory object, with the attributes
+    # saved in a network snapshot: row is None for a terminal that is not
+    # in the snapshot, of which only the name is known
+    def __init__(self, snapshot, class_name, loc_name, row=None):
+        self._snapshot = snapshot
+        self._class_name = class_name
+        self._row = row
+        self.loc_name = loc_name
+        self.outserv = 0
+
+    def _has_value(self, name):
+        if self._row is None or name not in self._row.dtype.names:
+            return False
+        value = self._row[name]
+        return not (isinstance(value, np.floating) and np.isnan(value))
+
+    def GetClassName(self):
+        return self._class_name
+
+    def GetFullName(self):
+        return f'{self.loc_name}.{self._class_name}'
+
+    def HasAttribute(self, name):
+        return name == 'outserv' or self._has_value(name) or \
+            (name == 'typ_id' and self._row is not None and \
+             any(n.startswith('typ_id.') for n in self._row.dtype.names))
+
+    def GetAttribute(self, name):
+        if name == 'typ_id' and self.HasAttribute('typ_id'):
+            return _SnapshotType(self)
+        if not self._has_value(name):
+            raise AttributeError(f'{self.loc_name}.{self._class_name} has no attribute {name}')
+        value = self._row[name].item()
+        if name in _SNAPSHOT_BUS_NAMES:
+            return _SnapshotCubicle(self._snapshot.element('ElmTerm', value) or \
+                                    _SnapshotObject(self._snapshot, 'ElmTerm', value))
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.GetAttribute(name)
+
+    def __eq__(self, o):
+        return isinstance(o, _SnapshotObject) and self._class_name == o._class_name and \
+            self.loc_name == o.loc_name
+
+    def __hash__(self):
+        return hash((self._class_name, self.loc_name))
+
+
+class _SnapshotType (object):
+    def __init__(self, element):
+        self._element = element
+
+    def GetAttribute(self, name):
+        return self._element.GetAttribute('typ_id.' + name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.GetAttribute(name)
+
+
+class _SnapshotCubicle (object):
+    def __init__(self, terminal):
+        self.cterm = terminal
+
+
+class NetworkSnapshot (object):
+    """
+    The parameters of all the in-service elements of a network, read once
+    from PowerFactory into one structured array per class of elements (see
+    SNAPSHOT_ATTRIBUTES), with a row per element and a column per attribute.
+
+    A snapshot can be saved to a file and loaded without PowerFactory. It
+    behaves like the PowerFactory application object as far as get_objects
+    is concerned, and its elements like PowerFactory objects as far as the
+    classes in this module are concerned, e.g.,
+
+        snapshot = NetworkSnapshot.load('IEEE39.npz')
+        SMs = [SynchronousMachine(sm) for sm in get_objects(snapshot, 'ElmSym')]
+
+    Power plants (ElmComp), whose slots are not saved, must still be read
+    from PowerFactory.
+    """
+    def __init__(self, tables, project_name='', modified=None):
+        self.tables = tables
+        self.project_name = project_name
+        self.modified = modified
+        self._index = {}
+
+    @classmethod
+    def read(cls, app, project_name='', modified=None, attributes=SNAPSHOT_ATTRIBUTES, verbose=False):
+        tables = {}
+        for class_name,attr_names in attributes.items():
+            objs = get_objects(app, class_name)
+            tables[class_name] = _make_snapshot_table([obj.loc_name for obj in objs], attr_names,
+                [[_read_snapshot_attribute(obj, name) for name in attr_names] for obj in objs])
+            if verbose: print(f'Read {len(objs)} objects of class {class_name}.')
+        return cls(tables, project_name, modified)
+
+    def to_arrays(self):
+        arrays = {'project_name': np.array(self.project_name),
+                  'modified': np.array('' if self.modified is None else str(self.modified))}
+        for class_name,table in self.tables.items():
+            arrays['table_' + class_name] = table
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        tables = {k[6:]: arrays[k] for k in arrays if k.startswith('table_')}
+        modified = str(arrays['modified'])
+        return cls(tables, str(arrays['project_name']), modified if modified != '' else None)
+
+    def save(self, filename):
+        np.savez_compressed(filename, **self.to_arrays())
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls.from_arrays({k: data[k] for k in data.files})
+
+    def __getitem__(self, class_name):
+        return self.tables[class_name]
+
+    def element(self, class_name, loc_name):
+        # the element of class_name called loc_name or None: if more than one
+        # element has the same name, the first one is returned
+        if class_name not in self.tables:
+            return None
+        if class_name not in self._index:
+            index = {}
+            for i,name in enumerate(self.tables[class_name]['loc_name']):
+                index.setdefault(name, i)
+            self._index[class_name] = index
+        i = self._index[class_name].get(loc_name)
+        if i is None:
+            return None
+        return _SnapshotObject(self, class_name, loc_name, self.tables[class_name][i])
+
+    def elements(self, class_name):
+        if class_name not in self.tables:
+            return []
+        return [_SnapshotObject(self, class_name, row['loc_name'].item(), row) \
+                for row in self.tables[class_name]]
+
+    def GetCalcRelevantObjects(self, pattern):
+        # pattern ends with the name of the class, e.g., '*.ElmSym' or, as
+        # built by get_objects, '.*ElmSym'
+        return self.elements(pattern.split('.')[-1].lstrip('*'))
+
+
+def get_network_snapshot(app, project, cache=None, attributes=SNAPSHOT_ATTRIBUTES, verbose=False):
+    """
+    Returns the NetworkSnapshot of the active project, reading it from
+    PowerFactory only if cache (a DiskCache) does not contain one for the
+    same project name and modification time.
+    """
+    try:
+        modified = project.GetAttribute('tmodified')
+    except:
+        # without a modification time, the snapshot cannot be reused
+        modified = None
+    if cache is None or modified is None:
+        return NetworkSnapshot.read(app, project.loc_name, modified, attributes, verbose)
+    key = content_hash('network snapshot', project.loc_name, modified, attributes)
+    arrays = cache.load(key)
+    if arrays is not None:
+        if verbose: print(f'Loaded network snapshot of project {project.loc_name} from the cache.')
+        return NetworkSnapshot.from_arrays(arrays)
+    snapshot = NetworkSnapshot.read(app, project.loc_name, modified, attributes, verbose)
+    cache.save(key, **snapshot.to_arrays())
+    return snapshot
+
+
 def sort_objects_by_name(objects):
     argsort = lambda lst: [i for i,_ in sorted(enumerate(lst), key=lambda x: x[1])]
     idx = argsort([obj.loc_name for obj in objects])
@@ -556,14 +846,225 @@ def correct_traces(xre, xim, delta):
 
 
 
-def _compute_samples_interval(res, interval, dt):
-    n_samples = res.GetNumberOfRows()
+def _samples_interval(n_samples, interval, dt):
     start = 0 if interval[0] == 0 else int(interval[0] / dt)
-    stop = n_samples if interval[1] is None else int(np.ceil(interval[1] / dt))
+    stop = n_samples if interval[1] is None else min(int(np.ceil(interval[1] / dt)), n_samples)
     return start,stop
 
 
-def get_simulation_variables(res, var_name, vector, interval=(0,None), dt=None,
+def _compute_samples_interval(res, interval, dt):
+    return _samples_interval(res.GetNumberOfRows(), interval, dt)
+
+
+class SimulationData (object):
+    """
+    The result of extract_simulation_data: time is the vector of the N
+    samples, values an (N,N_requests) array with one column per requested
+    (element, variable) pair and columns the list of the (element name,
+    variable name) pairs of the requests, in the same order.
+    """
+    def __init__(self, time, values, columns):
+        self.time = time
+        self.values = values
+        self.columns = columns
+        self.index = {}
+        for j,col in enumerate(columns):
+            self.index.setdefault(col, j)
+
+    def __getitem__(self, key):
+        # key is an (element name, variable name) pair
+        return self.values[:, self.index[key]]
+
+    def variables(self, var_name, element_names):
+        # an (N,N_elements) array with var_name of the given elements
+        return self.values[:, [self.index[(name, var_name)] for name in element_names]]
+
+    def select(self, columns):
+        # a SimulationData with only the given (element name, variable name) columns
+        missing = [col for col in columns if col not in self.index]
+        if len(missing) > 0:
+            raise Exception('Variable {}:{} is not available.'.format(*missing[0]))
+        return SimulationData(self.time, self.values[:, [self.index[col] for col in columns]],
+                              list(columns))
+
+
+def _read_column(res, col, vector, start, stop, decimation, out):
+    # reads the samples start:stop:decimation of column col (-1 is time) into out
+    if vector is not None:
+        if res.GetColumnValues(vector, col):
+            raise Exception(f'Cannot read column {col} of the results')
+        # slicing the list before the conversion avoids copying unused samples
+        out[:] = vector.V[start:stop:decimation]
+    else:
+        for i,j in enumerate(range(start, stop, decimation)):
+            out[i] = res.GetValue(j, col)[1]
+
+
+def find_simulation_columns(res, requests):
+    """
+    Returns the indices of the columns of res that contain the (element,
+    variable name) pairs in requests, raising an exception if any is missing.
+    The indices do not change as long as the same variables are recorded, so
+    they can be passed to extract_simulation_data more than once.
+    """
+    cols = []
+    for element,var_name in requests:
+        col = res.FindColumn(element, var_name)
+        if col < 0:
+            raise Exception(f'Variable {element.loc_name}:{var_name} is not available.')
+        cols.append(col)
+    return cols
+
+
+def extract_simulation_data(res, requests, vector=None, interval=(0,None), dt=None, decimation=1, columns=None):
+    """
+    Extracts many variables from the results of a simulation at once.
+
+    Parameters
+    ----------
+    res : ElmRes object
+        The results of the simulation, already loaded in memory.
+    requests : list of (element, variable name) pairs
+        The variables to extract: their columns are looked up first, so that
+        a missing variable is reported before any data are read, and each
+        column is read only once, even if it is requested more than once.
+    vector : IntVec object, optional
+        Used to read whole columns with GetColumnValues. If None, the much
+        slower GetValue is called for each sample.
+    interval : tuple, optional
+        Start and stop time of the samples to extract (stop can be None,
+        i.e., the end of the simulation). The default is (0,None).
+    dt : float, optional
+        Time step of the simulation, needed if interval is not (0,None).
+    decimation : int, optional
+        Only one every decimation samples is extracted. The default is 1.
+    columns : list of int, optional
+        The columns of the requested variables, as returned by
+        find_simulation_columns. If None, they are looked up in res.
+
+    Returns
+    -------
+    data : SimulationData
+        The time and the values of the requested variables.
+
+    """
+    cols = find_simulation_columns(res, requests) if columns is None else columns
+    if len(cols) != len(requests):
+        raise Exception('There must be one column for each requested variable.')
+    first = {}
+    for j,col in enumerate(cols):
+        first.setdefault(col, j)
+    start,stop = _compute_samples_interval(res, interval, dt)
+    n_samples = len(range(start, stop, decimation))
+    time = np.empty(n_samples)
+    _read_column(res, -1, vector, start, stop, decimation, time)
+    values = np.empty((n_samples, len(cols)))
+    for j,col in enumerate(cols):
+        if first[col] == j:
+            _read_column(res, col, vector, start, stop, decimation, values[:,j])
+        else:
+            values[:,j] = values[:,first[col]]
+    return SimulationData(time, values, [(element.loc_name, var_name) for element,var_name in requests])
+
+
+def export_simulation_data(app, res, filename, col_sep=',', dec_sep='.'):
+    """
+    Asks PowerFactory to export all the variables in res to a CSV file in a
+    single call, which is much faster than reading long simulations one
+    column at a time. The file can be read with read_exported_simulation_data.
+    """
+    comres = app.GetFromStudyCase('ComRes')
+    comres.pResult = res
+    comres.iopt_exp = 6      # CSV
+    comres.iopt_csel = 0     # all the variables
+    comres.iopt_tsel = 0     # the whole simulation
+    comres.iopt_locn = 2     # element names without their path
+    comres.ciopt_head = 1    # variable names instead of their descriptions
+    comres.iopt_sep = 0      # the separators below, not the system ones
+    comres.col_Sep = col_sep
+    comres.dec_Sep = dec_sep
+    comres.f_name = os.path.abspath(filename)
+    if comres.Execute():
+        raise Exception(f'Cannot export the simulation results to {filename}')
+
+
+def _parse_export_header(line, col_sep):
+    return [field.strip().strip('"').strip() for field in line.rstrip('\r\n').split(col_sep)]
+
+
+def _export_element_name(name):
+    # the element names can include the path and the class of the element
+    return re.sub(r'\.(Elm|Sta|Typ)[A-Za-z0-9]+$', '', name.split('\\')[-1])
+
+
+def _export_variable_name(name):
+    # e.g., 's:speed in p.u.' when the description is included
+    return name.split()[0] if len(name) > 0 else name
+
+
+def read_exported_simulation_data(filename, col_sep=',', dec_sep='.', interval=(0,None),
+                                  dt=None, decimation=1, block_size=2**24):
+    """
+    Reads a CSV file written by export_simulation_data (or by ComRes with the
+    same options), without PowerFactory.
+
+    The file has two header lines, with the element names and the variable
+    names of the columns, the first of which is time. The numbers are parsed
+    by numpy in blocks of about block_size bytes, which are copied into a
+    preallocated array: there is no Python loop over rows or values.
+
+    Returns a SimulationData object, whose columns are the (element name,
+    variable name) pairs of the file, with the samples in the given interval
+    (see extract_simulation_data).
+    """
+    import io
+    with open(filename, 'rb') as fid:
+        elements = _parse_export_header(fid.readline().decode('utf-8', 'replace'), col_sep)
+        variables = _parse_export_header(fid.readline().decode('utf-8', 'replace'), col_sep)
+        if len(elements) != len(variables) or len(elements) < 2:
+            raise Exception(f'{filename}: malformed header')
+        n_cols = len(elements)
+        offset = fid.tell()
+        # the rows are counted first, so that the result can be preallocated
+        n_rows,last = 0,b'\n'
+        for block in iter(lambda: fid.read(block_size), b''):
+            n_rows += block.count(b'\n')
+            last = block[-1:]
+        if last != b'\n':
+            n_rows += 1
+        fid.seek(offset)
+        data = np.empty((n_rows, n_cols))
+        row,rest = 0,b''
+        while True:
+            block = fid.read(block_size)
+            if len(block) == 0:
+                lines,rest = rest,b''
+            else:
+                block = rest + block
+                cut = block.rfind(b'\n') + 1
+                lines,rest = block[:cut],block[cut:]
+            if dec_sep != '.':
+                lines = lines.replace(dec_sep.encode('ascii'), b'.')
+            if lines.strip() == b'':
+                values = np.zeros((0, n_cols))
+            else:
+                values = np.loadtxt(io.BytesIO(lines), delimiter=col_sep, ndmin=2)
+            if values.shape[1] != n_cols:
+                raise Exception(f'{filename}: rows must have {n_cols} values')
+            n = values.shape[0]
+            data[row:row+n] = values
+            row += n
+            if len(block) == 0:
+                break
+    data = data[:row]
+    start,stop = _samples_interval(row, interval, dt)
+    data = data[start:stop:decimation]
+    columns = [(_export_element_name(elm), _export_variable_name(var))
+               for elm,var in zip(elements[1:], variables[1:])]
+    return SimulationData(np.ascontiguousarray(data[:,0]), data[:,1:], columns)
+
+
+def get_simulation_variables(res, var_name, vector=None, interval=(0,None), dt=None,
                              elements=None, elements_name=None, app=None,
                              decimation=1, full_output=False):
     # vector is a PowerFactory IntVec object. It can be None, in which case
@@ -575,32 +1076,15 @@ def get_simulation_variables(res, var_name, vector, interval=(0,None), dt=None,
             raise Exception('You must provide "app" if "elements_name" is passed')
         full_output = True
         elements = app.GetCalcRelevantObjects(elements_name)
-    start,stop = _compute_samples_interval(res, interval, dt)
-    n_samples = stop - start
-    variables = np.zeros((int(np.ceil(n_samples / decimation)), len(elements)))
-    for i,element in enumerate(elements):
-        col = res.FindColumn(element, var_name)
-        if col < 0:
-            raise Exception(f'Variable {element.loc_name}:{var_name} is not available.')
-        if vector is not None:
-            err = res.GetColumnValues(vector, col)
-            if not err:
-                variables[:,i] = np.array(vector.V)[start:stop]
-        else:
-            variables[:,i] = np.array([res.GetValue(j,col)[1] for j in range(start, stop, decimation)])
+    data = extract_simulation_data(res, [(element, var_name) for element in elements],
+                                   vector, interval, dt, decimation)
     if full_output:
-        return np.squeeze(variables), elements
-    return np.squeeze(variables)
+        return np.squeeze(data.values), elements
+    return np.squeeze(data.values)
 
 
-def get_simulation_time(res, vector, interval=(0,None), dt=None, decimation=1):
-    start,stop = _compute_samples_interval(res, interval, dt)
-    if vector is not None:
-        err = res.GetColumnValues(vector, -1)
-        if err:
-            raise Exception('Cannot get time variable')
-        return np.array(vector.V)[start:stop]
-    return np.array([res.GetValue(i,-1)[1] for i in range(start, stop, decimation)])
+def get_simulation_time(res, vector=None, interval=(0,None), dt=None, decimation=1):
+    return extract_simulation_data(res, [], vector, interval, dt, decimation).time
 
 
 get_simulation_dt = lambda res: np.diff([res.GetValue(i, -1)[1] for i in range(2)])[0]
@@ -645,17 +1129,14 @@ def OU(dt, mean, stddev, tau, N, random_state = None):
         A realization of the Ornstein-Uhlenbeck process with the above parameters.
 
     """
-    const = 2 * stddev**2 / tau
-    mu = np.exp(-dt / tau)
-    coeff = np.sqrt(const * tau / 2 * (1 - mu**2))
+    mu,coeff = _OU_coefficients(dt, stddev, tau)
     if random_state is not None:
         rnd = random_state.normal(size=N)
     else:
         rnd = np.random.normal(size=N)
     ou = np.zeros(N)
     ou[0] = mean
-    for i in range(1, N):
-        ou[i] = mean + mu * (ou[i-1] - mean) + coeff * rnd[i]
+    ou[1:] = _OU_recursion(ou[0], mean, mu, coeff, rnd[1:])
     return ou
 
 def OU_2(dt, alpha, mu, c, N, random_state = None):
@@ -691,12 +1172,806 @@ def OU_2(dt, alpha, mu, c, N, random_state = None):
         rnd = c * np.sqrt(dt) * np.random.normal(size=N)
     ou = np.zeros(N)
     ou[0] = mu
-    for i in range(N-1):
-        ou[i+1] = (ou[i] + coeff[0] + rnd[i]) * coeff[1]
+    ou[1:] = _OU_2_recursion(ou[0], coeff, rnd[:-1])
+    return ou
+
+
+def _OU_coefficients(dt, stddev, tau):
+    # the coefficients of the recursion of OU
+    const = 2 * stddev**2 / tau
+    mu = np.exp(-dt / tau)
+    coeff = np.sqrt(const * tau / 2 * (1 - mu**2))
+    return mu,coeff
+
+
+def _OU_recursion(prev, mean, mu, coeff, rnd):
+    # ou[i] = mean + mu * (ou[i-1] - mean) + coeff * rnd[i] for all the numbers
+    # in rnd, starting from ou[-1] = prev. The loop runs on Python floats, which
+    # give exactly the same results as numpy's float64 scalars in a fraction
+    # of the time, so that the result can be computed in chunks, bit for bit
+    prev,mean,mu,coeff = float(prev),float(mean),float(mu),float(coeff)
+    ou = []
+    append = ou.append
+    for x in rnd.tolist():
+        prev = mean + mu * (prev - mean) + coeff * x
+        append(prev)
+    return np.array(ou, dtype=float)
+
+
+def _OU_2_recursion(prev, coeff, rnd):
+    # ou[i+1] = (ou[i] + coeff[0] + rnd[i]) * coeff[1], starting from
+    # ou[0] = prev: returns ou[1:]. See _OU_recursion
+    prev,c0,c1 = float(prev),float(coeff[0]),float(coeff[1])
+    ou = []
+    append = ou.append
+    for x in rnd.tolist():
+        prev = (prev + c0 + x) * c1
+        append(prev)
+    return np.array(ou, dtype=float)
+
+
+def _normal_draws(random_state, N, N_loads):
+    # random_state can be None (numpy's global generator), a single object with
+    # a normal method, from which the samples of the loads are drawn one load
+    # after the other, i.e., as in N_loads consecutive calls to OU, or a list
+    # with one such object per load
+    if random_state is None:
+        return np.random.normal(size=(N_loads, N)).T
+    if isinstance(random_state, (list, tuple)):
+        if len(random_state) != N_loads:
+            raise Exception(f'{len(random_state)} random states given for {N_loads} loads')
+        return np.array([rs.normal(size=N) for rs in random_state]).T
+    return random_state.normal(size=(N_loads, N)).T
+
+
+def _ar1_filter(a, x, zi):
+    # y[i] = a * y[i-1] + x[i] along the first axis of x, with y[-1] = zi / a:
+    # scipy's lfilter needs scalar coefficients, so the columns of x are
+    # grouped by their value of a. Also returns the final state of the
+    # filter, to be passed as zi to the next block of samples
+    from scipy.signal import lfilter
+    y = np.empty(x.shape)
+    zf = np.array(zi, dtype=float)
+    if x.shape[0] == 0:
+        # lfilter does not return a meaningful state for empty input
+        return y,zf
+    for value in np.unique(a):
+        cols = np.nonzero(a == value)[0]
+        y[:,cols],z = lfilter([1.], [1., -value], x[:,cols], axis=0, zi=zf[np.newaxis,cols])
+        zf[cols] = z[0]
+    return y,zf
+
+
+def spawn_random_states(seed, n, start=0, stop=None):
+    """
+    spawn_random_states returns the RandomState objects of the streams
+    start,...,stop-1 of n independent streams derived from seed with
+    SeedSequence.spawn. Stream i depends only on seed and i: a run split
+    in shards, each of which takes its own range of the same n streams,
+    draws exactly the numbers of the unsharded run, and no two streams overlap.
+    seed can be an integer or a SeedSequence, e.g., one of those spawned
+    for the trials of a batch.
+    """
+    from numpy.random import RandomState, SeedSequence, MT19937
+    if isinstance(seed, SeedSequence):
+        # a fresh copy, since spawn changes the state of a SeedSequence
+        seed = SeedSequence(seed.entropy, spawn_key=seed.spawn_key)
+    else:
+        seed = SeedSequence(seed)
+    stop = n if stop is None else stop
+    return [RandomState(MT19937(ss)) for ss in seed.spawn(n)[start:stop]]
+
+
+def spatial_correlation(coords, length_scale, kernel='exponential'):
+    """
+    spatial_correlation returns the correlation matrix of processes located
+    at coords, an (N,d) array of coordinates, given by a kernel of their
+    distance d: exp(-d/length_scale) if kernel is 'exponential' and
+    exp(-(d/length_scale)**2/2) if kernel is 'gaussian'. Both are positive
+    semidefinite for any set of points.
+    """
+    coords = np.asarray(coords, dtype=float)
+    if coords.ndim == 1:
+        coords = coords[:,np.newaxis]
+    d = np.sqrt(((coords[:,np.newaxis,:] - coords[np.newaxis,:,:])**2).sum(axis=-1))
+    if kernel == 'exponential':
+        return np.exp(-d / length_scale)
+    if kernel == 'gaussian':
+        return np.exp(-(d / length_scale)**2 / 2)
+    raise Exception('kernel must be one of "exponential" or "gaussian"')
+
+
+def _correlation_factor(corr, N_loads):
+    # L such that corr = L L^T, from a Cholesky factorization or, if corr is
+    # only semidefinite (e.g., two loads are perfectly correlated), from its
+    # eigendecomposition
+    corr = np.asarray(corr, dtype=float)
+    if corr.shape != (N_loads, N_loads):
+        raise Exception(f'The correlation matrix must be {N_loads}x{N_loads}')
+    if not np.allclose(corr, corr.T) or not np.allclose(np.diag(corr), 1):
+        raise Exception('The correlation matrix must be symmetric with unit diagonal')
+    try:
+        return np.linalg.cholesky(corr)
+    except np.linalg.LinAlgError:
+        s,U = np.linalg.eigh((corr + corr.T) / 2)
+        if s[0] < -1e-8 * s[-1]:
+            raise Exception('The correlation matrix is not positive semidefinite')
+        return U * np.sqrt(np.maximum(s, 0))
+
+
+def OU_batch(dt, mean, stddev, tau, N, random_state = None, corr = None):
+    """
+    OU_batch returns realizations of N_loads independent Ornstein-Uhlenbeck
+    processes, with the same parametrization as OU. The recursion is run as
+    a linear filter instead of a Python loop, which is much faster for long
+    realizations but not bit-for-bit identical to OU: use OU where the
+    samples of previous runs must be reproduced exactly.
+
+    Parameters
+    ----------
+    dt : float
+        Time step.
+    mean, stddev, tau : floats or arrays of length N_loads
+        Means, standard deviations and time constants of the processes.
+    N : integer
+        Number of samples.
+    random_state : RandomState object or list of RandomState objects, optional
+        If a single object is given, the random numbers of the processes
+        are drawn one process after the other, so that the result is the
+        same as that of N_loads consecutive calls to OU with that object.
+        If a list is given, each process uses its own object. The default
+        is None, i.e., numpy's global random generator.
+    corr : (N_loads,N_loads) array, optional
+        Correlation matrix of the noise that drives the processes (see
+        spatial_correlation): the independent random numbers of each time
+        step are mixed by its Cholesky factor. If all processes have the same
+        tau, this is also the correlation of the processes. The default is
+        None, i.e., independent processes.
+
+    Returns
+    -------
+    ou : (N,N_loads) array
+        Realizations of the Ornstein-Uhlenbeck processes. They are equal to
+        the output of OU up to round-off, since the operations are carried
+        out in a different order.
+
+    """
+    mean,stddev,tau = np.broadcast_arrays(*map(np.atleast_1d, (mean, stddev, tau)))
+    N_loads = mean.size
+    const = 2 * stddev**2 / tau
+    mu = np.exp(-dt / tau)
+    coeff = np.sqrt(const * tau / 2 * (1 - mu**2))
+    rnd = _normal_draws(random_state, N, N_loads)
+    if corr is not None:
+        rnd = rnd @ _correlation_factor(corr, N_loads).T
+    ou = np.zeros((N, N_loads))
+    # the deviation from the mean starts at 0
+    ou[1:] = _ar1_filter(mu, coeff * rnd[1:], np.zeros(N_loads))[0]
+    return ou + mean
+
+
+def OU_2_batch(dt, alpha, mu, c, N, random_state = None):
+    """
+    OU_2_batch returns realizations of N_loads independent Ornstein-Uhlenbeck
+    processes, with the same parametrization as OU_2. The recursion is run as
+    a linear filter instead of a Python loop, which is not bit-for-bit
+    identical to OU_2 (see OU_batch).
+
+    Parameters
+    ----------
+    dt : float
+        Time step.
+    alpha, mu, c : floats or arrays of length N_loads
+        Parameters of the processes, see OU_2.
+    N : integer
+        Number of samples.
+    random_state : RandomState object or list of RandomState objects, optional
+        See OU_batch.
+
+    Returns
+    -------
+    ou : (N,N_loads) array
+        Realizations of the Ornstein-Uhlenbeck processes. They are equal to
+        the output of OU_2 up to round-off, since the operations are carried
+        out in a different order.
+
+    """
+    alpha,mu,c = np.broadcast_arrays(*map(np.atleast_1d, (alpha, mu, c)))
+    N_loads = mu.size
+    coeff = np.array([alpha * mu * dt, 1 / (1 + alpha * dt)])
+    rnd = c * np.sqrt(dt) * _normal_draws(random_state, N, N_loads)
+    ou = np.zeros((N, N_loads))
+    ou[0] = mu
+    # ou[i+1] = coeff[1] * ou[i] + coeff[1] * (coeff[0] + rnd[i])
+    ou[1:] = _ar1_filter(coeff[1], coeff[1] * (coeff[0] + rnd[:-1]), coeff[1] * mu)[0]
     return ou
 
 
-def run_power_flow(app, project_folder=None, study_case_name=None, verbose=False):
+
+def _copy_random_state(random_state):
+    import copy
+    return copy.deepcopy(np.random.mtrand._rand if random_state is None else random_state)
+
+
+def _set_random_state(random_state, src):
+    # makes random_state continue from where src is
+    if random_state is None:
+        np.random.set_state(src.get_state())
+    elif isinstance(random_state, np.random.Generator):
+        random_state.bit_generator.state = src.bit_generator.state
+    else:
+        random_state.set_state(src.get_state())
+
+
+def _normal_draw_chunks(random_state, N, N_loads, chunk_size):
+    # yields the same random numbers as _normal_draws, chunk_size rows at a time
+    if isinstance(random_state, (list, tuple)):
+        if len(random_state) != N_loads:
+            raise Exception(f'{len(random_state)} random states given for {N_loads} loads')
+        streams = random_state
+    else:
+        # the numbers of the loads are drawn one load after the other from a
+        # single random state: each load gets a copy of it, advanced by the N
+        # numbers of the previous loads, which are drawn in chunks and discarded
+        streams = [_copy_random_state(random_state)]
+        for _ in range(N_loads-1):
+            streams.append(_copy_random_state(streams[-1]))
+            for start in range(0, N, chunk_size):
+                streams[-1].normal(size=min(chunk_size, N-start))
+    for start in range(0, N, chunk_size):
+        n = min(chunk_size, N-start)
+        yield np.array([rs.normal(size=n) for rs in streams]).T
+    if not isinstance(random_state, (list, tuple)):
+        _set_random_state(random_state, streams[-1])
+
+
+def OU_chunks(dt, mean, stddev, tau, N, chunk_size=100000, random_state = None, corr = None,
+              exact = False):
+    """
+    OU_chunks yields the samples returned by OU_batch in blocks of
+    chunk_size rows, carrying the state of the processes from one block to
+    the next, so that memory does not depend on N. The concatenation of the
+    blocks is identical to the output of OU_batch with the same arguments.
+
+    If exact is True, each block is computed with the recursion of OU
+    instead of the linear filter, so that the concatenation of the blocks
+    is identical, bit for bit, to the output of N_loads consecutive calls
+    to OU with the same random state (corr cannot be used).
+
+    With a single random state and more than one process, the numbers of
+    each process are drawn from a copy of the random state advanced past
+    those of the previous processes, which costs (N_loads-1)*N extra draws:
+    a list of random states, one per process, avoids them (see
+    spawn_random_states). The random state is advanced as by OU_batch once
+    all blocks have been consumed.
+    """
+    mean,stddev,tau = np.broadcast_arrays(*map(np.atleast_1d, (mean, stddev, tau)))
+    N_loads = mean.size
+    if exact:
+        if corr is not None:
+            raise Exception('corr cannot be used with exact = True')
+        yield from _OU_exact_chunks(dt, mean, stddev, tau, N, chunk_size, random_state)
+        return
+    const = 2 * stddev**2 / tau
+    mu = np.exp(-dt / tau)
+    coeff = np.sqrt(const * tau / 2 * (1 - mu**2))
+    L = None if corr is None else _correlation_factor(corr, N_loads)
+    z = np.zeros(N_loads)
+    first = True
+    for rnd in _normal_draw_chunks(random_state, N, N_loads, chunk_size):
+        if L is not None:
+            rnd = rnd @ L.T
+        if first:
+            # the deviation from the mean starts at 0 and the first number is not used
+            dev,z = _ar1_filter(mu, coeff * rnd[1:], z)
+            dev = np.concatenate((np.zeros((1, N_loads)), dev))
+            first = False
+        else:
+            dev,z = _ar1_filter(mu, coeff * rnd, z)
+        yield dev + mean
+
+
+def OU_2_chunks(dt, alpha, mu, c, N, chunk_size=100000, random_state = None, exact = False):
+    """
+    OU_2_chunks yields the samples returned by OU_2_batch in blocks of
+    chunk_size rows, carrying the state of the processes from one block to
+    the next. If exact is True, the blocks are identical, bit for bit, to
+    the output of OU_2. See OU_chunks.
+    """
+    alpha,mu,c = np.broadcast_arrays(*map(np.atleast_1d, (alpha, mu, c)))
+    N_loads = mu.size
+    if exact:
+        yield from _OU_2_exact_chunks(dt, alpha, mu, c, N, chunk_size, random_state)
+        return
+    coeff = np.array([alpha * mu * dt, 1 / (1 + alpha * dt)])
+    z = coeff[1] * mu
+    # sample i+1 depends on the i-th random number: the last number of each
+    # block is used in the next one
+    pending = None
+    for rnd in _normal_draw_chunks(random_state, N, N_loads, chunk_size):
+        x = coeff[1] * (coeff[0] + c * np.sqrt(dt) * rnd)
+        if pending is None:
+            ou,z = _ar1_filter(coeff[1], x[:-1], z)
+            ou = np.concatenate((mu[np.newaxis,:], ou))
+        else:
+            ou,z = _ar1_filter(coeff[1], np.concatenate((pending, x[:-1])), z)
+        pending = x[-1:]
+        yield ou
+
+
+def _OU_exact_chunks(dt, mean, stddev, tau, N, chunk_size, random_state):
+    # the blocks of OU_chunks with exact = True: the coefficients are computed
+    # from scalars, as by OU, and the last sample of each process is carried
+    # to the next block
+    mean = mean.tolist()
+    coeffs = [_OU_coefficients(dt, s, t) for s,t in zip(stddev.tolist(), tau.tolist())]
+    last = None
+    for rnd in _normal_draw_chunks(random_state, N, len(mean), chunk_size):
+        ou = np.empty(rnd.shape)
+        for k,(mu,coeff) in enumerate(coeffs):
+            if last is None:
+                # the first number is not used
+                ou[0,k] = mean[k]
+                ou[1:,k] = _OU_recursion(ou[0,k], mean[k], mu, coeff, rnd[1:,k])
+            else:
+                ou[:,k] = _OU_recursion(last[k], mean[k], mu, coeff, rnd[:,k])
+        last = ou[-1].copy()
+        yield ou
+
+
+def _OU_2_exact_chunks(dt, alpha, mu, c, N, chunk_size, random_state):
+    # the blocks of OU_2_chunks with exact = True: sample i+1 depends on the
+    # i-th random number, so the last number of each block is used in the next
+    coeffs = [np.array([a * m * dt, 1 / (1 + a * dt)]) for a,m in zip(alpha.tolist(), mu.tolist())]
+    c,mu = c.tolist(),mu.tolist()
+    last,pending = None,[None] * len(mu)
+    for rnd in _normal_draw_chunks(random_state, N, len(mu), chunk_size):
+        ou = np.empty(rnd.shape)
+        for k,coeff in enumerate(coeffs):
+            x = c[k] * np.sqrt(dt) * rnd[:,k]
+            if last is None:
+                ou[0,k] = mu[k]
+                ou[1:,k] = _OU_2_recursion(ou[0,k], coeff, x[:-1])
+            else:
+                ou[:,k] = _OU_2_recursion(last[k], coeff, np.concatenate((pending[k], x[:-1])))
+            pending[k] = x[-1:]
+        last = ou[-1].copy()
+        yield ou
+
+
+def _format_measurement_rows(tPQ, row_end):
+    # a single %-formatting of a whole block is several times faster than
+    # formatting one row at a time and gives the same bytes as f'{x:.6f}'
+    return ('%.6f\t%.2f\t%.2f' + row_end) * tPQ.shape[0] % tuple(tPQ.ravel().tolist())
+
+
+def write_measurement_file(filename, tPQ, blank_lines=False, rows_per_write=50000):
+    """
+    Writes time, P and Q of a time-varying load to a PowerFactory measurement
+    file (ElmFile).
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file.
+    tPQ : array or iterable of arrays
+        Either an (N,3) array with time, P and Q in its columns or an iterable
+        of such arrays, which are written one after the other: in the latter
+        case only one block at a time needs to be in memory.
+    blank_lines : bool, optional
+        Whether the header and each row are followed by a blank line,
+        as in the files written by run_pf_simulation.py. The default is False.
+    rows_per_write : int, optional
+        Number of rows that are formatted and written at once. The default is 50000.
+
+    Returns
+    -------
+    None.
+
+    """
+    row_end = '\n\n' if blank_lines else '\n'
+    with open(filename, 'w', buffering=2**20) as fid:
+        fid.write('2' + row_end)
+        for block in ([tPQ] if isinstance(tPQ, np.ndarray) else tPQ):
+            _write_measurement_block(fid, block, row_end, rows_per_write)
+
+
+def _write_measurement_block(fid, block, row_end, rows_per_write):
+    block = np.asarray(block, dtype=float)
+    if block.ndim != 2 or block.shape[1] != 3:
+        raise Exception(f'Blocks must have 3 columns, got shape {block.shape}')
+    for i in range(0, block.shape[0], rows_per_write):
+        fid.write(_format_measurement_rows(block[i:i+rows_per_write], row_end))
+
+
+def write_measurement_files(files, blank_lines=False, n_threads=None):
+    """
+    Writes several measurement files concurrently, one per thread (see
+    write_measurement_file): files is a list of (filename, tPQ) pairs.
+    The data of different files must not be generated from a shared
+    random state, since the generators are consumed in separate threads.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    files = list(files)
+    if len(files) == 0:
+        return
+    if n_threads is None:
+        n_threads = min(len(files), os.cpu_count() or 1)
+    if n_threads == 1:
+        for filename,tPQ in files:
+            write_measurement_file(filename, tPQ, blank_lines)
+        return
+    with ThreadPoolExecutor(n_threads) as executor:
+        futures = [executor.submit(write_measurement_file, filename, tPQ, blank_lines)
+                   for filename,tPQ in files]
+        # raises the first exception, if any
+        for future in futures:
+            future.result()
+
+
+def write_joint_measurement_files(filenames, tPQ_chunks, blank_lines=False, rows_per_write=50000):
+    """
+    Writes the measurement files of loads whose samples are generated
+    together, e.g., correlated processes: tPQ_chunks yields lists with one
+    (n,3) block per file, which are appended to the files in turn, so that
+    only one block per file needs to be in memory.
+    """
+    from contextlib import ExitStack
+    row_end = '\n\n' if blank_lines else '\n'
+    with ExitStack() as stack:
+        fids = [stack.enter_context(open(filename, 'w', buffering=2**20)) for filename in filenames]
+        for fid in fids:
+            fid.write('2' + row_end)
+        for blocks in tPQ_chunks:
+            if len(blocks) != len(fids):
+                raise Exception(f'{len(blocks)} blocks given for {len(fids)} files')
+            for fid,block in zip(fids, blocks):
+                _write_measurement_block(fid, block, row_end, rows_per_write)
+
+
+class LoadProfile (object):
+    """
+    A measured (or piecewise-constant) time series of the active and,
+    optionally, reactive power of a load, which can be evaluated at arbitrary
+    times, e.g., to resample it to the time step of a simulation.
+
+    kind is 'linear' (linear interpolation between samples) or 'previous'
+    (each value holds until the next sample, as in a PWL signal). Before the
+    first sample the profile is equal to left, if given, or to its first value;
+    after the last sample it is equal to its last value.
+    """
+    def __init__(self, t, P, Q=None, kind='linear', left=None):
+        if kind not in ('linear', 'previous'):
+            raise Exception('kind must be one of "linear" or "previous"')
+        self.t = np.asarray(t, dtype=float)
+        self.P = np.asarray(P, dtype=float)
+        self.Q = None if Q is None else np.asarray(Q, dtype=float)
+        if self.t.ndim != 1 or self.t.size == 0:
+            raise Exception('Time must be a non-empty vector')
+        if self.P.shape != self.t.shape or (self.Q is not None and self.Q.shape != self.t.shape):
+            raise Exception('Time, P and Q must have the same number of samples')
+        if np.any(np.diff(self.t) < 0):
+            raise Exception('Time must be non-decreasing')
+        self.kind = kind
+        self.left = left
+
+    @property
+    def has_Q(self):
+        return self.Q is not None
+
+    def _resample(self, x, t):
+        left = x[0] if self.left is None else self.left
+        if self.kind == 'linear':
+            return np.interp(t, self.t, x, left=left)
+        idx = np.searchsorted(self.t, t, side='right') - 1
+        y = x[np.maximum(idx, 0)]
+        y[idx < 0] = left
+        return y
+
+    def __call__(self, t):
+        # an (N,2) array with P and Q at times t (Q is NaN if the profile has no Q)
+        t = np.asarray(t, dtype=float)
+        PQ = np.full((t.size, 2), np.nan)
+        PQ[:,0] = self._resample(self.P, t)
+        if self.Q is not None:
+            PQ[:,1] = self._resample(self.Q, t)
+        return PQ
+
+    def mean(self):
+        # the time average of P and Q (the plain average if all samples
+        # have the same time)
+        duration = self.t[-1] - self.t[0]
+        def avg(x):
+            if x is None:
+                return np.nan
+            if duration == 0:
+                return x.mean()
+            if self.kind == 'linear':
+                return np.sum((x[1:] + x[:-1]) / 2 * np.diff(self.t)) / duration
+            return np.sum(x[:-1] * np.diff(self.t)) / duration
+        return avg(self.P),avg(self.Q)
+
+    def scaled(self, P0, Q0, mode='mean'):
+        """
+        Returns a new profile scaled to the nominal powers P0 and Q0 of a load.
+        With mode='pu' the profile is in per unit of P0 and Q0; with mode='mean'
+        it is rescaled so that its time average is P0 and Q0. If the profile
+        has no Q, Q follows P with the power factor of the load.
+        """
+        if mode == 'pu':
+            kP,kQ = P0,Q0
+        elif mode == 'mean':
+            Pm,Qm = self.mean()
+            if Pm == 0 or Qm == 0:
+                raise Exception('Cannot rescale a profile whose mean is zero')
+            kP,kQ = P0/Pm,(np.nan if np.isnan(Qm) else Q0/Qm)
+        else:
+            raise Exception('mode must be one of "pu" or "mean"')
+        P = kP * self.P
+        if self.Q is not None:
+            Q = kQ * self.Q
+        elif P0 != 0:
+            Q = Q0 / P0 * P
+        else:
+            Q = np.full(self.t.shape, Q0, dtype=float)
+        left = None if self.left is None else kP * self.left
+        return LoadProfile(self.t, P, Q, self.kind, left)
+
+    def chunks(self, t0, dt, N, chunk_size=100000):
+        """
+        Yields the (n,2) arrays of P and Q at times t0 + dt * np.arange(N),
+        in blocks of chunk_size rows, as OU_chunks.
+        """
+        for start in range(0, N, chunk_size):
+            yield self(t0 + dt * np.arange(start, min(start + chunk_size, N)))
+
+
+def read_load_profile(filename, dataset='/profile', kind='linear'):
+    """
+    Reads a LoadProfile from a text or HDF5 file.
+
+    Text files contain time, P and, optionally, Q in their columns, separated
+    by white space: the first line can be the number of data columns, as in
+    PowerFactory measurement files, and lines starting with # are ignored.
+    In HDF5 files (extension .h5, .hdf5 or .hdf), dataset is either an (N,2)
+    or (N,3) array with the same columns or a group with the arrays t, P and,
+    optionally, Q.
+    """
+    if os.path.splitext(filename)[1].lower() in ('.h5', '.hdf5', '.hdf'):
+        with tables.open_file(filename, 'r') as fid:
+            node = fid.get_node(dataset)
+            if isinstance(node, tables.Group):
+                return LoadProfile(node.t.read(), node.P.read(),
+                                   node.Q.read() if 'Q' in node else None, kind)
+            data = np.asarray(node.read(), dtype=float)
+    else:
+        with open(filename, 'r') as fid:
+            first_line = fid.readline().split()
+        # the header of PowerFactory measurement files
+        skiprows = 1 if len(first_line) == 1 and first_line[0].isdigit() else 0
+        data = np.loadtxt(filename, skiprows=skiprows, ndmin=2)
+    if data.ndim != 2 or data.shape[1] not in (2, 3):
+        raise Exception(f'{filename}: the profile must have 2 or 3 columns')
+    return LoadProfile(data[:,0], data[:,1], data[:,2] if data.shape[1] == 3 else None, kind)
+
+
+# the classes of the elements in the results of a power flow and the names
+# and PowerFactory attributes of their quantities. NOTE: the ``1`` in the
+# attribute names indicates that it's a positive-sequence quantity
+_PF_CLASSES = {'SMs': 'ElmSym', 'SGs': 'ElmGenStat', 'loads': 'ElmLod',
+               'buses': 'ElmTerm', 'lines': 'ElmLne', 'transformers': 'ElmTr2'}
+_PF_ELEMENT_QUANTITIES = [
+    ('P',      'm:Psum:bus1'),   # [MW]
+    ('Q',      'm:Qsum:bus1'),   # [Mvar]
+    ('ur',     'm:u1r:bus1'),    # [pu]
+    ('ui',     'm:u1i:bus1'),    # [pu]
+    ('u',      'm:u1:bus1'),     # [pu]
+    ('V',      'm:U1:bus1'),     # [kV] line-to-ground voltage
+    ('Vl',     'm:U1l:bus1'),    # [kV] line-to-line voltage
+    ('ir',     'm:i1r:bus1'),    # [pu]
+    ('ii',     'm:i1i:bus1'),    # [pu]
+    ('i',      'm:i1:bus1'),     # [pu]
+    ('I',      'm:I:bus1'),      # [kA]
+    ('phiu',   'm:phiu1:bus1'),  # [deg] voltage angle
+    ('phii',   'm:phii1:bus1'),  # [deg] current angle
+    ('cosphi', 'm:cosphi:bus1')  # power factor
+]
+_PF_QUANTITIES = {
+    'SMs': _PF_ELEMENT_QUANTITIES,
+    'SGs': _PF_ELEMENT_QUANTITIES[:2],
+    'loads': _PF_ELEMENT_QUANTITIES,
+    'buses': [('ur',     'm:u1r'),      # [pu]
+              ('ui',     'm:u1i'),      # [pu]
+              ('u',      'm:u1'),       # [pu]
+              ('V',      'm:U'),        # [kV] line-to-ground voltage
+              ('Vl',     'm:Ul'),       # [kV] line-to-line voltage
+              ('phi',    'm:phiu'),     # [deg]
+              ('phirel', 'm:phiurel')] + \
+             [(f'{pq}_{power_type}', f'm:{pq}{power_type}') for pq in 'PQ'
+              for power_type in ('gen', 'load', 'flow', 'out')],
+    'lines': [(f'{pq}_bus{i}', f'm:{pq}sum:bus{i}') for i in (1,2) for pq in 'PQ'],
+    'transformers': [(f'{pq}_bus{hl}v', f'm:{pq}sum:bus{hl}v') for pq in 'PQ' for hl in 'hl']
+}
+# the terminals over which the totals of P and Q are computed ('' means
+# that the totals are numbers)
+_PF_TOTALS = {'SMs': ('',), 'SGs': ('',), 'loads': ('',),
+              'lines': ('bus1', 'bus2'), 'transformers': ('bushv', 'buslv')}
+
+
+class PowerFlowResults (object):
+    """
+    The results of a power flow, as returned by run_power_flow: for each
+    group of elements ('SMs', 'SGs', 'loads', 'buses', 'lines' and
+    'transformers'), the names of the elements and one array per quantity,
+    with one value per element, e.g.,
+
+        P = results.get('SMs', 'P')           # all the SMs
+        Q = results.get('loads', 'Q', names)  # the loads in names
+
+    Indexing the results by group gives the same nested dictionaries as older
+    versions of run_power_flow, including the 'Ptot' and 'Qtot' entries,
+    e.g., results['SMs']['G 01']['P']. The results are saved to npz files as
+    plain arrays (see to_arrays), so that they can be loaded without pickle.
+    """
+    def __init__(self, names, values):
+        # names: {group: list of names}, values: {group: {quantity: array}}
+        self.names = names
+        self.values = values
+        self._index = {}
+        self._dict = None
+
+    @property
+    def groups(self):
+        return list(self.names.keys())
+
+    def index(self, group):
+        # the row of each element: if more than one element has the same name,
+        # the last one is used, like in the dictionaries
+        if group not in self._index:
+            self._index[group] = {name: i for i,name in enumerate(self.names[group])}
+        return self._index[group]
+
+    def get(self, group, quantity, names=None):
+        values = self.values[group][quantity]
+        if names is None:
+            return values.copy()
+        index = self.index(group)
+        return values[[index[name] for name in names]]
+
+    def value(self, group, name, quantity):
+        return float(self.values[group][quantity][self.index(group)[name]])
+
+    def total(self, group, quantity):
+        # summed in the same order as by older versions of run_power_flow
+        return sum(self.values[group][quantity].tolist(), 0)
+
+    def _group_dict(self, group):
+        quantities = list(self.values[group].keys())
+        nested = [q for q in quantities if group == 'buses' and q[:2] in ('P_', 'Q_')]
+        d = {}
+        if group == 'transformers':
+            for pq in 'PQ':
+                d[f'{pq}tot'] = {term: self.total(group, f'{pq}_{term}') for term in _PF_TOTALS[group]}
+        rows = np.column_stack([self.values[group][q] for q in quantities]).tolist() \
+            if len(quantities) > 0 else [[] for _ in self.names[group]]
+        for name,row in zip(self.names[group], rows):
+            d[name] = {q: x for q,x in zip(quantities, row) if q not in nested}
+            for pq in 'PQ':
+                sub = {q[2:]: x for q,x in zip(quantities, row) if q in nested and q[0] == pq}
+                if len(sub) > 0:
+                    d[name][pq] = sub
+        if group in _PF_TOTALS and group != 'transformers':
+            for pq in 'PQ':
+                terms = _PF_TOTALS[group]
+                if terms == ('',):
+                    if pq in self.values[group]:
+                        d[f'{pq}tot'] = self.total(group, pq)
+                else:
+                    d[f'{pq}tot'] = {term: self.total(group, f'{pq}_{term}') for term in terms}
+        return d
+
+    def to_dict(self):
+        if self._dict is None:
+            self._dict = {group: self._group_dict(group) for group in self.names}
+        return self._dict
+
+    def __getitem__(self, group):
+        return self.to_dict()[group]
+
+    def __contains__(self, group):
+        return group in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self):
+        return self.names.keys()
+
+    def to_arrays(self, prefix):
+        arrays = {}
+        for group in self.names:
+            arrays[f'{prefix}.{group}.names'] = np.array(self.names[group], dtype=str)
+            for quantity,x in self.values[group].items():
+                arrays[f'{prefix}.{group}.{quantity}'] = x
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        names,values = {},{}
+        for key in arrays:
+            if not key.startswith(prefix + '.'):
+                continue
+            group,quantity = key[len(prefix)+1:].split('.', 1)
+            if quantity == 'names':
+                names[group] = [str(n) for n in arrays[key]]
+            else:
+                values.setdefault(group, {})[quantity] = np.asarray(arrays[key], dtype=float)
+        # keep the quantities in the order in which run_power_flow reads them
+        order = {group: [q for q,_ in quantities] for group,quantities in _PF_QUANTITIES.items()}
+        for group in names:
+            v = values.get(group, {})
+            values[group] = {q: v[q] for q in sorted(v, key=lambda q: order[group].index(q) \
+                             if group in order and q in order[group] else len(v))}
+        return cls(names, {group: values[group] for group in names})
+
+    @classmethod
+    def from_dict(cls, results):
+        # the results returned by older versions of run_power_flow
+        names,values = {},{}
+        for group,elements in results.items():
+            names[group] = [name for name in elements if name not in ('Ptot', 'Qtot')]
+            columns = {}
+            for name in names[group]:
+                for quantity,x in elements[name].items():
+                    if isinstance(x, dict):
+                        for k,y in x.items():
+                            columns.setdefault(f'{quantity}_{k}', []).append(y)
+                    else:
+                        columns.setdefault(quantity, []).append(x)
+            values[group] = {quantity: np.array(x, dtype=float) for quantity,x in columns.items()}
+        return cls(names, values)
+
+
+def read_power_flow(data, key):
+    """
+    Returns the PowerFlowResults saved with key, e.g., 'PF_without_slack', in
+    data (a dictionary or the object returned by np.load) either as arrays
+    or, by older versions of the run scripts, as a pickled dictionary.
+    """
+    files = data.files if hasattr(data, 'files') else data.keys()
+    if f'{key}.SMs.names' in files:
+        return PowerFlowResults.from_arrays({k: data[k] for k in files if k.startswith(key + '.')}, key)
+    results = data[key]
+    if isinstance(results, np.ndarray):
+        results = results.item()
+    return PowerFlowResults.from_dict(results)
+
+
+def _read_power_flow_quantities(objs, attr_names, skip_errors):
+    # reads the attributes of all objects into an array with one row per
+    # object: with skip_errors, the objects that do not have all the
+    # attributes are left out, otherwise an exception is raised
+    names,rows = [],[]
+    for obj in objs:
+        try:
+            rows.append([obj.GetAttribute(attr_name) for attr_name in attr_names])
+        except:
+            if not skip_errors:
+                raise
+            continue
+        names.append(obj.loc_name)
+    return names, np.array(rows, dtype=float).reshape(len(rows), len(attr_names))
+
+
+def run_power_flow(app, project_folder=None, study_case_name=None, verbose=False, quantities=None):
+    """
+    Runs a power flow and returns its results as a PowerFlowResults object.
+
+    quantities is an optional dictionary with the names of the quantities
+    to read for each group of elements, e.g., {'SMs': ['P','Q'], 'SGs': ['P']}:
+    the groups that are not in it are not read. By default, all the
+    quantities of all the groups are read.
+    """
     if project_folder is not None and study_case_name is not None:
         study_case = project_folder.GetContents(study_case_name)[0]
         study_case.Activate()
@@ -706,127 +1981,24 @@ def run_power_flow(app, project_folder=None, study_case_name=None, verbose=False
     if err:
         raise Exception('Cannot run load flow')
     if verbose: print('Successfully run load flow.')
-    results = {key: {} for key in ('SMs', 'SGs', 'buses', 'loads', 'lines', 'transformers')}
-    
+
     get_objects = lambda clss: [obj for obj in app.GetCalcRelevantObjects('*.' + clss) \
                                 if not obj.outserv]
-        
-    # NOTE: the ``1`` in the variable names below indicates that it's a
-    # positive-sequence quantity
-    Ptot, Qtot = 0, 0
-    for sm in get_objects('ElmSym'):
-        pq = [sm.GetAttribute(f'm:{c}sum:bus1') for c in 'PQ'] # [MW,Mvar]
-        results['SMs'][sm.loc_name] = {
-            'P':      pq[0], # [MW]
-            'Q':      pq[1], # [Mvar]
-            'ur':     sm.GetAttribute('m:u1r:bus1'),   # [pu]
-            'ui':     sm.GetAttribute('m:u1i:bus1'),   # [pu]
-            'u':      sm.GetAttribute('m:u1:bus1'),    # [pu]
-            'V':      sm.GetAttribute('m:U1:bus1'),    # [kV] line-to-ground voltage
-            'Vl':     sm.GetAttribute('m:U1l:bus1'),   # [kV] line-to-line voltage
-            'ir':     sm.GetAttribute('m:i1r:bus1'),   # [pu]
-            'ii':     sm.GetAttribute('m:i1i:bus1'),   # [pu]
-            'i':      sm.GetAttribute('m:i1:bus1'),    # [pu]
-            'I':      sm.GetAttribute('m:I:bus1'),     # [kA]
-            'phiu':   sm.GetAttribute('m:phiu1:bus1'), # [deg] current angle
-            'phii':   sm.GetAttribute('m:phii1:bus1'), # [deg] current angle
-            'cosphi': sm.GetAttribute('m:cosphi:bus1') # [deg] current angle
-        }
-        Ptot += pq[0]
-        Qtot += pq[1]
-    results['SMs']['Ptot'] = Ptot
-    results['SMs']['Qtot'] = Qtot
-
-    Ptot, Qtot = 0, 0
-    for sg in get_objects('ElmGenStat'):
-        pq = [sg.GetAttribute(f'm:{c}sum:bus1') for c in 'PQ']
-        results['SGs'][sg.loc_name] = {
-            'P': pq[0],
-            'Q': pq[1]
-        }
-        Ptot += pq[0]
-        Qtot += pq[1]
-    results['SGs']['Ptot'] = Ptot
-    results['SGs']['Qtot'] = Qtot
-
-    Ptot, Qtot = 0, 0
-    for load in get_objects('ElmLod'):
-        pq = [load.GetAttribute(f'm:{c}sum:bus1') for c in 'PQ']
-        results['loads'][load.loc_name] = {
-            'P':      pq[0], # [MW]
-            'Q':      pq[1], # [Mvar]
-            'ur':     load.GetAttribute('m:u1r:bus1'),   # [pu]
-            'ui':     load.GetAttribute('m:u1i:bus1'),   # [pu]
-            'u':      load.GetAttribute('m:u1:bus1'),    # [pu]
-            'V':      load.GetAttribute('m:U1:bus1'),    # [kV] line-to-ground voltage
-            'Vl':     load.GetAttribute('m:U1l:bus1'),   # [kV] line-to-line voltage
-            'ir':     load.GetAttribute('m:i1r:bus1'),   # [pu]
-            'ii':     load.GetAttribute('m:i1i:bus1'),   # [pu]
-            'i':      load.GetAttribute('m:i1:bus1'),    # [pu]
-            'I':      load.GetAttribute('m:I:bus1'),     # [kA]
-            'phiu':   load.GetAttribute('m:phiu1:bus1'), # [deg] current angle
-            'phii':   load.GetAttribute('m:phii1:bus1'), # [deg] current angle
-            'cosphi': load.GetAttribute('m:cosphi:bus1') # [deg] current angle
-        }
-        Ptot += pq[0]
-        Qtot += pq[1]
-    results['loads']['Ptot'] = Ptot
-    results['loads']['Qtot'] = Qtot
-    
-    power_types = ['gen','load','flow','out']
-    for bus in get_objects('ElmTerm'):
-        try:
-            results['buses'][bus.loc_name] = {
-                'ur':     bus.GetAttribute('m:u1r'),     # [pu]
-                'ui':     bus.GetAttribute('m:u1i'),     # [pu]
-                'u':      bus.GetAttribute('m:u1'),      # [pu]
-                'V':      bus.GetAttribute('m:U'),       # [kV] line-to-ground voltage
-                'Vl':     bus.GetAttribute('m:Ul'),      # [kV] line-to-line voltage
-                'phi':    bus.GetAttribute('m:phiu'),    # [deg]
-                'phirel': bus.GetAttribute('m:phiurel'), # [deg]
-                'P': {power_type: bus.GetAttribute(f'm:P{power_type}') for power_type in power_types},
-                'Q': {power_type: bus.GetAttribute(f'm:Q{power_type}') for power_type in power_types}
-            }
-        except:
-            pass
-
-    Ptot = {'bus1': 0, 'bus2': 0}
-    Qtot = {'bus1': 0, 'bus2': 0}
-    for line in get_objects('ElmLne'):
-        P1 = line.GetAttribute('m:Psum:bus1')
-        Q1 = line.GetAttribute('m:Qsum:bus1')
-        P2 = line.GetAttribute('m:Psum:bus2')
-        Q2 = line.GetAttribute('m:Qsum:bus2')
-        Ptot['bus1'] += P1
-        Qtot['bus1'] += Q1
-        Ptot['bus2'] += P2
-        Qtot['bus2'] += Q2
-        results['lines'][line.loc_name] = {
-            'P_bus1': P1, 'Q_bus1': Q1,
-            'P_bus2': P2, 'Q_bus2': Q2,
-        }
-    results['lines']['Ptot'] = Ptot
-    results['lines']['Qtot'] = Qtot
-
-    results['transformers']['Ptot'] = {'bushv': 0, 'buslv': 0}
-    results['transformers']['Qtot'] = {'bushv': 0, 'buslv': 0}
-    for trans in get_objects('ElmTr2'):
-        results['transformers'][trans.loc_name] = {}
-        has_attrs = True
-        for pq in 'PQ':
-            for hl in 'hl':
-                try:
-                    val = trans.GetAttribute(f'm:{pq}sum:bus{hl}v')
-                    results['transformers'][trans.loc_name][f'{pq}_bus{hl}v'] = val
-                    results['transformers'][f'{pq}tot'][f'bus{hl}v'] += val
-                except:
-                    results['transformers'].pop(trans.loc_name)
-                    has_attrs = False
-                    break
-            if not has_attrs:
-                break
 
-    return results
+    names,values = {},{}
+    for group,group_quantities in _PF_QUANTITIES.items():
+        if quantities is not None:
+            if group not in quantities:
+                continue
+            group_quantities = [(q,attr) for q,attr in group_quantities if q in quantities[group]]
+        # the buses and the transformers whose quantities are not all available
+        # are left out of the results, as they have always been
+        names[group],x = _read_power_flow_quantities(get_objects(_PF_CLASSES[group]),
+                                                     [attr for _,attr in group_quantities],
+                                                     group in ('buses', 'transformers'))
+        values[group] = {q: x[:,j].copy() for j,(q,_) in enumerate(group_quantities)}
+
+    return PowerFlowResults(names, values)
 
 
 def print_power_flow(results):
@@ -874,10 +2046,446 @@ def print_power_flow(results):
     print('\n======= Buses ========')
     for name in sorted(list(results['buses'].keys())):
         data = results['buses'][name]
-        print(f'{name}: voltage = {data["voltage"]:5.3f} pu, V = {data["Vl"]:7.3f} kV, ' + \
+        print(f'{name}: voltage = {data["u"]:5.3f} pu, V = {data["Vl"]:7.3f} kV, ' + \
               f'Pflow = {data["P"]["flow"]*coeff:7.2f} {unit}W, Qflow = {data["Q"]["flow"]*coeff:7.2f} {unit}VA.')
 
 
+def _branch_parameters(branch, bus_index, vb, S_base):
+    # the index of the from and to buses, the series admittance, the shunt
+    # admittance at each end and the tap ratio (on the from side) of a branch,
+    # in per unit of S_base and of the nominal voltages of the buses
+    terms = [bus_index[_bus_name_to_terminal_name(term)] for term in branch.terminals]
+    if isinstance(branch, Transformer):
+        # the tap is on the HV side, i.e., terminals[1], and the impedance,
+        # given in per unit of the ratings, is referred to the LV side
+        t,f = terms
+        z = (branch.r + 1j * branch.x) * S_base / branch.prating * (branch.vl * 1e3 / vb[t])**2
+        tap = branch.kt * (branch.vh / branch.vl) * (vb[t] / vb[f])
+        return f, t, 1 / z, 0., 0., tap
+    f,t = terms
+    if isinstance(branch, CommonImpedance):
+        # prating is in MVA, as the parameter Sn of ElmZpu
+        z = (branch.r + 1j * branch.x) * S_base / (branch.prating * 1e6)
+        return f, t, 1 / z, 0., 0., 1.
+    # lines and series capacitors, whose parameters are in ohm and S
+    Z_base = vb[f]**2 / S_base
+    num = branch.num if hasattr(branch, 'num') else 1
+    y_sh = 0.5j * branch.b * Z_base * num
+    return f, t, num * Z_base / (branch.r + 1j * branch.x), y_sh, y_sh, 1.
+
+
+class AdmittanceMatrix (object):
+    """
+    The bus admittance matrix of a network, in per unit of S_base and of the
+    nominal voltages of the buses, as returned by build_admittance_matrix.
+
+    Y is a sparse CSR matrix whose rows and columns are in the order of
+    bus_names, i.e., the terminal names of the buses (see Bus.terminal). The
+    contribution of branch k is the 2x2 matrix [[Yff,Yft],[Ytf,Ytt]][k] at
+    rows and columns (f[k],t[k]): branches can be switched out and back in
+    with remove_branch and restore_branch, which update Y in place.
+    """
+    def __init__(self, bus_names, branch_names, f, t, Yff, Yft, Ytf, Ytt, Ysh, S_base):
+        from scipy.sparse import coo_matrix
+        self.bus_names = bus_names
+        self.bus_index = {name: i for i,name in enumerate(bus_names)}
+        self.branch_names = branch_names
+        self.f, self.t = f, t
+        self.Yff, self.Yft, self.Ytf, self.Ytt = Yff, Yft, Ytf, Ytt
+        self.Ysh = Ysh
+        self.S_base = S_base
+        self.in_service = np.ones(f.size, dtype=bool)
+        n = len(bus_names)
+        rows = np.concatenate((f, f, t, t, np.arange(n)))
+        cols = np.concatenate((f, t, f, t, np.arange(n)))
+        vals = np.concatenate((Yff, Yft, Ytf, Ytt, Ysh))
+        # the duplicates are summed, and the entries of all branches are kept,
+        # even if they sum to zero, so that the structure of Y never changes
+        self.Y = coo_matrix((vals, (rows, cols)), shape=(n, n)).tocsr()
+        self.Y.sort_indices()
+        # the positions in Y.data of the four entries of each branch
+        self._pos = np.column_stack([self._positions(rows[i*f.size:(i+1)*f.size],
+                                                     cols[i*f.size:(i+1)*f.size]) for i in range(4)])
+
+    def _positions(self, rows, cols):
+        indptr,indices = self.Y.indptr,self.Y.indices
+        return np.array([indptr[i] + np.searchsorted(indices[indptr[i]:indptr[i+1]], j) \
+                         for i,j in zip(rows, cols)], dtype=int)
+
+    @property
+    def n_buses(self):
+        return len(self.bus_names)
+
+    def branch_index(self, name):
+        return self.branch_names.index(name)
+
+    def branch_stamp(self, k):
+        # the buses of branch k and its contribution to Y between them
+        return (self.f[k], self.t[k]), np.array([[self.Yff[k], self.Yft[k]],
+                                                 [self.Ytf[k], self.Ytt[k]]])
+
+    def _update(self, k, sign):
+        self.Y.data[self._pos[k]] += sign * np.array([self.Yff[k], self.Yft[k], self.Ytf[k], self.Ytt[k]])
+
+    def remove_branch(self, k):
+        if not self.in_service[k]:
+            raise Exception(f'Branch {self.branch_names[k]} is already out of service')
+        self._update(k, -1)
+        self.in_service[k] = False
+
+    def restore_branch(self, k):
+        if self.in_service[k]:
+            raise Exception(f'Branch {self.branch_names[k]} is already in service')
+        self._update(k, 1)
+        self.in_service[k] = True
+
+    def outage_solver(self, solve, k):
+        """
+        Returns a function that solves the linear system with the matrix Y
+        without branch k, given solve, a function that solves it with Y (e.g.,
+        the solve method of scipy.sparse.linalg.splu(Y.tocsc())).
+
+        The outage changes Y by a matrix of rank 2 (1 for a branch without
+        shunt admittance), so it is accounted for by the Woodbury identity
+        with two calls to solve, instead of factorizing Y again.
+        """
+        (f,t),stamp = self.branch_stamp(k)
+        E = np.zeros((self.n_buses, 2))
+        E[f,0] = E[t,1] = 1
+        C = -stamp
+        Z = solve(E.astype(complex))
+        K = np.eye(2) + E.T @ Z @ C
+        def outage_solve(b):
+            x = solve(b)
+            return x - Z @ (C @ np.linalg.solve(K, E.T @ x))
+        return outage_solve
+
+    def branch_matrices(self):
+        # the sparse matrices that give the currents injected into the
+        # branches at their from and to buses, i.e., If = Yf @ V and It = Yt @ V:
+        # the branches out of service have zero rows
+        from scipy.sparse import csr_matrix
+        n_branches,on = self.f.size,self.in_service.astype(float)
+        rows = np.concatenate((np.arange(n_branches), np.arange(n_branches)))
+        shape = (n_branches, self.n_buses)
+        Yf = csr_matrix((np.concatenate((self.Yff, self.Yft)) * np.tile(on, 2),
+                         (rows, np.concatenate((self.f, self.t)))), shape=shape)
+        Yt = csr_matrix((np.concatenate((self.Ytf, self.Ytt)) * np.tile(on, 2),
+                         (rows, np.concatenate((self.f, self.t)))), shape=shape)
+        return Yf, Yt
+
+
+def build_admittance_matrix(buses, branches, shunts=(), S_base=100e6):
+    """
+    Builds the bus admittance matrix of a network.
+
+    Parameters
+    ----------
+    buses : list of Bus objects
+        The buses of the network, which give the order of the rows and
+        columns of the matrix and their nominal voltages.
+    branches : list of Line, SeriesCapacitor, CommonImpedance or Transformer objects
+        The branches of the network, whose terminals must be in buses.
+    shunts : list of Shunt objects, optional
+        The shunts of the network.
+    S_base : float, optional
+        Base power in VA. The default is 100 MVA.
+
+    Returns
+    -------
+    Y : AdmittanceMatrix
+        The admittance matrix and the admittances of each branch.
+
+    """
+    bus_names = [bus.terminal for bus in buses]
+    if len(set(bus_names)) < len(bus_names):
+        raise Exception('The terminal names of the buses are not unique')
+    bus_index = {name: i for i,name in enumerate(bus_names)}
+    vb = np.array([bus.vb for bus in buses])
+    try:
+        params = [_branch_parameters(branch, bus_index, vb, S_base) for branch in branches]
+        shunt_buses = np.array([bus_index[_bus_name_to_terminal_name(shunt.terminals[0])] \
+                                for shunt in shunts], dtype=int)
+    except KeyError as e:
+        raise Exception(f'Bus {e.args[0]} is not in the list of buses')
+    f,t,ys,ysh_f,ysh_t,tap = [np.array(x) for x in zip(*params)] if len(params) > 0 else \
+        [np.zeros(0, dtype=int)] * 2 + [np.zeros(0, dtype=complex)] * 3 + [np.zeros(0)]
+    f,t = f.astype(int),t.astype(int)
+    ys,ysh_f,ysh_t = ys.astype(complex),ysh_f.astype(complex),ysh_t.astype(complex)
+    Yff = (ys + ysh_f) / tap**2
+    Yft = -ys / tap
+    Ytf = -ys / tap
+    Ytt = ys + ysh_t
+    # shunt admittances in S, in per unit of the nominal voltages of their buses
+    Ysh = np.zeros(len(buses), dtype=complex)
+    if len(shunts) > 0:
+        y = np.array([shunt.g + 1j * shunt.b for shunt in shunts])
+        np.add.at(Ysh, shunt_buses, y * vb[shunt_buses]**2 / S_base)
+    return AdmittanceMatrix(bus_names, [branch.name for branch in branches],
+                            f, t, Yff, Yft, Ytf, Ytt, Ysh, S_base)
+
+
+def network_admittance_matrix(app, S_base=100e6, voltages_from='type', verbose=False):
+    """
+    Builds the bus admittance matrix of the in-service elements of a network:
+    app can be the PowerFactory application or a NetworkSnapshot. Returns
+    the AdmittanceMatrix and the Bus objects, in the same order.
+    """
+    import io, sys, contextlib
+    # the classes print a message for each parallel line or transformer
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        buses = [Bus(obj) for obj in get_objects(app, 'ElmTerm')]
+        branches = [Line(obj) for obj in get_objects(app, 'ElmLne')] + \
+            [SeriesCapacitor(obj) for obj in get_objects(app, 'ElmScap')] + \
+            [CommonImpedance(obj) for obj in get_objects(app, 'ElmZpu')] + \
+            [Transformer(obj, voltages_from) for obj in get_objects(app, 'ElmTr2')]
+        shunts = [Shunt(obj) for obj in get_objects(app, 'ElmShnt')]
+    return build_admittance_matrix(buses, branches, shunts, S_base), buses
+
+
+def _power_flow_jacobian(Y, V, pvpq, pq):
+    # the derivatives of the power injections with respect to the angles and
+    # magnitudes of the voltages, in polar coordinates
+    from scipy.sparse import diags, bmat
+    I = Y @ V
+    Vnorm = V / np.abs(V)
+    dS_dVm = diags(V) @ (Y @ diags(Vnorm)).conj() + diags(I.conj() * Vnorm)
+    dS_dVa = 1j * diags(V) @ (diags(I) - Y @ diags(V)).conj()
+    dS_dVa,dS_dVm = dS_dVa.tocsr(),dS_dVm.tocsr()
+    J11 = dS_dVa[pvpq][:,pvpq].real
+    J12 = dS_dVm[pvpq][:,pq].real
+    J21 = dS_dVa[pq][:,pvpq].imag
+    J22 = dS_dVm[pq][:,pq].imag
+    return bmat([[J11, J12], [J21, J22]], format='csc')
+
+
+def _newton_raphson(Y, S, V, ref, pv, pq, tol, max_iter):
+    # solves V * conj(Y @ V) = S at the PV and PQ buses: the angle of the
+    # reference bus and the magnitudes of the PV and reference buses are those of V
+    from scipy.sparse.linalg import spsolve
+    pvpq = np.concatenate((pv, pq))
+    n_pvpq = pvpq.size
+    Va,Vm = np.angle(V),np.abs(V)
+    mismatch = lambda V: V * (Y @ V).conj() - S
+    for it in range(max_iter + 1):
+        mis = mismatch(V)
+        F = np.concatenate((mis[pvpq].real, mis[pq].imag))
+        if F.size == 0 or np.max(np.abs(F)) < tol:
+            return V, True, it
+        if it == max_iter:
+            break
+        dx = spsolve(_power_flow_jacobian(Y, V, pvpq, pq), -F)
+        if not np.all(np.isfinite(dx)):
+            break
+        Va[pvpq] += dx[:n_pvpq]
+        Vm[pq] += dx[n_pvpq:]
+        V = Vm * np.exp(1j * Va)
+    return V, False, it
+
+
+class NewtonPowerFlow (object):
+    """
+    A Newton-Raphson power flow on a bus admittance matrix, which can be used
+    to screen many load and generation scenarios without PowerFactory.
+
+    The synchronous machines control the voltage of their buses (PV buses)
+    within their reactive power limits, except the reference machine, whose
+    bus is the slack. The loads have constant power, i.e., they make up the
+    PQ buses with the buses that have neither. As in the netlist, the active
+    power of a machine is pg * prating, its limits of reactive power are
+    qmin * prating and qmax * prating and its voltage set point is vg.
+
+    All powers are in MW and Mvar, like in the results of run_power_flow,
+    and the voltages are complex, in per unit of the nominal voltages.
+    """
+    def __init__(self, Y, buses, SMs, loads):
+        # Y is an AdmittanceMatrix, buses the Bus objects used to build it and
+        # SMs and loads are SynchronousMachine and Load objects
+        self.Y = Y
+        bus_of = lambda elm: Y.bus_index[_bus_name_to_terminal_name(elm.terminals[0])]
+        n = Y.n_buses
+        self.SM_names = [sm.name for sm in SMs]
+        self.load_names = [load.name for load in loads]
+        self.gen_bus = np.array([bus_of(sm) for sm in SMs], dtype=int)
+        self.load_bus = np.array([bus_of(load) for load in loads], dtype=int)
+        self.P_gen = np.array([sm.pg * sm.prating for sm in SMs]) * 1e-6
+        self.Q_min = np.array([sm.qmin * sm.prating for sm in SMs]) * 1e-6
+        self.Q_max = np.array([sm.qmax * sm.prating for sm in SMs]) * 1e-6
+        self.P_load = np.array([load.pc for load in loads]) * 1e-6
+        self.Q_load = np.array([load.qc for load in loads]) * 1e-6
+        ref = [i for i,sm in enumerate(SMs) if sm.ref_gen]
+        if len(ref) != 1:
+            raise Exception('There must be exactly one reference machine')
+        self.ref_gen = ref[0]
+        self.ref = self.gen_bus[self.ref_gen]
+        # the initial guess is the voltage of the buses, i.e., that of the last
+        # power flow run by PowerFactory: the machines set the magnitudes
+        if Y.bus_index != {bus.terminal: i for i,bus in enumerate(buses)}:
+            raise Exception('The buses are not those of the admittance matrix')
+        V0 = np.array([bus.v0 * np.exp(1j * np.deg2rad(bus.theta0)) for bus in buses])
+        V0[~np.isfinite(V0) | (np.abs(V0) == 0)] = 1.
+        # the first machine of each bus sets its voltage
+        Vm = np.abs(V0)
+        Vm[self.gen_bus[::-1]] = np.array([sm.vg for sm in SMs])[::-1]
+        self.V0 = Vm * np.exp(1j * np.angle(V0))
+        self.pv = np.setdiff1d(self.gen_bus, [self.ref])
+        self.pq = np.setdiff1d(np.arange(n), self.gen_bus)
+
+    @classmethod
+    def from_network(cls, app, S_base=100e6, voltages_from='type', verbose=False):
+        # app can be the PowerFactory application or a NetworkSnapshot
+        import io, sys, contextlib
+        Y,buses = network_admittance_matrix(app, S_base, voltages_from, verbose)
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            SMs = [SynchronousMachine(obj) for obj in get_objects(app, 'ElmSym')]
+            loads = [Load(obj) for obj in get_objects(app, 'ElmLod')]
+        return cls(Y, buses, SMs, loads)
+
+    def solve(self, P_load=None, Q_load=None, P_gen=None, V0=None, q_limits=True, tol=1e-8, max_iter=20):
+        """
+        Solves the power flow with the given powers of the loads and of the
+        machines (the P of the reference machine is ignored): those that are
+        None are the ones of the network. V0 is the initial guess.
+
+        Returns a dictionary with the voltages V, whether the solution
+        converged, the number of iterations and the active and reactive
+        powers P_gen and Q_gen of the machines. With q_limits, the machines
+        that cannot keep the voltage of their bus within their limits of
+        reactive power are set at the limit and their buses become PQ.
+        """
+        S_base = self.Y.S_base * 1e-6
+        P_load = self.P_load if P_load is None else np.asarray(P_load, dtype=float)
+        Q_load = self.Q_load if Q_load is None else np.asarray(Q_load, dtype=float)
+        P_gen = self.P_gen if P_gen is None else np.asarray(P_gen, dtype=float)
+        V = self.V0.copy() if V0 is None else np.array(V0, dtype=complex)
+        # the magnitudes of the PV and slack buses and the angle of the slack are set
+        V_set = np.abs(self.V0)
+        gen_buses = np.append(self.pv, self.ref)
+        V[gen_buses] = V_set[gen_buses] * np.exp(1j * np.angle(V[gen_buses]))
+        V[self.ref] = self.V0[self.ref]
+        n = self.Y.n_buses
+        not_ref = np.arange(self.gen_bus.size) != self.ref_gen
+        S_load = np.zeros(n, dtype=complex)
+        np.add.at(S_load, self.load_bus, (P_load + 1j * Q_load) / S_base)
+        # the machines whose reactive power is fixed at one of their limits
+        Q_fixed = np.full(self.gen_bus.size, np.nan)
+        pv,pq = self.pv.copy(),self.pq.copy()
+        iterations = 0
+        while True:
+            S = -S_load.copy()
+            np.add.at(S, self.gen_bus[not_ref], P_gen[not_ref] / S_base)
+            fixed = np.isfinite(Q_fixed)
+            np.add.at(S, self.gen_bus[fixed], 1j * Q_fixed[fixed] / S_base)
+            V,converged,it = _newton_raphson(self.Y.Y, S, V, self.ref, pv, pq, tol, max_iter)
+            iterations += it
+            Q_bus = ((V * (self.Y.Y @ V).conj()).imag - S.imag) * S_base
+            if not converged or not q_limits:
+                break
+            # the limits of the machines whose buses are still PV
+            free = ~fixed & not_ref & np.isin(self.gen_bus, pv)
+            Q_min,Q_max = np.zeros(n),np.zeros(n)
+            np.add.at(Q_min, self.gen_bus[free], self.Q_min[free])
+            np.add.at(Q_max, self.gen_bus[free], self.Q_max[free])
+            above = pv[Q_bus[pv] > Q_max[pv] + tol * S_base]
+            below = pv[Q_bus[pv] < Q_min[pv] - tol * S_base]
+            if above.size == 0 and below.size == 0:
+                break
+            for buses,limits in (above,self.Q_max),(below,self.Q_min):
+                idx = free & np.isin(self.gen_bus, buses)
+                Q_fixed[idx] = limits[idx]
+            pv = np.setdiff1d(pv, np.concatenate((above, below)))
+            pq = np.union1d(pq, np.concatenate((above, below)))
+        return {'V': V, 'converged': converged, 'iterations': iterations,
+                **self._machine_powers(V, S_load, Q_bus, P_gen, Q_fixed, S_base)}
+
+    def _machine_powers(self, V, S_load, Q_bus, P_gen, Q_fixed, S_base):
+        # the machines at the same bus share the reactive power that is not
+        # fixed in proportion to the width of their ranges (equally if zero),
+        # and the reference machine supplies the active power of the slack
+        P_gen = P_gen.copy()
+        not_ref = np.arange(self.gen_bus.size) != self.ref_gen
+        S_ref = V[self.ref] * (self.Y.Y[self.ref] @ V)[0].conj()
+        P_gen[self.ref_gen] = (S_ref.real + S_load[self.ref].real) * S_base - \
+            np.sum(P_gen[not_ref & (self.gen_bus == self.ref)])
+        Q_gen = np.where(np.isfinite(Q_fixed), Q_fixed, 0.)
+        free = ~np.isfinite(Q_fixed)
+        for bus in np.unique(self.gen_bus[free]):
+            idx = np.where(free & (self.gen_bus == bus))[0]
+            width = self.Q_max[idx] - self.Q_min[idx]
+            weights = width / np.sum(width) if np.all(width > 0) else np.ones(idx.size) / idx.size
+            Q_gen[idx] = Q_bus[bus] * weights
+        return {'P_gen': P_gen, 'Q_gen': Q_gen}
+
+    def solve_batch(self, P_load, Q_load=None, P_gen=None, q_limits=True, tol=1e-8,
+                    max_iter=20, warm_start=True, verbose=False):
+        """
+        Solves the power flow for many scenarios, i.e., the rows of P_load,
+        Q_load and P_gen (those that are None are the ones of the network).
+        With warm_start, each scenario starts from the solution of the closest
+        scenario solved so far, and from the initial guess of the network if
+        that does not converge.
+
+        Returns a dictionary with the same keys as solve, whose values have one
+        row per scenario.
+        """
+        P_load = np.atleast_2d(P_load)
+        n_scenarios = P_load.shape[0]
+        Q_load = np.tile(self.Q_load, (n_scenarios, 1)) if Q_load is None else np.atleast_2d(Q_load)
+        P_gen = np.tile(self.P_gen, (n_scenarios, 1)) if P_gen is None else np.atleast_2d(P_gen)
+        X = np.concatenate((P_load, Q_load, P_gen), axis=1)
+        out = {'V': np.zeros((n_scenarios, self.Y.n_buses), dtype=complex),
+               'converged': np.zeros(n_scenarios, dtype=bool),
+               'iterations': np.zeros(n_scenarios, dtype=int),
+               'P_gen': np.zeros((n_scenarios, self.gen_bus.size)),
+               'Q_gen': np.zeros((n_scenarios, self.gen_bus.size))}
+        solved = []
+        scenarios = range(n_scenarios)
+        if verbose:
+            from tqdm import tqdm
+            scenarios = tqdm(scenarios, ascii=True, ncols=70)
+        for i in scenarios:
+            V0 = None
+            if warm_start and len(solved) > 0:
+                j = solved[np.argmin(np.sum((X[solved] - X[i])**2, axis=1))]
+                V0 = out['V'][j]
+            sol = self.solve(P_load[i], Q_load[i], P_gen[i], V0, q_limits, tol, max_iter)
+            if not sol['converged'] and V0 is not None:
+                sol = self.solve(P_load[i], Q_load[i], P_gen[i], None, q_limits, tol, max_iter)
+            for key in out:
+                out[key][i] = sol[key]
+            if sol['converged']:
+                solved.append(i)
+        return out
+
+    def compare(self, solution, results):
+        """
+        Compares a solution with the results of run_power_flow (a
+        PowerFlowResults object or the equivalent dictionary) for the same
+        scenario. Returns the largest absolute differences of the magnitude
+        (in pu) and of the angle (in degrees) of the voltages of the buses and
+        of the active and reactive powers of the machines.
+        """
+        if not isinstance(results, PowerFlowResults):
+            results = PowerFlowResults.from_dict(results)
+        idx,u,phi = [],[],[]
+        for name,x,y in zip(results.names['buses'], results.get('buses', 'u'), results.get('buses', 'phi')):
+            try:
+                i = self.Y.bus_index[_bus_name_to_terminal_name(name)]
+            except (IndexError, KeyError):
+                continue
+            idx.append(i)
+            u.append(x)
+            phi.append(y)
+        V = solution['V'][idx]
+        dphi = np.angle(np.exp(1j * (np.angle(V) - np.deg2rad(phi))), deg=True)
+        SM_index = {_element_name(name): i for i,name in enumerate(results.names['SMs'])}
+        rows = [SM_index[name] for name in self.SM_names]
+        return {'u': np.max(np.abs(np.abs(V) - np.array(u)), initial=0),
+                'phi': np.max(np.abs(dphi), initial=0),
+                'P': np.max(np.abs(solution['P_gen'] - results.get('SMs', 'P')[rows]), initial=0),
+                'Q': np.max(np.abs(solution['Q_gen'] - results.get('SMs', 'Q')[rows]), initial=0)}
+
+
 def parse_sparse_matrix_file(filename, sparse=False, one_based_indexes=True):
     from scipy.sparse import csr_matrix
     data = np.loadtxt(filename)
@@ -955,12 +2563,20 @@ def parse_Jacobian_vars_file(filename):
     return vars_idx,state_vars,voltages,currents,signals
 
 
-def compute_TF(J, fmin, fmax, Nf, col_idx=0):
+def compute_TF(J, fmin, fmax, Nf, col_idx=0, backend='direct'):
+    # backend can be any of tfcommon.BACKENDS: only the 'direct' backend
+    # computes the full inverse M at each frequency, the others return M = None
     from tqdm import tqdm
     if np.isscalar(col_idx):
         col_idx = [col_idx]
     F = np.logspace(fmin, fmax, Nf)
     Nv = J.shape[0]
+    if backend != 'direct':
+        from tfcommon import sweep
+        b = np.zeros(Nv)
+        np.add.at(b, col_idx, 1)
+        TF = sweep(J, b, F, backend)[:,:,0]
+        return TF,F,None
     I = np.eye(Nv)
     M = np.zeros((Nf, Nv, Nv), dtype=complex)
     TF = np.zeros((Nf, Nv), dtype=complex)
@@ -974,3 +2590,102 @@ def compute_TF(J, fmin, fmax, Nf, col_idx=0):
         # alternatively:
         #TF[i,:] = M[i,:,col_idx].T.sum(axis=1)
     return TF,F,M
+
+
+def content_hash(*items):
+    # SHA-256 digest of the contents of items, which can be numpy arrays,
+    # scipy sparse matrices, strings, numbers or (nested) lists, tuples and
+    # dictionaries of these: equal contents always give equal digests
+    import hashlib
+    h = hashlib.sha256()
+    def update(item):
+        if hasattr(item, 'tocsr') and hasattr(item, 'nnz'):
+            item = item.tocsr()
+            item.sort_indices()
+            h.update(f'sparse{item.shape}'.encode('utf-8'))
+            for x in item.data, item.indices, item.indptr:
+                update(x)
+        elif isinstance(item, np.ndarray) and item.dtype != object:
+            h.update(f'array{item.dtype.str}{item.shape}'.encode('utf-8'))
+            h.update(np.ascontiguousarray(item).tobytes())
+        elif isinstance(item, dict):
+            h.update(b'dict')
+            for k in sorted(item.keys(), key=str):
+                update(k)
+                update(item[k])
+        elif isinstance(item, (list, tuple)):
+            h.update(f'{type(item).__name__}{len(item)}'.encode('utf-8'))
+            for x in item:
+                update(x)
+        else:
+            h.update(repr(item).encode('utf-8'))
+    for item in items:
+        update(item)
+    return h.hexdigest()
+
+
+class DiskCache (object):
+    """
+    A directory of files named after the hash of their contents (see
+    content_hash), whose total size is kept below max_size bytes by
+    removing the least recently used files.
+    """
+    def __init__(self, cache_dir, max_size=2**30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key, ext='.npz'):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def touch(self, key, ext='.npz'):
+        # returns True if the entry exists and marks it as recently used
+        try:
+            os.utime(self.path(key, ext))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def load(self, key):
+        # returns a dictionary with the arrays saved with key or None
+        if not self.touch(key):
+            return None
+        try:
+            with np.load(self.path(key)) as data:
+                return {k: data[k] for k in data.files}
+        except Exception:
+            # e.g., a file truncated by a full disk
+            return None
+
+    def tmp_path(self, key, ext='.npz'):
+        # entries are written to a temporary file first and then moved in
+        # place by commit, so that concurrent processes never see them half-written
+        return self.path(key, f'.{os.getpid()}.tmp{ext}')
+
+    def commit(self, key, ext='.npz'):
+        os.replace(self.tmp_path(key, ext), self.path(key, ext))
+
+    def save(self, key, **arrays):
+        np.savez(self.tmp_path(key), **arrays)
+        self.commit(key)
+        self.prune()
+
+    def prune(self, keep=()):
+        # removes the least recently used entries until the cache fits in
+        # max_size: the entries whose paths are in keep are never removed
+        keep = set(map(os.path.abspath, keep))
+        entries,size = [],0
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and '.tmp.' not in entry.name:
+                st = entry.stat()
+                size += st.st_size
+                if os.path.abspath(entry.path) not in keep:
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        for _,entry_size,path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
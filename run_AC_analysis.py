@@ -12,7 +12,7 @@ from time import time as TIME
 import numpy as np
 
 import powerfactory as pf
-from pfcommon import get_simulation_time, get_simulation_variables
+from pfcommon import get_simulation_time, get_simulation_variables, write_measurement_file
 
 
 __all__ = ['compute_fourier_coeffs', 'SinusoidalLoad']
@@ -77,10 +77,7 @@ class SinusoidalLoad (object):
         if verbosity_level > 1:
             sys.stdout.write(f'Writing sinusoidal input to file (tend = {n_samples*dt:.2f} s)... ')
             sys.stdout.flush()
-        with open(self.meas_filepath, 'w') as fid:
-            fid.write('2\n')
-            for row in tPQ:
-                fid.write(f'{row[0]:.6f}\t{row[1]:.2f}\t{row[2]:.2f}\n')
+        write_measurement_file(self.meas_filepath, tPQ)
         if verbosity_level > 1: sys.stdout.write('done.\n')
 
     def clean(self):
@@ -13,14 +13,21 @@ from time import time as TIME
 import numpy as np
 from numpy.random import RandomState, SeedSequence, MT19937
 
-from pfcommon import OU, get_simulation_time, get_simulation_variables, \
-    run_power_flow, parse_sparse_matrix_file, parse_Amat_vars_file, \
-        parse_Jacobian_vars_file
+from pfcommon import OU_chunks, find_simulation_columns, extract_simulation_data, export_simulation_data, \
+    read_exported_simulation_data, write_measurement_file, write_measurement_files, \
+        run_power_flow, parse_sparse_matrix_file, \
+        parse_Amat_vars_file, parse_Jacobian_vars_file, content_hash, DiskCache, read_load_profile, \
+        spawn_random_states, spatial_correlation, write_joint_measurement_files
 
 
 __all__ = ['compute_fourier_coeffs']
 
 progname = os.path.basename(sys.argv[0])
+
+# the files of the stochastic loads are reused by all runs with the same parameters
+LOAD_CACHE_DIR = os.environ.get('PF_LOAD_CACHE_DIR',
+                                os.path.join(os.path.expanduser('~'), '.cache', 'pf_loads'))
+LOAD_CACHE_SIZE = 2**32
 sys.path.append("C:\\Program Files\\DIgSILENT\\PowerFactory 2023 SP5\\Python\\3.9")
 
 
@@ -99,6 +106,62 @@ def _tran(tstop, verbose=False):
     return sim, t1-t0, err
 
 
+def _append_to_store(fid, time, data):
+    # appends the samples of time and of the variables in data (with the
+    # layout returned by _get_data) to the extendable arrays of an HDF5 file
+    import tables
+    def append(where, name, x, title=''):
+        if name not in where:
+            fid.create_earray(where, name, tables.Float64Atom(), (0,) + x.shape[1:], title=title)
+        where._f_get_child(name).append(x)
+    append(fid.root, 'time', time)
+    for key in data:
+        group = fid.root[key] if key in fid.root else fid.create_group(fid.root, key)
+        for var_name,x in data[key].items():
+            x = np.reshape(x, (time.size, -1))
+            # the names of the variables, e.g., s:speed, are not valid node names
+            append(group, var_name.replace(':', '_'), x[:,0] if x.shape[1] == 1 else x, var_name)
+
+
+def _tran_segmented(res, record_map, data_obj, tstop, segment, dt, store_file, verbose=False):
+    # runs the transient simulation in windows of duration segment: at the end
+    # of each window the new samples are appended to store_file and the results
+    # are cleared, so that memory does not depend on tstop and the samples of
+    # the windows that have been completed are saved even if the run fails
+    import tables
+    record_plan = _record_plan(record_map)
+    sim = PF_APP.GetFromStudyCase('ComSim')
+    t_ends = np.append(np.arange(segment, tstop - segment/1000, segment), tstop)
+    dur,t_last = 0,-np.inf
+    with tables.open_file(store_file, 'w', filters=tables.Filters(complevel=5, complib='zlib')) as fid:
+        for i,t_end in enumerate(t_ends):
+            sim.tstop = t_end
+            if verbose:
+                sys.stdout.write(f'Running simulation until t = {t_end:.1f} sec ({i+1}/{len(t_ends)})... ')
+                sys.stdout.flush()
+            t0 = TIME()
+            # ComSim continues from where the previous window stopped
+            err = sim.Execute()
+            dur += TIME() - t0
+            if verbose:
+                sys.stdout.write(f'done in {TIME()-t0:.0f} sec.\n')
+            if err:
+                break
+            time,data = _get_data(res, record_plan, data_obj, dt=dt, verbose=verbose)
+            # the samples are selected by time, since the first sample of a window
+            # can be the last of the previous one
+            idx = np.asarray(time) > t_last
+            if np.any(idx):
+                time = np.asarray(time)[idx]
+                data = {key: {var_name: np.reshape(x, (idx.size, -1))[idx] for var_name,x in d.items()}
+                        for key,d in data.items()}
+                _append_to_store(fid, time, data)
+                fid.flush()
+                t_last = time[-1]
+            res.Clear()
+    return sim, dur, err
+
+
 def _get_objects(suffix, keep_out_of_service=False):
     return [obj for obj in PF_APP.GetCalcRelevantObjects(suffix) \
             if not obj.outserv or keep_out_of_service]
@@ -313,116 +376,175 @@ def _compute_measures(fn, verbose=False):
     return Htot,Etot,Mtot,Stot,H,S,J,Pload,Qload,Psm,Qsm,Psg,Qsg
 
 
+class RecordPlan(object):
+    """
+    The devices, variables and attributes selected by the 'record' entry of
+    a configuration file, computed once and then shared by _set_vars_to_save,
+    _get_attributes and _get_data. The names of the devices of each type are
+    matched in the same way everywhere: '*' selects all devices, any other
+    string is a regular expression matched against the beginning of loc_name
+    and a list contains the names of the devices. devices is an optional
+    dictionary with the devices of each type among which they are matched,
+    which by default are those of the active project.
+    """
+    def __init__(self, record_map, devices=None):
+        self.record_map = record_map
+        # one (dev_type, key, devices) tuple for each entry of record_map
+        self.entries = []
+        # the (device, variable name) pairs saved by PowerFactory and, for each
+        # key and variable name, the slice of requests (and of the columns
+        # that contain them) where its devices are
+        self.requests = []
+        self.slots = {}
+        for dev_type,rec in record_map.items():
+            key = rec['devs_name'] if 'devs_name' in rec else dev_type
+            candidates = _get_objects('*.' + dev_type) if devices is None else devices[dev_type]
+            matching = [dev for dev in candidates if RecordPlan.matches(rec['names'], dev.loc_name)]
+            self.entries.append((dev_type, key, matching))
+            self.slots[key] = {}
+            for var_name in rec['vars']:
+                self.slots[key][var_name] = slice(len(self.requests), len(self.requests) + len(matching))
+                self.requests += [(dev, var_name) for dev in matching]
+        self.device_names = {key: [dev.loc_name for dev in devices] for _,key,devices in self.entries}
+        # the indices of the columns of the ElmRes object, looked up the first
+        # time the data are read, and the name and number of columns of the
+        # ElmRes object they refer to
+        self.columns = None
+        self.layout = None
+
+    @staticmethod
+    def matches(names, loc_name):
+        if isinstance(names, str):
+            return names == '*' or re.match(names, loc_name) is not None
+        return loc_name in names
+
+    def find_columns(self, res):
+        # the indices are reused only for the same ElmRes object with the same
+        # number of columns, i.e., if no variable has been added or removed,
+        # and if the first and last columns have not moved: the variables are
+        # always added in the same order, and the whole look-up is what takes time
+        layout = res.GetFullName(), res.GetNumberOfColumns()
+        if self.columns is not None and layout != self.layout:
+            self.columns = None
+        if self.columns is not None and len(self.requests) > 0:
+            for i in 0,-1:
+                if res.FindColumn(*self.requests[i]) != self.columns[i]:
+                    self.columns = None
+                    break
+        if self.columns is None:
+            self.columns = find_simulation_columns(res, self.requests)
+            self.layout = layout
+        return self.columns
+
+
+def _record_plan(record_map):
+    return record_map if isinstance(record_map, RecordPlan) else RecordPlan(record_map)
+
+
 def _set_vars_to_save(record_map, verbose=False):
     ### tell PowerFactory which variables should be saved to its internal file
     # speed, electrical power, mechanical torque, electrical torque, terminal voltage
+    plan = _record_plan(record_map)
     res = PF_APP.GetFromStudyCase('*.ElmRes')
-    device_names = {}
     if verbose: print('Adding the following quantities to the list of variables to be saved:')
-    for dev_type in record_map:
-        devices = _get_objects('*.' + dev_type)
-        try:
-            key = record_map[dev_type]['devs_name']
-        except:
-            key = dev_type
-        device_names[key] = []
+    for dev_type,key,devices in plan.entries:
         for dev in devices:
-            if (isinstance(record_map[dev_type]['names'], str) and \
-                (record_map[dev_type]['names'] == '*' or \
-                 re.match(record_map[dev_type]['names'], dev.loc_name) is not None)) or \
-                dev.loc_name in record_map[dev_type]['names']:
-                if verbose: sys.stdout.write(f'{dev.loc_name}:')
-                for var_name in record_map[dev_type]['vars']:
-                    res.AddVariable(dev, var_name)
-                    if verbose: sys.stdout.write(f' {var_name}')
-                device_names[key].append(dev.loc_name)
-                if verbose: sys.stdout.write('\n')
-    return res, device_names
+            if verbose: sys.stdout.write(f'{dev.loc_name}:')
+            for var_name in plan.record_map[dev_type]['vars']:
+                res.AddVariable(dev, var_name)
+                if verbose: sys.stdout.write(f' {var_name}')
+            if verbose: sys.stdout.write('\n')
+    return res, {key: names.copy() for key,names in plan.device_names.items()}
 
 
 def _get_attributes(record_map, verbose=False):
+    plan = _record_plan(record_map)
     device_names = {}
     attributes = {}
     ref_SMs = []
     if verbose: print('Getting the following attributes:')
-    for dev_type in record_map:
-        devices = _get_objects('*.' + dev_type)
-        try:
-            key = record_map[dev_type]['devs_name']
-        except:
-            key = dev_type
+    for dev_type,key,devices in plan.entries:
         device_names[key] = []
         attributes[key] = {}
-        names = record_map[dev_type]['names']
         for dev in devices:
-            if (isinstance(names,str) and \
-                (names == '*' or re.match(names, dev.loc_name) is not None)) or \
-               (isinstance(names,list) and dev.loc_name in names):
-                if verbose: sys.stdout.write(f'{dev.loc_name}:')
-                if 'attrs' in record_map[dev_type]:
-                    for attr_name in record_map[dev_type]['attrs']:
-                        if attr_name not in attributes[key]:
-                            attributes[key][attr_name] = []
-                        if '.' in attr_name:
-                            obj = dev
-                            for subattr in attr_name.split('.'):
-                                obj = obj.GetAttribute(subattr)
-                            attributes[key][attr_name].append(obj)
-                        else:
-                            attributes[key][attr_name].append(dev.GetAttribute(attr_name))
-                        if verbose: sys.stdout.write(f' {attr_name}')
-                device_names[key].append(dev.loc_name)
-                if dev_type == 'ElmSym' and dev.ip_ctrl:
-                    ref_SMs.append(dev.loc_name)
-                if verbose: sys.stdout.write('\n')
+            if verbose: sys.stdout.write(f'{dev.loc_name}:')
+            if 'attrs' in plan.record_map[dev_type]:
+                for attr_name in plan.record_map[dev_type]['attrs']:
+                    if attr_name not in attributes[key]:
+                        attributes[key][attr_name] = []
+                    if '.' in attr_name:
+                        obj = dev
+                        for subattr in attr_name.split('.'):
+                            obj = obj.GetAttribute(subattr)
+                        attributes[key][attr_name].append(obj)
+                    else:
+                        attributes[key][attr_name].append(dev.GetAttribute(attr_name))
+                    if verbose: sys.stdout.write(f' {attr_name}')
+            device_names[key].append(dev.loc_name)
+            if dev_type == 'ElmSym' and dev.ip_ctrl:
+                ref_SMs.append(dev.loc_name)
+            if verbose: sys.stdout.write('\n')
     return attributes, device_names, ref_SMs
 
 
-def _get_data(res, record_map, data_obj, interval=(0,None), dt=None, verbose=False):
+def _get_data(res, record_map, data_obj, interval=(0,None), dt=None, verbose=False, export_file=None):
     # data_obj is a PowerFactor DataObject used to create an IntVec object
     # where the column data will be stored. If it is None, the (much slower)
     # GetValue function will be used, which gets one value at a time from the
-    # ElmRes object
+    # ElmRes object. If export_file is not None, PowerFactory exports all the
+    # results to that (CSV) file in one call, which is then parsed and removed.
+    # record_map can be a RecordPlan, which should be used when the data are
+    # read more than once, since the columns are then looked up only once
+    plan = _record_plan(record_map)
     if verbose:
         sys.stdout.write('Loading data from PF internal file... ')
         sys.stdout.flush()
-    vec = data_obj.CreateObject('IntVec') if data_obj is not None else None
+    vec = data_obj.CreateObject('IntVec') if data_obj is not None and export_file is None else None
     t0 = TIME()
     res.Flush()
-    res.Load()
+    if export_file is not None:
+        export_simulation_data(PF_APP, res, export_file)
+        time,data = _read_exported_data(plan, export_file, interval, dt)
+        os.remove(export_file)
+    else:
+        res.Load()
     t1 = TIME()
     if verbose:
-        sys.stdout.write(f'in memory in {t1-t0:.0f} sec... ')
+        sys.stdout.write(f'{"exported and parsed" if export_file is not None else "in memory"} in {t1-t0:.0f} sec... ')
         sys.stdout.flush()
-    time = get_simulation_time(res, vec, interval, dt)
+    # all the columns are looked up first and then read in a single pass
+    requests = plan.requests
+    columns = plan.find_columns(res) if export_file is None else None
     t2 = TIME()
     if verbose:
-        sys.stdout.write(f'read time in {t2-t1:.0f} sec... ')
+        sys.stdout.write(f'found {len(requests)} columns in {t2-t1:.0f} sec... ')
         sys.stdout.flush()
-    data = {}
-    for dev_type in record_map:
-        devices = _get_objects('*.' + dev_type)
-        if isinstance(record_map[dev_type]['names'], list):
-            devices = [dev for dev in devices if dev.loc_name in record_map[dev_type]['names']]
-        elif isinstance(record_map[dev_type]['names'], str) and \
-            record_map[dev_type]['names'] != '*' and '*' in  record_map[dev_type]['names']:
-            devices = [dev for dev in devices if re.match(record_map[dev_type]['names'], dev.loc_name) is not None]
-        try:
-            key = record_map[dev_type]['devs_name']
-        except:
-            key = dev_type
-        data[key] = {}
-        for var_name in record_map[dev_type]['vars']:
-            data[key][var_name] = get_simulation_variables(res, var_name, vec,
-                                                           interval, dt, app=PF_APP,
-                                                           elements=devices)
-    res.Release()
+    if export_file is None:
+        time,data = _arrange_data(plan, extract_simulation_data(res, requests, vec, interval, dt,
+                                                                columns=columns))
+        res.Release()
     t3 = TIME()
     if vec is not None:
         vec.Delete()
     if verbose:
         sys.stdout.write(f'read vars in {t3-t2:.0f} sec (total: {t3-t0:.0f} sec).\n')
-    return np.array(time), data
+    return time, data
+
+
+def _arrange_data(plan, res_data):
+    # the (time, data) layout returned by _get_data: data[key][var_name] has
+    # the values of var_name for the devices of key, in the order of
+    # plan.device_names[key] (squeezed if there is only one device)
+    data = {key: {var_name: np.squeeze(res_data.values[:,idx]) for var_name,idx in var_slices.items()}
+            for key,var_slices in plan.slots.items()}
+    return np.array(res_data.time), data
+
+
+def _read_exported_data(plan, export_file, interval=(0,None), dt=None):
+    # parses the results that ComRes exported to export_file (see
+    # pfcommon.export_simulation_data) into the layout of _get_data
+    exported = read_exported_simulation_data(export_file, interval=interval, dt=dt)
+    return _arrange_data(plan, exported.select([(dev.loc_name, var_name) for dev,var_name in plan.requests]))
 
 
 def _get_seed(config):
@@ -438,6 +560,54 @@ def _get_random_state(config):
     return rs,seed
 
 
+def _load_correlation(corr_config, loads):
+    # the correlation matrix of the fluctuations of the loads, either given
+    # explicitly (in the order of corr_config['loads'], if present, otherwise
+    # in that of loads) or computed with a spatial kernel from the coordinates
+    # of the loads (by default the GPS coordinates of their terminals)
+    names = [load.loc_name for load in loads]
+    if 'matrix' in corr_config:
+        corr = np.array(corr_config['matrix'], dtype=float)
+        if 'loads' in corr_config:
+            try:
+                idx = [corr_config['loads'].index(name) for name in names]
+            except ValueError as e:
+                raise Exception(f'Missing load in the correlation matrix: {e}')
+            corr = corr[np.ix_(idx, idx)]
+    else:
+        if 'coords' in corr_config:
+            coords = [corr_config['coords'][name] for name in names]
+        else:
+            coords = [[load.bus1.cterm.GPSlat, load.bus1.cterm.GPSlon] for load in loads]
+        corr = spatial_correlation(coords, corr_config['length_scale'],
+                                   corr_config['kernel'] if 'kernel' in corr_config else 'exponential')
+    if corr.shape != (len(loads), len(loads)):
+        raise Exception(f'The correlation matrix must be {len(loads)}x{len(loads)}')
+    return corr
+
+
+def _correlated_load_chunks(seeds, dt, P, Q, n_samples, tau, corr):
+    # yields lists with one (n,3) block of time, P and Q per load: the P of
+    # the loads are correlated according to corr, and so are their Q, while
+    # P and Q are independent. The P and Q of each load have their own
+    # streams spawned from the seed of the load, i.e., the same seed that
+    # the load would use if the loads were independent
+    n_loads = len(P)
+    from scipy.linalg import block_diag
+    streams = [spawn_random_states(sd, 2) for sd in seeds]
+    streams = [PQ[0] for PQ in streams] + [PQ[1] for PQ in streams]
+    mean = [p[0] for p in P] + [q[0] for q in Q]
+    stddev = [p[1] for p in P] + [q[1] for q in Q]
+    taus = [tau[0]] * n_loads + [tau[1]] * n_loads
+    start = 0
+    for PQ in OU_chunks(dt, mean, stddev, taus, n_samples, random_state=streams,
+                        corr=block_diag(corr, corr)):
+        n = PQ.shape[0]
+        t = dt * np.arange(start, start + n)
+        start += n
+        yield [np.column_stack((t, PQ[:,i], PQ[:,n_loads+i])) for i in range(n_loads)]
+
+
 def _print_network_info():
     ### Get some info over the network
     generators = _get_objects('*.ElmSym')
@@ -502,16 +672,19 @@ class TimeVaryingLoad(object):
 
     @classmethod
     def _write(cls, filename, tPQ, verbose=False):
+        # tPQ is either an (N,3) array or an iterable of such arrays
         if verbose:
             sys.stdout.write(f'Writing load values to `{filename}`... ')
             sys.stdout.flush()
-        with open(filename, 'w') as fid:
-            fid.write('2\n')
-            for row in tPQ:
-                fid.write(f'{row[0]:.6f}\t{row[1]:.2f}\t{row[2]:.2f}\n')
+        write_measurement_file(filename, tPQ)
         if verbose:
             sys.stdout.write('done.\n')
 
+    def set_file(self, filepath):
+        # the measurement file reads the load values from filepath
+        self.meas_filepath = filepath
+        self.meas_file.f_name = filepath
+
     def write_to_file(self, dt, P, Q, verbose=False):
         n_samples = P.size
         tPQ = np.zeros((n_samples, 3))
@@ -520,6 +693,22 @@ class TimeVaryingLoad(object):
         tPQ[:,2] = Q
         TimeVaryingLoad._write(self.meas_filepath, tPQ, verbose)
 
+    @staticmethod
+    def _tPQ_chunks(dt, PQ_chunks):
+        # PQ_chunks yields (n,2) arrays of P and Q: only one of them
+        # is in memory at any time
+        start = 0
+        for PQ in PQ_chunks:
+            n = PQ.shape[0]
+            tPQ = np.zeros((n, 3))
+            tPQ[:,0] = dt * np.arange(start, start + n)
+            tPQ[:,1:] = PQ
+            start += n
+            yield tPQ
+
+    def write_chunks_to_file(self, dt, PQ_chunks, verbose=False):
+        TimeVaryingLoad._write(self.meas_filepath, TimeVaryingLoad._tPQ_chunks(dt, PQ_chunks), verbose)
+
     def clean(self, verbose=False):
         if verbose: print(f'Deleting measurement file `{self.meas_file.loc_name}`...')
         self.meas_file.Delete()
@@ -560,13 +749,60 @@ class OULoad(TimeVaryingLoad):
         else:
             self.rs = None
 
-    def write_to_file(self, dt, P, Q, n_samples, tau, verbose=False):
+    def samples(self, dt, P, Q, n_samples, tau):
+        # returns a generator of the (n,3) blocks of time, P and Q that
+        # write_to_file saves, e.g., to pass them to write_measurement_files
         if np.isscalar(tau):
             tau = [tau, tau]
-        super().write_to_file(dt,
-                              OU(dt, P[0], P[1], tau[0], n_samples, random_state=self.rs),
-                              OU(dt, Q[0], Q[1], tau[1], n_samples, random_state=self.rs),
-                              verbose)
+        # P and Q are drawn one after the other from self.rs with the recursion
+        # of OU, so that a given seed gives exactly the same load file as in
+        # previous runs, one chunk at a time
+        PQ_chunks = OU_chunks(dt, [P[0], Q[0]], [P[1], Q[1]], tau, n_samples,
+                              random_state=self.rs, exact=True)
+        return TimeVaryingLoad._tPQ_chunks(dt, PQ_chunks)
+
+    def cache_key(self, dt, P, Q, n_samples, tau):
+        # the hash of all the parameters that determine the samples: None
+        # if these are not reproducible
+        if self.seed is None:
+            return None
+        if np.isscalar(tau):
+            tau = [tau, tau]
+        return content_hash('OULoad', self.load.loc_name, [float(x) for x in P],
+                            [float(x) for x in Q], int(self.seed), float(dt),
+                            int(n_samples), [float(x) for x in tau])
+
+    def write_to_file(self, dt, P, Q, n_samples, tau, verbose=False):
+        TimeVaryingLoad._write(self.meas_filepath, self.samples(dt, P, Q, n_samples, tau), verbose)
+
+class ProfileLoad(TimeVaryingLoad):
+    def __init__(self, load, app, grid, library_name, user_models_name, frame_name, profile,
+                 outdir='.', scale=None, offset=0.):
+        # profile is a pfcommon.LoadProfile, which is scaled to the nominal
+        # powers of the load if scale is 'pu' or 'mean'
+        super().__init__(load, app, grid, library_name, user_models_name, frame_name, outdir)
+        if scale is not None:
+            profile = profile.scaled(load.plini, load.qlini, scale)
+        self.profile = profile
+        self.offset = offset
+
+    def samples(self, dt, n_samples):
+        # the first sample of the profile (plus offset) is at time 0 of the simulation
+        def PQ_chunks():
+            for PQ in self.profile.chunks(self.profile.t[0] + self.offset, dt, n_samples):
+                if not self.profile.has_Q:
+                    PQ[:,1] = self.load.qlini
+                yield PQ
+        return TimeVaryingLoad._tPQ_chunks(dt, PQ_chunks())
+
+    def cache_key(self, dt, n_samples):
+        Q = self.profile.Q if self.profile.has_Q else float(self.load.qlini)
+        return content_hash('ProfileLoad', self.load.loc_name, self.profile.t, self.profile.P,
+                            Q, self.profile.kind, self.profile.left, float(self.offset),
+                            float(dt), int(n_samples))
+
+    def write_to_file(self, dt, n_samples, verbose=False):
+        TimeVaryingLoad._write(self.meas_filepath, self.samples(dt, n_samples), verbose)
 
 
 ############################################################
@@ -578,7 +814,9 @@ def run_tran():
     
     def usage(exit_code=None):
         print(f'usage: {progname} tran [-f | --force] [-o | --outfile <filename>]')
-        print( '       ' + ' ' * len(progname) + '      [-v | --verbose <level>] [-m | --email] config_file')
+        print( '       ' + ' ' * len(progname) + '      [-v | --verbose <level>] [-m | --email]')
+        print( '       ' + ' ' * len(progname) + '      [--no-cache] [--cache-size <MB>]')
+        print( '       ' + ' ' * len(progname) + '      [-s | --segment <duration>] config_file')
         if exit_code is not None:
             sys.exit(exit_code)
             
@@ -586,6 +824,9 @@ def run_tran():
     outfile = None
     verbosity_level = 1
     send_email = False
+    use_cache = True
+    cache_size = LOAD_CACHE_SIZE
+    segment = None
 
     i = 2
     n_args = len(sys.argv)
@@ -603,6 +844,14 @@ def run_tran():
             verbosity_level = int(sys.argv[i])
         elif arg in ('-m', '--email'):
             send_email = True
+        elif arg == '--no-cache':
+            use_cache = False
+        elif arg == '--cache-size':
+            i += 1
+            cache_size = int(float(sys.argv[i]) * 2**20)
+        elif arg in ('-s', '--segment'):
+            i += 1
+            segment = float(sys.argv[i])
         elif arg[0] == '-':
             print(f'{progname}: unknown option `{arg}`')
             sys.exit(1)
@@ -625,6 +874,12 @@ def run_tran():
     config = json.load(open(config_file, 'r'))
     if 'coiref' not in config:
         config['coiref'] = 'element'
+    # the duration of the windows of a segmented simulation can also be in the configuration
+    if segment is None and 'segment' in config:
+        segment = config['segment']
+    if segment is not None and segment <= 0:
+        print(f'{progname}: the duration of the segments must be > 0.')
+        sys.exit(1)
 
     project_name = config['project_name']
     
@@ -683,26 +938,92 @@ def run_tran():
             for i,load in enumerate(loads):
                 print('[{:3d}] {:30s} {:10.3f} {:10.3f}'.format(i+1, load.loc_name, load.plini, load.qlini))
 
-    seeds = rs.randint(0, 1000000, size=n_loads)
-    stoch_loads = [OULoad(ld, PF_APP, grid, config['library_name'],
-                          config['user_models_name'], config['frame_name'],
-                          outdir='stoch_loads', seed=sd)
-                   for ld,sd in zip(loads,seeds)]
+    if 'profile' in config:
+        # all the loads replay the same measured profile, usually scaled to their nominal powers
+        profile_config = config['profile']
+        profile = read_load_profile(profile_config['file'],
+                                    profile_config['dataset'] if 'dataset' in profile_config else '/profile',
+                                    profile_config['kind'] if 'kind' in profile_config else 'linear')
+        stoch_loads = [ProfileLoad(ld, PF_APP, grid, config['library_name'],
+                                   config['user_models_name'], config['frame_name'], profile,
+                                   outdir='stoch_loads',
+                                   scale=profile_config['scale'] if 'scale' in profile_config else 'mean',
+                                   offset=profile_config['offset'] if 'offset' in profile_config else 0.)
+                       for ld in loads]
+        seeds = None
+    else:
+        # one seed per load, drawn from the global seed: the loads use it
+        # both when they are independent and when they are correlated
+        seeds = rs.randint(0, 1000000, size=n_loads)
+        stoch_loads = [OULoad(ld, PF_APP, grid, config['library_name'],
+                              config['user_models_name'], config['frame_name'],
+                              outdir='stoch_loads', seed=sd)
+                       for ld,sd in zip(loads,seeds)]
 
     dt = config['dt']
     tstop = config['tstop']
     n_samples = int(np.ceil(tstop / dt)) + 1
-    tau = [config['tau']['P'], config['tau']['Q']]
-    for i,(load,stoch_load) in enumerate(zip(loads, stoch_loads)):
-        P = load.plini, np.abs(load.plini)*config['sigma']['P']
-        Q = load.qlini, np.abs(load.qlini)*config['sigma']['Q']
-        msg = 'Writing load file {:d}/{:d}...'.format(i+1, n_loads)
-        sys.stdout.write(msg)
+    if 'profile' not in config:
+        tau = [config['tau']['P'], config['tau']['Q']]
+    cache = DiskCache(LOAD_CACHE_DIR, cache_size) if use_cache else None
+    correlated = 'correlation' in config and 'profile' not in config
+    # each load has its own random state, so the files can be written
+    # concurrently, unless the loads are correlated
+    files,keys = [],[]
+    if correlated:
+        corr = _load_correlation(config['correlation'], loads)
+        P = [(load.plini, np.abs(load.plini)*config['sigma']['P']) for load in loads]
+        Q = [(load.qlini, np.abs(load.qlini)*config['sigma']['Q']) for load in loads]
+        if cache is not None:
+            # the files of all the loads are generated together
+            group_key = content_hash('correlated OULoad', [load.loc_name for load in loads],
+                                     P, Q, [int(sd) for sd in seeds], float(dt), int(n_samples), tau, corr)
+            for load,stoch_load in zip(loads, stoch_loads):
+                key = content_hash(group_key, load.loc_name)
+                stoch_load.set_file(cache.path(key, '.dat'))
+                keys.append(key)
+            if all(cache.touch(key, '.dat') for key in keys):
+                keys = []
+        if cache is None or len(keys) > 0:
+            files = [cache.tmp_path(key, '.dat') for key in keys] if cache is not None else \
+                [stoch_load.meas_filepath for stoch_load in stoch_loads]
+    else:
+        for load,stoch_load in zip(loads, stoch_loads):
+            if 'profile' in config:
+                args = dt, n_samples
+            else:
+                P = load.plini, np.abs(load.plini)*config['sigma']['P']
+                Q = load.qlini, np.abs(load.qlini)*config['sigma']['Q']
+                args = dt, P, Q, n_samples, tau
+            key = stoch_load.cache_key(*args) if cache is not None else None
+            if key is not None:
+                # the measurement file points to the cached file, which is
+                # written only if it is not there already
+                stoch_load.set_file(cache.path(key, '.dat'))
+                if cache.touch(key, '.dat'):
+                    continue
+                filepath = cache.tmp_path(key, '.dat')
+            else:
+                filepath = stoch_load.meas_filepath
+            files.append((filepath, stoch_load.samples(*args)))
+            keys.append(key)
+    if verbosity_level > 0 and len(files) < n_loads:
+        print(f'{n_loads - len(files)} of {n_loads} load files found in {LOAD_CACHE_DIR}.')
+    if len(files) > 0:
+        sys.stdout.write(f'Writing {len(files)} load files... ')
         sys.stdout.flush()
-        stoch_load.write_to_file(dt, P, Q, n_samples, tau, verbosity_level>2)
-        if i < n_loads-1:
-            sys.stdout.write('\b' * len(msg))
-    sys.stdout.write('\n')
+        if correlated:
+            write_joint_measurement_files(files, _correlated_load_chunks(seeds, dt, P, Q, n_samples, tau, corr))
+        else:
+            write_measurement_files(files)
+        sys.stdout.write('done.\n')
+    if cache is not None:
+        for key in keys:
+            if key is not None:
+                cache.commit(key, '.dat')
+        # the files used by this simulation are not removed, even if they
+        # alone exceed the size of the cache
+        cache.prune(keep=[stoch_load.meas_filepath for stoch_load in stoch_loads])
     
     PF1, PF2 = _apply_configuration(config, verbosity_level)
 
@@ -724,15 +1045,20 @@ def run_tran():
         
     try:
         inc = _IC(dt, coiref=config['coiref'], verbose=verbosity_level>1)
-        res, _ = _set_vars_to_save(config['record'], verbosity_level>1)
-        sim,dur,err = _tran(tstop, verbosity_level>1)
-
-        interval = (0, None)
-        time,data = _get_data(res, config['record'], project, interval, dt, verbosity_level>1)
-        attributes, device_names, ref_SMs = _get_attributes(config['record'], verbosity_level>2)
+        # the devices to record are looked up once for all the phases below
+        record_plan = RecordPlan(config['record'])
+        res, _ = _set_vars_to_save(record_plan, verbosity_level>1)
+        if segment is None:
+            sim,dur,err = _tran(tstop, verbosity_level>1)
+            interval = (0, None)
+            # with 'export_results', the results are exported by PowerFactory to a
+            # CSV file and parsed, instead of being read one column at a time
+            export_file = os.path.splitext(os.path.abspath(outfile))[0] + '_res.csv' \
+                if 'export_results' in config and config['export_results'] else None
+            time,data = _get_data(res, record_plan, project, interval, dt, verbosity_level>1, export_file)
+        attributes, device_names, ref_SMs = _get_attributes(record_plan, verbosity_level>2)
         blob = {'config': config,
                 'seed': seed,
-                'OU_seeds': seeds,
                 'inertia': Htot,
                 'energy': Etot,
                 'momentum': Mtot,
@@ -741,15 +1067,28 @@ def run_tran():
                 'Psm': Psm, 'Qsm': Qsm,
                 'Psg': Psg, 'Qsg': Qsg,
                 'Pload': Pload, 'Qload': Qload,
-                'PF_with_slack': PF1,
-                'PF_without_slack': PF2,
-                'time': np.array(time, dtype=object),
-                'data': data,
+                **PF1.to_arrays('PF_with_slack'),
+                **PF2.to_arrays('PF_without_slack'),
                 'attributes': attributes,
                 'device_names': device_names,
                 'ref_SMs': ref_SMs}
-    
-        np.savez_compressed(outfile, **blob)
+        if seeds is not None:
+            # the seeds of the OU processes of the loads, drawn from seed
+            blob['OU_seeds'] = seeds
+        if segment is None:
+            blob['time'] = np.array(time, dtype=object)
+            blob['data'] = data
+            np.savez_compressed(outfile, **blob)
+        else:
+            # time and data are in an HDF5 file next to the output file, which
+            # is saved before the simulation starts, so that a partial run is usable
+            blob['data_file'] = os.path.splitext(os.path.abspath(outfile))[0] + '.h5'
+            np.savez_compressed(outfile, **blob)
+            sim,dur,err = _tran_segmented(res, record_plan, project, tstop, segment, dt,
+                                          blob['data_file'], verbosity_level>1)
+            if err:
+                raise Exception('Simulation error: the data of the completed segments ' +
+                                f'are in {blob["data_file"]}')
 
     except Exception as inst:
         print('Failed to run transient simulation:')
@@ -929,8 +1268,8 @@ def run_AC_analysis():
                 'Psm': Psm, 'Qsm': Qsm,
                 'Psg': Psg, 'Qsg': Qsg,
                 'Pload': Pload, 'Qload': Qload,
-                'PF_with_slack': PF1,
-                'PF_without_slack': PF2,
+                **PF1.to_arrays('PF_with_slack'),
+                **PF2.to_arrays('PF_without_slack'),
                 'J': J, 'vars_idx': vars_idx,
                 'state_vars': state_vars, 'voltages': voltages,
                 'currents': currents, 'signals': signals,
@@ -1052,6 +1391,9 @@ def run_AC_tran_analysis():
     P = (load.plini, config['dP'] * load.plini)
     Q = (load.qlini, 0.0)
     time,data = [], []
+    # the devices to record and their columns in the results are the same at
+    # all frequencies
+    record_plan = RecordPlan(config['record'])
     for f in iter_fun(F):
         if verbosity_level > 1: print(f'Running simulation with F = {f:g} Hz.')
         T = 1/f
@@ -1062,17 +1404,17 @@ def run_AC_tran_analysis():
         try:
             inc = _IC(dt, verbosity_level>1)
             sim,dur,err = _tran(ttran, verbosity_level>1)
-            res, _ = _set_vars_to_save(config['record'], verbosity_level>2)
+            res, _ = _set_vars_to_save(record_plan, verbosity_level>2)
             sim,dur,err = _tran(tstop, verbosity_level>1)
             interval = (0, None) if config['save_transient'] else (ttran, None)
-            t,d = _get_data(res, config['record'], project, interval, dt, verbosity_level>1)
+            t,d = _get_data(res, record_plan, project, interval, dt, verbosity_level>1)
             time.append(t)
             data.append(d)
         except:
             print('Cannot run simulation')
 
     if len(time) > 0:
-        attributes, device_names, ref_SMs = _get_attributes(config['record'], verbosity_level>2)
+        attributes, device_names, ref_SMs = _get_attributes(record_plan, verbosity_level>2)
         blob = {'config': config,
                 'inertia': Htot,
                 'energy': Etot,
@@ -1082,8 +1424,8 @@ def run_AC_tran_analysis():
                 'Psm': Psm, 'Qsm': Qsm,
                 'Psg': Psg, 'Qsg': Qsg,
                 'Pload': Pload, 'Qload': Qload,
-                'PF_with_slack': PF1,
-                'PF_without_slack': PF2,
+                **PF1.to_arrays('PF_with_slack'),
+                **PF2.to_arrays('PF_without_slack'),
                 'F': F,
                 'time': np.array(time, dtype=object),
                 'data': data,
@@ -1186,7 +1528,8 @@ def run_load_step_sim():
     load_event.dQ = config['dQ'] * 100
     
     inc = _IC(config['dt'], verbosity_level>1)
-    res,_ = _set_vars_to_save(config['record'], verbosity_level>2)
+    record_plan = RecordPlan(config['record'])
+    res,_ = _set_vars_to_save(record_plan, verbosity_level>2)
     sim,dur,err = _tran(config['tstop'], verbosity_level>1)
     # setting the load as out of service because for some reason the following
     # call to .Delete doesn't remove the object from the simulation events
@@ -1197,8 +1540,8 @@ def run_load_step_sim():
         print('Cannot run transient simulation.')
         sys.exit(1)
 
-    attributes,device_names, ref_SMs = _get_attributes(config['record'], verbosity_level>2)
-    time,data = _get_data(res, config['record'], project, verbosity_level>1)
+    attributes,device_names, ref_SMs = _get_attributes(record_plan, verbosity_level>2)
+    time,data = _get_data(res, record_plan, project, verbose=verbosity_level>1)
 
     blob = {'config': config,
             'time': np.array(time, dtype=object),
@@ -6,9 +6,9 @@ from time import time as TIME
 import numpy as np
 from numpy.random import RandomState, SeedSequence, MT19937
 
-from pfcommon import OU, get_simulation_time, get_simulation_variables, \
-    run_power_flow, parse_sparse_matrix_file, parse_Amat_vars_file, \
-        parse_Jacobian_vars_file
+from pfcommon import OU_chunks, extract_simulation_data, export_simulation_data, \
+    read_exported_simulation_data, write_measurement_file, run_power_flow, parse_sparse_matrix_file, \
+        parse_Amat_vars_file, parse_Jacobian_vars_file
 
 
 __all__ = ['compute_fourier_coeffs']
@@ -320,10 +320,9 @@ def _set_vars_to_save(record_map, verbose=False):
             key = dev_type
         device_names[key] = []
         for dev in devices:
-            if (isinstance(record_map[dev_type]['names'], str) and \
-                (record_map[dev_type]['names'] == '*' or \
-                 re.match(record_map[dev_type]['names'], dev.loc_name) is not None)) or \
-                dev.loc_name in record_map[dev_type]['names']:
+            names = record_map[dev_type]['names']
+            if (isinstance(names, str) and (names == '*' or re.match(names, dev.loc_name) is not None)) or \
+               (isinstance(names, list) and dev.loc_name in names):
                 if verbose: sys.stdout.write(f'{dev.loc_name}:')
                 for var_name in record_map[dev_type]['vars']:
                     res.AddVariable(dev, var_name)
@@ -371,45 +370,57 @@ def _get_attributes(record_map, verbose=False):
     return attributes, device_names, ref_SMs
 
 
-def _get_data(res, record_map, data_obj, interval=(0,None), dt=None, verbose=False):
+def _get_data(res, record_map, data_obj, interval=(0,None), dt=None, verbose=False, export_file=None):
     # data_obj is a PowerFactor DataObject used to create an IntVec object
     # where the column data will be stored. If it is None, the (much slower)
     # GetValue function will be used, which gets one value at a time from the
-    # ElmRes object
+    # ElmRes object. If export_file is not None, PowerFactory exports all the
+    # results to that (CSV) file in one call, which is then parsed and removed
     if verbose:
         sys.stdout.write('Loading data from PF internal file... ')
         sys.stdout.flush()
-    vec = data_obj.CreateObject('IntVec') if data_obj is not None else None
+    vec = data_obj.CreateObject('IntVec') if data_obj is not None and export_file is None else None
     t0 = TIME()
     res.Flush()
-    res.Load()
+    if export_file is not None:
+        export_simulation_data(PF_APP, res, export_file)
+        exported = read_exported_simulation_data(export_file, interval=interval, dt=dt)
+        os.remove(export_file)
+    else:
+        res.Load()
     t1 = TIME()
     if verbose:
-        sys.stdout.write(f'in memory in {t1-t0:.0f} sec... ')
-        sys.stdout.flush()
-    time = get_simulation_time(res, vec, interval, dt)
-    t2 = TIME()
-    if verbose:
-        sys.stdout.write(f'read time in {t2-t1:.0f} sec... ')
+        sys.stdout.write(f'{"exported and parsed" if export_file is not None else "in memory"} in {t1-t0:.0f} sec... ')
         sys.stdout.flush()
-    data = {}
+    # all the columns are looked up first and then read in a single pass
+    requests,slices = [],{}
     for dev_type in record_map:
-        devices = _get_objects('*.' + dev_type)
-        if isinstance(record_map[dev_type]['names'], list):
-            devices = [dev for dev in devices if dev.loc_name in record_map[dev_type]['names']]
-        elif isinstance(record_map[dev_type]['names'], str) and \
-            record_map[dev_type]['names'] != '*' and '*' in  record_map[dev_type]['names']:
-            devices = [dev for dev in devices if re.match(record_map[dev_type]['names'], dev.loc_name) is not None]
+        # the names are matched as in _set_vars_to_save and _get_attributes
+        names = record_map[dev_type]['names']
+        devices = [dev for dev in _get_objects('*.' + dev_type) if \
+                   (isinstance(names, str) and (names == '*' or re.match(names, dev.loc_name) is not None)) or \
+                   (isinstance(names, list) and dev.loc_name in names)]
         try:
             key = record_map[dev_type]['devs_name']
         except:
             key = dev_type
-        data[key] = {}
+        slices[key] = {}
         for var_name in record_map[dev_type]['vars']:
-            data[key][var_name] = get_simulation_variables(res, var_name, vec,
-                                                           interval, dt, app=PF_APP,
-                                                           elements=devices)
-    res.Release()
+            slices[key][var_name] = slice(len(requests), len(requests) + len(devices))
+            requests += [(dev, var_name) for dev in devices]
+    t2 = TIME()
+    if verbose:
+        sys.stdout.write(f'found {len(requests)} columns in {t2-t1:.0f} sec... ')
+        sys.stdout.flush()
+    if export_file is not None:
+        res_data = exported.select([(dev.loc_name, var_name) for dev,var_name in requests])
+    else:
+        res_data = extract_simulation_data(res, requests, vec, interval, dt)
+    time = res_data.time
+    data = {key: {var_name: np.squeeze(res_data.values[:,idx]) for var_name,idx in var_slices.items()}
+            for key,var_slices in slices.items()}
+    if export_file is None:
+        res.Release()
     t3 = TIME()
     if vec is not None:
         vec.Delete()
@@ -495,13 +506,11 @@ class TimeVaryingLoad(object):
 
     @classmethod
     def _write(cls, filename, tPQ, verbose=False):
+        # tPQ is either an (N,3) array or an iterable of such arrays
         if verbose:
             sys.stdout.write(f'Writing load values to `{filename}`... ')
             sys.stdout.flush()
-        with open(filename, 'w') as fid:
-            fid.write('2\n')
-            for row in tPQ:
-                fid.write(f'{row[0]:.6f}\t{row[1]:.2f}\t{row[2]:.2f}\n')
+        write_measurement_file(filename, tPQ)
         if verbose:
             sys.stdout.write('done.\n')
 
@@ -513,6 +522,22 @@ class TimeVaryingLoad(object):
         tPQ[:,2] = Q
         TimeVaryingLoad._write(self.meas_filepath, tPQ, verbose)
 
+    @staticmethod
+    def _tPQ_chunks(dt, PQ_chunks):
+        # PQ_chunks yields (n,2) arrays of P and Q: only one of them
+        # is in memory at any time
+        start = 0
+        for PQ in PQ_chunks:
+            n = PQ.shape[0]
+            tPQ = np.zeros((n, 3))
+            tPQ[:,0] = dt * np.arange(start, start + n)
+            tPQ[:,1:] = PQ
+            start += n
+            yield tPQ
+
+    def write_chunks_to_file(self, dt, PQ_chunks, verbose=False):
+        TimeVaryingLoad._write(self.meas_filepath, TimeVaryingLoad._tPQ_chunks(dt, PQ_chunks), verbose)
+
     def clean(self, verbose=False):
         if verbose: print(f'Deleting measurement file `{self.meas_file.loc_name}`...')
         self.meas_file.Delete()
@@ -553,13 +578,20 @@ class OULoad(TimeVaryingLoad):
         else:
             self.rs = None
 
-    def write_to_file(self, dt, P, Q, n_samples, tau, verbose=False):
+    def samples(self, dt, P, Q, n_samples, tau):
+        # returns a generator of the (n,3) blocks of time, P and Q that
+        # write_to_file saves, e.g., to pass them to write_measurement_files
         if np.isscalar(tau):
             tau = [tau, tau]
-        super().write_to_file(dt,
-                              OU(dt, P[0], P[1], tau[0], n_samples, random_state=self.rs),
-                              OU(dt, Q[0], Q[1], tau[1], n_samples, random_state=self.rs),
-                              verbose)
+        # P and Q are drawn one after the other from self.rs with the recursion
+        # of OU, so that a given seed gives exactly the same load file as in
+        # previous runs, one chunk at a time
+        PQ_chunks = OU_chunks(dt, [P[0], Q[0]], [P[1], Q[1]], tau, n_samples,
+                              random_state=self.rs, exact=True)
+        return TimeVaryingLoad._tPQ_chunks(dt, PQ_chunks)
+
+    def write_to_file(self, dt, P, Q, n_samples, tau, verbose=False):
+        TimeVaryingLoad._write(self.meas_filepath, self.samples(dt, P, Q, n_samples, tau), verbose)
 
 ############################################################
 ###                   AC ANALYSIS                        ###
@@ -685,8 +717,8 @@ def run_AC_analysis(config_folder, config_file):
                 'Psm': Psm, 'Qsm': Qsm,
                 'Psg': Psg, 'Qsg': Qsg,
                 'Pload': Pload, 'Qload': Qload,
-                'PF_with_slack': PF1,
-                'PF_without_slack': PF2,
+                **PF1.to_arrays('PF_with_slack'),
+                **PF2.to_arrays('PF_without_slack'),
                 'J': J, 'vars_idx': vars_idx,
                 'state_vars': state_vars, 'voltages': voltages,
                 'currents': currents, 'signals': signals,
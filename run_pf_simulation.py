@@ -15,14 +15,20 @@ if powerfactory_path not in sys.path:
     sys.path.append(powerfactory_path)
 import powerfactory as pf
 
-from pfcommon import sort_objects_by_name, OU_2, BaseParameters, \
+from pfcommon import sort_objects_by_name, OU_2_chunks, BaseParameters, \
     get_simulation_time, get_simulation_variables, correct_traces, \
-    is_voltage, is_current, is_frequency, find_element_by_name
+    is_voltage, is_current, is_frequency, find_element_by_name, write_measurement_file, \
+    content_hash, DiskCache, LoadProfile, read_load_profile
 
 __all__ = ['run_sim']
 
 progname = os.path.basename(sys.argv[0])
 
+# the file of the time-varying load is reused by all runs with the same parameters
+LOAD_CACHE_DIR = os.environ.get('PF_LOAD_CACHE_DIR',
+                                os.path.join(os.path.expanduser('~'), '.cache', 'pf_loads'))
+LOAD_CACHE_SIZE = 2**32
+
 
 def write_trace_to_file(x, fid, path, atom, extendable=True):
     if extendable:
@@ -37,8 +43,10 @@ def write_trace_to_file(x, fid, path, atom, extendable=True):
         fid.create_array(fid.root, path, x, atom=atom)
 
     
-def run_sim(config_file, output_file=None, output_dir='.', output_file_prefix='',
-            output_file_suffix='', append=False, force=False, verbose=False):
+def _run_sim(load_files, config_file, output_file=None, output_dir='.', output_file_prefix='',
+             output_file_suffix='', append=False, force=False, verbose=False, cache=None):
+    # load_files is a list to which the ElmFile object of the time-varying load
+    # and its original file name are appended, for run_sim to restore it
 
     config = json.load(open(config_file, 'r'))
     project_name = config['project_name']
@@ -202,7 +210,17 @@ def run_sim(config_file, output_file=None, output_dir='.', output_file_prefix=''
             net_element = variable_load
             if verbose: print(f'Set {variable_load_name} as time-varying load.')
     
-    variable_load_filename = app.GetCalcRelevantObjects('*.ElmFile')[0].f_name
+    variable_load_file = app.GetCalcRelevantObjects('*.ElmFile')[0]
+    variable_load_filename = original_load_filename = variable_load_file.f_name
+    # a file in the cache is never the file of the project: it means that a
+    # previous run did not restore the original name
+    in_dir = lambda path, d: os.path.normcase(os.path.abspath(path)).startswith(
+        os.path.normcase(os.path.abspath(d)) + os.path.sep)
+    cache_dirs = [LOAD_CACHE_DIR] + ([cache.cache_dir] if cache is not None else [])
+    if any(in_dir(original_load_filename, d) for d in cache_dirs):
+        raise Exception(f'The time-varying load file "{original_load_filename}" is in the cache ' +
+                        'of load files: set the file name of the ElmFile object to its original value')
+    load_files.append((variable_load_file, original_load_filename))
     if verbose: print(f'The time-varying load file is "{variable_load_filename}".')
 
     if 'compensator_name' in config and config['compensator_name'] is not None:
@@ -227,46 +245,107 @@ def run_sim(config_file, output_file=None, output_dir='.', output_file_prefix=''
     decimation = config['decimation'] if 'decimation' in config else 1
     tstop = config['tstop'][-1]    # [s]  total simulation duration
     dt = 1 / srate
-    t = dt + np.r_[0 : tstop + dt/2 : dt]
-    N_samples = t.size
-
-    # a matrix containing time, P and Q of the time-varying load
-    tPQ = np.zeros((N_samples,3))
-
+    # the time vector is dt + np.r_[0 : tstop + dt/2 : dt], which is
+    # generated one chunk at a time together with the load values
+    N_samples = int(np.ceil((tstop + dt/2) / dt))
+    chunk_size = 100000
+
+    # the samples are reproducible, and therefore can be cached, unless the
+    # seed of the OU process is random
+    cacheable = cache is not None
     if 'OU' in config:
         try:
             rng_seed = config['seed']
         except:
+            cacheable = False
             rs = RandomState(MT19937(SeedSequence(int(time_now()))))
             rng_seed = rs.randint(0, 1000000)
         # OU parameters
         alpha = config['OU']['alpha']
         mu = config['OU']['mu']
         c = config['OU']['c']
-        # generate the dynamics of the time-varying load and save it to file
-        var_load = OU_2(dt, alpha, mu, c, N_samples, RandomState(MT19937(SeedSequence(rng_seed))))
     elif 'PWL' in config:
-        var_load = np.zeros(N_samples)
         PWL = np.array(config['PWL'])
-        N_steps = PWL.shape[0]
-        for i in range(N_steps - 1):
-            idx = (t >= PWL[i, 0]) & (t < PWL[i+1, 0])
-            var_load[idx] = PWL[i, 1]
-        idx = t >= PWL[-1, 0]
-        var_load[idx] = PWL[-1, 1]
-    else:
-        var_load = np.zeros(N_samples)
+        # each value holds until the next step, and the signal is zero before the first one
+        PWL_profile = LoadProfile(PWL[:,0], PWL[:,1], kind='previous', left=0.)
+    elif 'profile' in config:
+        # a measured profile of P and, optionally, Q of the load, which replaces
+        # its nominal values: the profile is aligned so that its first sample
+        # (plus offset) is at time 0 of the simulation
+        profile_file = config['profile']['file']
+        profile_offset = config['profile']['offset'] if 'offset' in config['profile'] else 0.
+        profile_scale = config['profile']['scale'] if 'scale' in config['profile'] else None
+        profile = read_load_profile(profile_file,
+                                    config['profile']['dataset'] if 'dataset' in config['profile'] else '/profile',
+                                    config['profile']['kind'] if 'kind' in config['profile'] else 'linear')
+
+    def var_load_chunks():
+        # yields the start index, the time and the deviations of P and Q of the
+        # time-varying load from their nominal values, in consecutive chunks of
+        # samples, so that memory does not depend on tstop
+        if 'OU' in config:
+            # the recursion of OU_2, so that a given seed gives exactly the same
+            # load values as in previous runs
+            var_loads = OU_2_chunks(dt, alpha, mu, c, N_samples, chunk_size,
+                                    RandomState(MT19937(SeedSequence(rng_seed))), exact=True)
+        elif 'profile' in config:
+            prof = profile if profile_scale is None else profile.scaled(P0, Q0, profile_scale)
+        for start in range(0, N_samples, chunk_size):
+            t = dt + np.arange(start, min(start + chunk_size, N_samples)) * dt
+            var_load = np.zeros((t.size, 2))
+            if 'OU' in config:
+                var_load[:,0] = next(var_loads)[:,0]
+            elif 'PWL' in config:
+                var_load[:,0] = PWL_profile(t)[:,0]
+            elif 'profile' in config:
+                PQ = prof(prof.t[0] + profile_offset + t)
+                var_load[:,0] = PQ[:,0] - P0
+                if prof.has_Q:
+                    var_load[:,1] = PQ[:,1] - Q0
+            yield start,t,var_load
 
     P0 = variable_load.plini
     Q0 = variable_load.qlini
-    tPQ[:,0] = t
-    tPQ[:,1] = P0 + var_load
-    tPQ[:,2] = Q0
-
-    with open(variable_load_filename, 'w') as fid:
-        fid.write('2\n\n')
-        for row in tPQ:
-            fid.write(f'{row[0]:.6f}\t{row[1]:.2f}\t{row[2]:.2f}\n\n')
+    save_var_load = 'save_var_load' in config and config['save_var_load']
+    # the decimated dynamics of the time-varying load, if it has to be saved
+    decimated_var_load = []
+
+    def tPQ_chunks():
+        for start,t,var_load in var_load_chunks():
+            # a matrix containing time, P and Q of the time-varying load
+            tPQ = np.zeros((t.size,3))
+            tPQ[:,0] = t
+            tPQ[:,1:] = [P0, Q0] + var_load
+            if save_var_load:
+                decimated_var_load.append(var_load[(-start) % decimation::decimation, 0])
+            yield tPQ
+
+    if cacheable:
+        if 'OU' in config:
+            params = 'OU', int(rng_seed), alpha, mu, c
+        elif 'PWL' in config:
+            params = 'PWL', PWL
+        elif 'profile' in config:
+            params = 'profile', profile.t, profile.P, profile.Q, profile.kind, \
+                profile_scale, float(profile_offset)
+        else:
+            params = 'constant',
+        key = content_hash('run_sim', variable_load_name, float(P0), float(Q0),
+                           float(dt), int(N_samples), params)
+        variable_load_filename = cache.path(key, '.dat')
+        variable_load_file.f_name = variable_load_filename
+        if cache.touch(key, '.dat'):
+            if verbose: print(f'Using the cached time-varying load file "{variable_load_filename}".')
+            if save_var_load:
+                # the samples are generated again only to be saved
+                for start,t,var_load in var_load_chunks():
+                    decimated_var_load.append(var_load[(-start) % decimation::decimation, 0])
+        else:
+            write_measurement_file(cache.tmp_path(key, '.dat'), tPQ_chunks(), blank_lines=True)
+            cache.commit(key, '.dat')
+        cache.prune(keep=[variable_load_filename])
+    else:
+        write_measurement_file(variable_load_filename, tPQ_chunks(), blank_lines=True)
 
     N_variable_loads = 1
 
@@ -299,6 +378,9 @@ def run_sim(config_file, output_file=None, output_dir='.', output_file_prefix=''
             m,n = PWL.shape
             variable_load_bus = int(re.findall('\d+', variable_load.bus1.cterm.loc_name)[0])
             Parameters.__dict__['columns'][f'PWL_bus_{variable_load_bus}'] = tables.Float64Col(shape=(m,n))
+        elif 'profile' in config:
+            Parameters.__dict__['columns']['profile_file'] = tables.StringCol(256)
+            Parameters.__dict__['columns']['profile_offset'] = tables.Float64Col()
 
         tbl = fid.create_table(fid.root, 'parameters', Parameters, 'parameters')
         params = tbl.row
@@ -323,6 +405,9 @@ def run_sim(config_file, output_file=None, output_dir='.', output_file_prefix=''
             params['c']          = [c]
         elif 'PWL' in config:
             params[f'PWL_bus_{variable_load_bus}'] = PWL
+        elif 'profile' in config:
+            params['profile_file']   = profile_file
+            params['profile_offset'] = profile_offset
         params.append()
         tbl.flush()
 
@@ -333,9 +418,9 @@ def run_sim(config_file, output_file=None, output_dir='.', output_file_prefix=''
 
     atom = tables.Float64Atom()
 
-    if 'save_var_load' in config and config['save_var_load']:
+    if save_var_load:
         variable_load_bus = int(variable_load_name.split(' ')[1])
-        write_trace_to_file(var_load[::decimation], fid, f'var_load_bus_{variable_load_bus}', atom)
+        write_trace_to_file(np.concatenate(decimated_var_load), fid, f'var_load_bus_{variable_load_bus}', atom)
 
     ### compute the initial condition of the simulation
     inc = app.GetFromStudyCase('ComInc')
@@ -400,7 +485,7 @@ def run_sim(config_file, output_file=None, output_dir='.', output_file_prefix=''
                 vars_in = delta_ref_entry['vars_in']
                 if 'c:fi' in vars_in:
                     elem = find_element_by_name(generators, delta_ref_entry['name'])
-                    delta_ref = get_simulation_variables(res, 'c:fi', [elem],
+                    delta_ref = get_simulation_variables(res, 'c:fi', elements=[elem],
                                                          decimation=decimation)
                     vars_out = delta_ref_entry['vars_out']
                     delta_ref_var_out = vars_out[vars_in.index('c:fi')]
@@ -487,10 +572,27 @@ def run_sim(config_file, output_file=None, output_dir='.', output_file_prefix=''
     res.Release()
     res.Clear()
     res.Close()
+    # the project points again to its own file, so that the runs that do not
+    # use the cache never overwrite a cached file
+    variable_load_file.f_name = original_load_filename
     #study_case.Deactivate()
     #project.Deactivate()
 
 
+def run_sim(config_file, output_file=None, output_dir='.', output_file_prefix='',
+            output_file_suffix='', append=False, force=False, verbose=False, cache=None):
+    # the project may point to a cached load file while the simulation runs:
+    # its original file name is restored also if the simulation fails, so that
+    # the runs that do not use the cache never overwrite a cached file
+    load_files = []
+    try:
+        _run_sim(load_files, config_file, output_file, output_dir, output_file_prefix,
+                 output_file_suffix, append, force, verbose, cache)
+    finally:
+        for variable_load_file,original_load_filename in load_files:
+            variable_load_file.f_name = original_load_filename
+
+
 if __name__ == '__main__':
     parser = arg.ArgumentParser(description = 'Simulate the IEEE14 network at a fixed value of inertia', \
                                 formatter_class = arg.ArgumentDefaultsHelpFormatter, \
@@ -503,6 +605,8 @@ if __name__ == '__main__':
                         help='append simulation to existing output file (has precedence over -f)')    
     parser.add_argument('-f', '--force', action='store_true', help='force overwrite of output file')
     parser.add_argument('-v', '--verbose', action='store_true', help='be verbose')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the cache of time-varying load files')
+    parser.add_argument('--cache-size', default=LOAD_CACHE_SIZE/2**20, type=float, help='maximum size of the cache in MB')
     args = parser.parse_args(args=sys.argv[1:])
 
     config_file = args.config_file
@@ -518,8 +622,9 @@ if __name__ == '__main__':
         output_dir = '.'
 
     try:
+        cache = None if args.no_cache else DiskCache(LOAD_CACHE_DIR, int(args.cache_size * 2**20))
         run_sim(config_file, output_file, output_dir, args.prefix, args.suffix,
-                args.append, args.force, args.verbose)
+                args.append, args.force, args.verbose, cache)
     except FileExistsError as err:
         output_file = os.path.basename(str(err).split(':')[0])
         print('{}: {}: file exists: use -a to append or -f to overwrite.'.format(progname, output_file))
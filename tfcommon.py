@@ -0,0 +1,866 @@
+
+import os
+import numpy as np
+
+__all__ = ['BACKENDS', 'sweep', 'descriptor_sweep', 'adaptive_sweep', 'LowRankSweep',
+           'output_covariance', 'modal_truncation', 'balanced_truncation',
+           'variable_names', 'select_variables']
+
+
+# the backends available to compute (j*2*pi*F*I - A)^-1 @ B over a frequency grid:
+#  direct - one dense solve per frequency, O(N_freq*n^3)
+#     eig - diagonalize A once, then evaluate all frequencies in one vectorized pass
+#   schur - reduce A to (complex) Schur form once, then do one vectorized
+#           back substitution over all frequencies
+BACKENDS = ('direct', 'eig', 'schur')
+
+
+def variable_names(vars_idx):
+    # vars_idx is the dictionary of dictionaries saved by run_PF.py AC:
+    # returns the list of 'object.variable' names sorted by their index in J
+    var_names,idx = [],[]
+    for k1,D in vars_idx.items():
+        for k2,v in D.items():
+            var_names.append(k1 + '.' + k2)
+            idx.append(v)
+    return [var_names[i] for i in np.argsort(idx)]
+
+
+def select_variables(var_names, patterns):
+    # returns the (sorted) indexes of the variables whose name matches at
+    # least one of the shell-style patterns, e.g., ['*.speed', 'Bus 01.ur']
+    from fnmatch import fnmatchcase
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return np.array([i for i,name in enumerate(var_names) \
+                     if any(fnmatchcase(name, pattern) for pattern in patterns)], dtype=int)
+
+
+def _chunks(N, size):
+    for start in range(0, N, size):
+        yield slice(start, min(start+size, N))
+
+
+def _eig_decomposition(A, max_cond=1e10):
+    # returns None if the eigenbasis of A is ill-conditioned or defective,
+    # since in that case V^-1 cannot be trusted
+    lam,V = np.linalg.eig(A)
+    cond = np.linalg.cond(V)
+    if not np.isfinite(cond) or cond > max_cond:
+        return None
+    return lam,V
+
+
+def _schur_decomposition(A):
+    from scipy.linalg import schur
+    # A = Z T Z^H, with T upper triangular
+    T,Z = schur(A, output='complex')
+    return T,Z
+
+
+def _triangular_sweep(T, Y, F):
+    # solves (sI - T) X = Y for all values of s = j*2*pi*F by back substitution,
+    # vectorized over frequencies and right-hand sides
+    n = T.shape[0]
+    s = 1j*2*np.pi*F
+    X = np.zeros((F.size, n, Y.shape[1]), dtype=complex)
+    for k in range(n-1, -1, -1):
+        rhs = Y[k,:] + T[k,k+1:] @ X[:,k+1:,:]
+        X[:,k,:] = rhs / (s - T[k,k])[:,np.newaxis]
+    return X
+
+
+def _prepare(A, B, backend, C=None, D=None, max_cond=1e10):
+    # does the work that is shared by all frequencies and returns the name
+    # of the backend actually used together with a dictionary of the arrays
+    # needed by _evaluate: all the entries are arrays, so that they can be
+    # placed in shared memory when the sweep is run on a process pool
+    arrays = {} if D is None else {'D': D}
+    if backend == 'eig':
+        decomp = _eig_decomposition(A, max_cond)
+        if decomp is not None:
+            # (sI - A)^-1 B = V (sI - Lambda)^-1 V^-1 B
+            lam,V = decomp
+            arrays['lam'] = lam
+            arrays['W'] = np.linalg.solve(V, B)
+            arrays['CV'] = V if C is None else C @ V
+            return backend,arrays
+        print('The eigenvectors of A are ill-conditioned: falling back to the direct backend.')
+        backend = 'direct'
+    if backend == 'schur':
+        T,Z = _schur_decomposition(A)
+        arrays['T'] = T
+        arrays['ZhB'] = Z.conj().T @ B
+        arrays['CZ'] = Z if C is None else C @ Z
+    elif backend == 'direct':
+        arrays['A'] = A
+        arrays['B'] = B
+        if C is not None:
+            arrays['C'] = C
+    return backend,arrays
+
+
+def _evaluate(backend, arrays, F):
+    # computes the response at the frequencies in F: every frequency is
+    # computed with the same sequence of operations, regardless of how the
+    # grid is split into chunks, so that the result does not depend on it
+    if backend == 'eig':
+        lam, W, CV = arrays['lam'], arrays['W'], arrays['CV']
+        Y = CV @ (W[np.newaxis,:,:] / (1j*2*np.pi*F[:,np.newaxis,np.newaxis] - \
+                                       lam[np.newaxis,:,np.newaxis]))
+    elif backend == 'schur':
+        Y = arrays['CZ'] @ _triangular_sweep(arrays['T'], arrays['ZhB'], F)
+    elif backend == 'direct':
+        A, B, C = arrays['A'], arrays['B'], arrays.get('C', None)
+        I = np.eye(A.shape[0])
+        Y = np.zeros((F.size, A.shape[0] if C is None else C.shape[0], B.shape[1]), dtype=complex)
+        for i in range(F.size):
+            tmp = np.linalg.solve(-A + 1j*2*np.pi*F[i]*I, B)
+            Y[i,:,:] = tmp if C is None else C @ tmp
+    elif backend == 'descriptor':
+        from scipy.sparse import csc_matrix, diags
+        from scipy.sparse.linalg import splu
+        N = int(arrays['N'])
+        J = csc_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=(N,N))
+        E = diags(arrays['E'], format='csc')
+        rhs, out_idx = arrays['rhs'], arrays['out_idx']
+        Y = np.zeros((F.size, out_idx.size, rhs.shape[1]), dtype=complex)
+        for i in range(F.size):
+            lu = splu((1j*2*np.pi*F[i]) * E - J)
+            Y[i,:,:] = lu.solve(rhs)[out_idx,:]
+    else:
+        raise Exception(f'Unknown backend "{backend}"')
+    if 'D' in arrays:
+        Y += arrays['D']
+    return Y
+
+
+############################################################
+###                 PARALLEL EXECUTION                   ###
+############################################################
+
+
+# environment variables that set the number of threads used by the
+# most common BLAS implementations
+_BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def _limit_blas_threads(n_threads):
+    # threadpoolctl is optional: without it, only the environment variables
+    # (which are read when a worker process starts) limit the number of threads
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        from contextlib import nullcontext
+        return nullcontext()
+    return threadpool_limits(limits=n_threads, user_api='blas')
+
+
+def _blas_threads(n_jobs):
+    # the BLAS threads of each of n_jobs workers: an equal share of the cores,
+    # but not more than the limit already set in the environment, e.g., by
+    # compute_TFs_batch.py, whose worker processes use one thread each
+    n_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+    for var in _BLAS_ENV_VARS:
+        try:
+            n_threads = min(n_threads, int(os.environ[var]))
+        except (KeyError, ValueError):
+            pass
+    return max(1, n_threads)
+
+
+_WORKER_BLAS_LIMITS = None
+
+def _init_worker(blas_threads):
+    global _WORKER_BLAS_LIMITS
+    for var in _BLAS_ENV_VARS:
+        os.environ[var] = str(blas_threads)
+    _WORKER_BLAS_LIMITS = _limit_blas_threads(blas_threads)
+    _WORKER_BLAS_LIMITS.__enter__()
+
+
+def _to_shared(x):
+    from multiprocessing import shared_memory
+    x = np.asarray(x)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, x.nbytes))
+    np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+    return shm, (shm.name, x.shape, x.dtype.str)
+
+
+def _from_shared(spec, writeable=False):
+    from multiprocessing import shared_memory
+    name,shape,dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    x = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    x.flags.writeable = writeable
+    return shm,x
+
+
+def _process_chunk(backend, array_specs, Y_spec, F, start):
+    # runs in a worker process: the input arrays are attached read-only
+    # and the result is written directly into the shared output array
+    shms,arrays = [],{}
+    for key,spec in array_specs.items():
+        shm,arrays[key] = _from_shared(spec)
+        shms.append(shm)
+    shm,Y = _from_shared(Y_spec, writeable=True)
+    shms.append(shm)
+    Y[start:start+F.size] = _evaluate(backend, arrays, F)
+    del arrays, Y
+    for shm in shms:
+        shm.close()
+    return F.size
+
+
+def _run(backend, arrays, F, Y, chunk_size, n_jobs=1, pool='thread', verbose=False):
+    chunks = list(_chunks(F.size, chunk_size))
+    if verbose:
+        from tqdm import tqdm
+        progress = tqdm(total=F.size, ascii=True, ncols=70)
+    # each worker gets an equal share of the cores for its BLAS calls
+    blas_threads = _blas_threads(n_jobs)
+    if n_jobs == 1:
+        with _limit_blas_threads(blas_threads):
+            for chunk in chunks:
+                Y[chunk] = _evaluate(backend, arrays, F[chunk])
+                if verbose: progress.update(chunk.stop - chunk.start)
+    else:
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+        if pool == 'thread':
+            def work(chunk):
+                Y[chunk] = _evaluate(backend, arrays, F[chunk])
+                return chunk.stop - chunk.start
+            with _limit_blas_threads(blas_threads), ThreadPoolExecutor(n_jobs) as executor:
+                for future in as_completed([executor.submit(work, chunk) for chunk in chunks]):
+                    n = future.result()
+                    if verbose: progress.update(n)
+        elif pool == 'process':
+            shms,array_specs = [],{}
+            for key,x in arrays.items():
+                shm,array_specs[key] = _to_shared(x)
+                shms.append(shm)
+            Y_shm,Y_spec = _to_shared(Y)
+            shms.append(Y_shm)
+            # the environment variables are inherited by the worker processes
+            env = {var: os.environ.get(var) for var in _BLAS_ENV_VARS}
+            for var in _BLAS_ENV_VARS:
+                os.environ[var] = str(blas_threads)
+            try:
+                with ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                                         initargs=(blas_threads,)) as executor:
+                    futures = [executor.submit(_process_chunk, backend, array_specs,
+                                               Y_spec, F[chunk], chunk.start) for chunk in chunks]
+                    for future in as_completed(futures):
+                        n = future.result()
+                        if verbose: progress.update(n)
+                Y[...] = np.ndarray(Y.shape, dtype=Y.dtype, buffer=Y_shm.buf)
+            finally:
+                for var,value in env.items():
+                    if value is None:
+                        os.environ.pop(var)
+                    else:
+                        os.environ[var] = value
+                for shm in shms:
+                    shm.close()
+                    shm.unlink()
+        else:
+            raise Exception('pool must be one of "thread" or "process"')
+    if verbose:
+        progress.close()
+    return Y
+
+
+def _default_chunk_size(N_freq, n, m, n_jobs):
+    # the temporary (chunk_size,n,m) arrays should not take more memory than
+    # an (n,n) matrix and there should be enough chunks to keep all workers busy
+    chunk_size = max(1, n // m)
+    if n_jobs > 1:
+        chunk_size = min(chunk_size, max(1, N_freq // (4 * n_jobs)))
+    return chunk_size
+
+
+def sweep(A, B, F, backend='eig', C=None, D=None, max_cond=1e10, chunk_size=None,
+          n_jobs=1, pool='thread', verbose=False):
+    """
+    sweep computes the frequency response C @ (j*2*pi*f*I - A)^-1 @ B + D
+    for all the frequencies in F.
+
+    Parameters
+    ----------
+    A : (n,n) array
+        State matrix.
+    B : (n,m) array
+        Input matrix: only the columns of the inputs of interest should be passed.
+    F : array of length N_freq
+        Frequencies (in Hz) at which the response is computed.
+    backend : string, optional
+        One of 'direct', 'eig' or 'schur'. The default is 'eig'. If the
+        eigenbasis of A is ill-conditioned (i.e., its condition number is
+        larger than max_cond) or defective, the 'eig' backend falls back
+        to 'direct'.
+    C : (p,n) array, optional
+        Output matrix. The default is None, i.e., the identity.
+    D : (p,m) array, optional
+        Feedthrough matrix. The default is None, i.e., zero.
+    max_cond : float, optional
+        Largest acceptable condition number of the matrix of eigenvectors
+        of A. The default is 1e10.
+    chunk_size : int, optional
+        Number of frequencies processed at once. The default is None, in
+        which case it is chosen so that the temporary (chunk_size,n,m)
+        arrays do not take more memory than A.
+    n_jobs : int, optional
+        Number of workers among which the chunks are distributed. The
+        decomposition of A is computed only once and shared by all
+        workers. The result does not depend on n_jobs. The default is 1.
+    pool : string, optional
+        Either 'thread' or 'process'. The default is 'thread'.
+    verbose : bool, optional
+        Whether to show a progress bar. The default is False.
+
+    Returns
+    -------
+    Y : (N_freq,p,m) complex array
+        The frequency response of the system at each frequency.
+
+    """
+    if backend not in BACKENDS:
+        raise Exception('backend must be one of ' + ', '.join(f'"{b}"' for b in BACKENDS))
+    F = np.asarray(F, dtype=float)
+    B = np.asarray(B)
+    if B.ndim == 1:
+        B = B[:,np.newaxis]
+    n,m = B.shape
+    p = n if C is None else C.shape[0]
+    if chunk_size is None:
+        chunk_size = _default_chunk_size(F.size, n, m, n_jobs)
+    backend,arrays = _prepare(A, B, backend, C, D, max_cond)
+    Y = np.zeros((F.size, p, m), dtype=complex)
+    return _run(backend, arrays, F, Y, chunk_size, n_jobs, pool, verbose)
+
+
+def descriptor_sweep(J, N_state, F, in_idx, out_idx=None, n_jobs=1, pool='thread', verbose=False):
+    """
+    descriptor_sweep computes the frequency response of the linearized
+    differential-algebraic system directly from the (sparse) Jacobian J,
+    i.e., without forming Jgy^-1 or the state matrix A. At each frequency,
+    the pencil
+
+        [ j*2*pi*f*I - Jfx,  -Jfy ] [x]   [0]
+        [           -Jgx,    -Jgy ] [y] = [u]
+
+    is factorized with a sparse LU decomposition and solved for the inputs u.
+
+    Parameters
+    ----------
+    J : (N,N) sparse matrix or array
+        Jacobian matrix, with the N_state state variables first.
+    N_state : int
+        Number of state variables.
+    F : array of length N_freq
+        Frequencies (in Hz) at which the response is computed.
+    in_idx : array of length m
+        Indexes of the algebraic equations where the inputs enter, relative
+        to the first algebraic variable.
+    out_idx : array of length p, optional
+        Indexes of the variables (state and algebraic) that are returned.
+        The default is None, i.e., all of them.
+    n_jobs : int, optional
+        Number of workers among which the frequencies are distributed.
+        The default is 1.
+    pool : string, optional
+        Either 'thread' or 'process'. The default is 'thread'.
+    verbose : bool, optional
+        Whether to show a progress bar. The default is False.
+
+    Returns
+    -------
+    Y : (N_freq,p,m) complex array
+        The frequency response of the system at each frequency.
+
+    """
+    from scipy.sparse import csc_matrix
+    J = csc_matrix(J)
+    N = J.shape[0]
+    F = np.asarray(F, dtype=float)
+    in_idx = np.atleast_1d(in_idx)
+    out_idx = np.arange(N) if out_idx is None else np.asarray(out_idx)
+    m = in_idx.size
+    rhs = np.zeros((N, m), dtype=complex)
+    rhs[N_state + in_idx, np.arange(m)] = 1
+    arrays = {'N': np.array(N), 'data': J.data, 'indices': J.indices, 'indptr': J.indptr,
+              'E': np.r_[np.ones(N_state), np.zeros(N - N_state)],
+              'rhs': rhs, 'out_idx': out_idx}
+    Y = np.zeros((F.size, out_idx.size, m), dtype=complex)
+    chunk_size = 1 if n_jobs == 1 else max(1, F.size // (4 * n_jobs))
+    return _run('descriptor', arrays, F, Y, chunk_size, n_jobs, pool, verbose)
+
+
+def _seed_frequencies(lam, fmin, fmax, steps_per_decade):
+    # a coarse logarithmic grid plus, for each lightly damped mode, its
+    # natural frequency and the edges of its half-power band
+    F = [np.logspace(np.log10(fmin), np.log10(fmax),
+                     max(2, int(np.ceil(np.log10(fmax/fmin) * steps_per_decade)) + 1))]
+    lam = lam[lam.imag > 0]
+    f0,df = lam.imag / (2*np.pi), np.abs(lam.real) / (2*np.pi)
+    F += [f0, f0 - df, f0 + df]
+    F = np.concatenate(F)
+    return np.unique(F[(F >= fmin) & (F <= fmax)])
+
+
+def adaptive_sweep(A, B, fmin, fmax, backend='eig', C=None, D=None, rtol=1e-2, atol=1e-6,
+                   steps_per_decade=5, max_points=10000, max_cond=1e10, n_jobs=1,
+                   pool='thread', verbose=False):
+    """
+    adaptive_sweep computes the frequency response C @ (j*2*pi*f*I - A)^-1 @ B + D
+    on a non-uniform grid of frequencies between fmin and fmax.
+
+    The grid is seeded with a coarse logarithmic grid and with the natural
+    frequencies Im(lambda)/(2*pi) of the eigenvalues of A (together with the
+    edges of their half-power bands). Each interval of the grid is then
+    bisected (in logarithmic scale) until the response at its midpoint
+    differs from the linear interpolation of the values at its ends by
+    less than rtol times its magnitude, for all input-output pairs.
+
+    Parameters
+    ----------
+    A, B, C, D, backend, max_cond, n_jobs, pool, verbose :
+        See sweep.
+    fmin, fmax : float
+        Smallest and largest frequency (in Hz) of the grid.
+    rtol : float, optional
+        Relative tolerance. The default is 1e-2.
+    atol : float, optional
+        Tolerance relative to the peak of each input-output pair, used
+        where the response is much smaller than its peak. The default is 1e-6.
+    steps_per_decade : int, optional
+        Number of steps per decade of the initial logarithmic grid. The
+        default is 5.
+    max_points : int, optional
+        Maximum number of frequencies. The default is 10000.
+
+    Returns
+    -------
+    Y : (N_freq,p,m) complex array
+        The frequency response of the system at each frequency.
+    F : array of length N_freq
+        The (sorted) frequencies at which the response was computed.
+
+    """
+    if backend not in BACKENDS:
+        raise Exception('backend must be one of ' + ', '.join(f'"{b}"' for b in BACKENDS))
+    if fmin <= 0 or fmin >= fmax:
+        raise Exception('frequencies must satisfy 0 < fmin < fmax')
+    B = np.asarray(B)
+    if B.ndim == 1:
+        B = B[:,np.newaxis]
+    n,m = B.shape
+    p = n if C is None else C.shape[0]
+    backend,arrays = _prepare(A, B, backend, C, D, max_cond)
+    lam = arrays['lam'] if backend == 'eig' else np.linalg.eigvals(A)
+
+    def evaluate(F):
+        Y = np.zeros((F.size, p, m), dtype=complex)
+        return _run(backend, arrays, F, Y, _default_chunk_size(F.size, n, m, n_jobs), n_jobs, pool)
+
+    F = _seed_frequencies(lam, fmin, fmax, steps_per_decade)
+    Y = evaluate(F)
+    # the intervals still to be checked are identified by their left end
+    left,right = F[:-1],F[1:]
+    Yleft,Yright = Y[:-1],Y[1:]
+    F,Y = [F],[Y]
+    N_freq = F[0].size
+    while left.size > 0 and N_freq + left.size <= max_points:
+        Fmid = np.sqrt(left * right)
+        Ymid = evaluate(Fmid)
+        F.append(Fmid)
+        Y.append(Ymid)
+        N_freq += Fmid.size
+        if verbose:
+            print(f'{N_freq} frequencies, {Fmid.size} new.')
+        scale = np.max([np.abs(y).max(axis=0) for y in Y], axis=0)
+        err = np.abs(Ymid - (Yleft + Yright) / 2)
+        tol = rtol * np.maximum(np.abs(Ymid), atol * scale)
+        # intervals that are too narrow are not bisected further
+        bisect = np.any(err > tol, axis=(1,2)) & (right / left > 1 + 1e-9)
+        left = np.concatenate((left[bisect], Fmid[bisect]))
+        right = np.concatenate((Fmid[bisect], right[bisect]))
+        Yleft = np.concatenate((Yleft[bisect], Ymid[bisect]))
+        Yright = np.concatenate((Ymid[bisect], Yright[bisect]))
+    if left.size > 0:
+        print(f'Maximum number of frequencies ({max_points}) reached: ' +
+              f'{left.size} intervals have not converged.')
+    F,Y = np.concatenate(F),np.concatenate(Y)
+    idx = np.argsort(F)
+    return Y[idx],F[idx]
+
+
+class LowRankSweep (object):
+    """
+    LowRankSweep computes the frequency response of a base system once and
+    then that of systems whose state and input matrices differ from those of
+    the base system only in a few rows, e.g., the ones of a generator whose
+    inertia has changed.
+
+    If A = A0 + E_R dA and B = B0 + E_R dB, where E_R are the columns of the
+    identity matrix corresponding to the k changed rows R, the
+    Sherman-Morrison-Woodbury formula gives
+
+        (sI - A)^-1 B = X0 + G0 K^-1 (dA X0 + dB),
+
+    with X0 = (sI - A0)^-1 B0, G0 = (sI - A0)^-1 E_R and K = I - dA G0.
+    A0 is decomposed only once (with eig or Schur, as in sweep), so that G0
+    costs O(n*k) per frequency with the eigendecomposition and O(n^2*k) with
+    the Schur one, instead of the O(n^3) of a new solve.
+
+    Parameters
+    ----------
+    A, B, F, C, D, max_cond, chunk_size :
+        The base system, see sweep. C and D must be the same for all systems.
+    backend : string, optional
+        Either 'eig' or 'schur'. The default is 'eig'. If the eigenbasis of
+        A is ill-conditioned, the Schur decomposition is used.
+    max_rank : int, optional
+        Systems with more than max_rank changed rows are computed from
+        scratch with sweep. The default is None, i.e., n // 4.
+    atol : float, optional
+        Entries that differ by at most atol are considered equal. The default is 0.
+
+    """
+    def __init__(self, A, B, F, C=None, D=None, backend='eig', max_cond=1e10,
+                 max_rank=None, atol=0., chunk_size=None):
+        self.A = np.asarray(A)
+        self.B = np.asarray(B)
+        if self.B.ndim == 1:
+            self.B = self.B[:,np.newaxis]
+        self.F = np.asarray(F, dtype=float)
+        self.C = None if C is None else np.asarray(C)
+        self.D = None if D is None else np.asarray(D)
+        self.backend = backend
+        self.max_cond = max_cond
+        n,m = self.B.shape
+        self.max_rank = max(1, n // 4) if max_rank is None else max_rank
+        self.atol = atol
+        self.chunk_size = _default_chunk_size(self.F.size, n, m, 1) if chunk_size is None else chunk_size
+        decomp = _eig_decomposition(self.A, max_cond) if backend == 'eig' else None
+        if decomp is not None:
+            lam,V = decomp
+            self._kind = 'eig'
+            self._arrays = {'lam': lam}
+            self._Vinv = np.linalg.inv(V)
+            self._basis = V
+        else:
+            T,Z = _schur_decomposition(self.A)
+            self._kind = 'schur'
+            self._arrays = {'T': T}
+            self._Vinv = Z.conj().T
+            self._basis = Z
+        self._Cbasis = self._basis if C is None else C @ self._basis
+        # responses of the base system, without outputs and with outputs
+        arrays = self._full_arrays(self._Vinv @ self.B, self._basis)
+        self.X0 = np.zeros((self.F.size, n, m), dtype=complex)
+        self.X0 = _run(self._kind, arrays, self.F, self.X0, self.chunk_size)
+        self.Y0 = self.X0 if C is None else C @ self.X0
+        if D is not None:
+            self.Y0 = self.Y0 + D
+
+    def _full_arrays(self, rhs, out):
+        # arrays for _evaluate that compute out @ (sI - A0)^-1 @ rhs, where
+        # rhs is already expressed in the basis of the decomposition
+        arrays = self._arrays.copy()
+        if self._kind == 'eig':
+            arrays['W'], arrays['CV'] = rhs, out
+        else:
+            arrays['ZhB'], arrays['CZ'] = rhs, out
+        return arrays
+
+    def changed_rows(self, A, B):
+        diff = np.concatenate((np.abs(A - self.A), np.abs(B - self.B)), axis=1)
+        return np.nonzero(np.any(diff > self.atol, axis=1))[0]
+
+    def __call__(self, A, B=None, C=None, D=None, verbose=False):
+        """
+        Returns the frequency response of the system (A,B,C,D) at the
+        frequencies of the base system, with shape (N_freq,p,m). B, C and D
+        default to those of the base system: if C or D differ from them, the
+        response is computed from scratch.
+        """
+        A = np.asarray(A)
+        B = self.B if B is None else np.asarray(B)
+        if B.ndim == 1:
+            B = B[:,np.newaxis]
+        C = self.C if C is None else np.asarray(C)
+        D = self.D if D is None else np.asarray(D)
+        same = lambda X,Y: (X is None and Y is None) or \
+            (X is not None and Y is not None and np.array_equal(X, Y))
+        if A.shape != self.A.shape or B.shape != self.B.shape or \
+            not same(C, self.C) or not same(D, self.D):
+            return sweep(A, B, self.F, self.backend, C, D, self.max_cond, verbose=verbose)
+        R = self.changed_rows(A, B)
+        if R.size == 0:
+            return self.Y0.copy()
+        if R.size > self.max_rank:
+            if verbose:
+                print(f'{R.size} rows have changed: computing the response from scratch.')
+            return sweep(A, B, self.F, self.backend, C, D, self.max_cond, verbose=verbose)
+        dA,dB = A[R] - self.A[R], B[R] - self.B[R]
+        p,k = self.Y0.shape[1],R.size
+        # computes [C G0; dA G0] at once
+        arrays = self._full_arrays(self._Vinv[:,R], np.concatenate((self._Cbasis, dA @ self._basis)))
+        I = np.eye(k)
+        Y = np.zeros(self.Y0.shape, dtype=complex)
+        chunks = _chunks(self.F.size, self.chunk_size)
+        if verbose:
+            from tqdm import tqdm
+            chunks = tqdm(list(chunks), ascii=True, ncols=70)
+        for chunk in chunks:
+            G = _evaluate(self._kind, arrays, self.F[chunk])
+            rhs = dA @ self.X0[chunk] + dB
+            Y[chunk] = self.Y0[chunk] + G[:,:p] @ np.linalg.solve(I - G[:,p:], rhs)
+        return Y
+
+
+def output_covariance(A, B, c, alpha, C=None, D=None, margin=1e-8, tol=1e-8):
+    """
+    output_covariance computes the stationary covariance matrix of the outputs
+    y = C x + D u of the system x' = A x + B u, where each input u_i is an
+    independent Ornstein-Uhlenbeck process du_i = -alpha_i u_i dt + c_i dW_i.
+
+    The OU processes are appended to the state of the system, giving
+
+        z = [x; u],   z' = [A, B; 0, -diag(alpha)] z + [0; diag(c)] w,
+
+    and the covariance P of z is the solution of the continuous Lyapunov
+    equation Az P + P Az^T + G G^T = 0. No frequency sweep is needed.
+
+    The modes of A with Re(lambda) >= -margin*max(|lambda|) (e.g., the one
+    at zero of the rotor angles) are separated from the others as in
+    balanced_truncation and the covariance is that of the asymptotically
+    stable part: this is the stationary covariance of the outputs as long
+    as those modes are not observable in them.
+
+    Parameters
+    ----------
+    A : (n,n) array
+        State matrix.
+    B : (n,m) array
+        Input matrix.
+    c, alpha : arrays of length m
+        Parameters of the OU processes.
+    C : (p,n) array, optional
+        Output matrix. The default is None, i.e., the identity.
+    D : (p,m) array, optional
+        Feedthrough matrix. The default is None, i.e., zero.
+    margin : float, optional
+        Relative stability margin used to separate the modes that are not
+        asymptotically stable. The default is 1e-8.
+    tol : float, optional
+        Relative tolerance below which those modes are considered not
+        observable in the outputs. The default is 1e-8.
+
+    Returns
+    -------
+    cov : (p,p) array
+        The covariance matrix of the outputs.
+
+    """
+    from scipy.linalg import solve_continuous_lyapunov
+    A = np.asarray(A)
+    B = np.asarray(B)
+    if B.ndim == 1:
+        B = B[:,np.newaxis]
+    n,m = B.shape
+    c,alpha = np.broadcast_to(c, m), np.broadcast_to(alpha, m)
+    if np.any(alpha <= 0):
+        raise Exception('alpha must be > 0')
+    C = np.eye(n) if C is None else np.asarray(C)
+    D = np.zeros((C.shape[0], m)) if D is None else np.asarray(D)
+    lam = np.linalg.eigvals(A)
+    (As,Bs,Cs),unstable = _split_unstable(A, B, C, margin * np.abs(lam).max())
+    if unstable is not None:
+        # the outputs are stationary only if they do not depend on the modes
+        # that are not asymptotically stable, i.e., if Cu Au^k = 0 for all k
+        Au,_,Cu = unstable
+        scale = max(np.linalg.norm(Au, 2), 1.)
+        obs = Cu
+        for k in range(Au.shape[0]):
+            if np.linalg.norm(obs) > tol * max(np.linalg.norm(C), 1.):
+                raise Exception(f'{Au.shape[0]} modes of the system are not asymptotically stable ' +
+                                f'(max Re(lambda) = {lam.real.max():g}) and are observable in the ' +
+                                'outputs: the stationary covariance does not exist')
+            obs = obs @ Au / scale
+    ns = As.shape[0]
+    Az = np.block([[As, Bs], [np.zeros((m,ns)), -np.diag(alpha)]])
+    GGt = np.zeros((ns+m, ns+m))
+    GGt[ns:,ns:] = np.diag(c**2)
+    P = solve_continuous_lyapunov(Az, -GGt)
+    Cz = np.concatenate((Cs, D), axis=1)
+    cov = Cz @ P @ Cz.T
+    # the solution is symmetric only up to round-off
+    return (cov + cov.T) / 2
+
+
+############################################################
+###                REDUCED-ORDER MODELS                  ###
+############################################################
+
+
+def _check_order(order, tol, n):
+    if (order is None) == (tol is None):
+        raise Exception('exactly one of order and tol must be given')
+    if order is not None and (order <= 0 or order > n):
+        raise Exception(f'order must be between 1 and {n}')
+
+
+def modal_truncation(A, B, C, D=None, order=None, tol=None, max_cond=1e10):
+    """
+    modal_truncation builds a real reduced-order model of (A,B,C,D) that
+    keeps the most dominant modes of A. The dominance of mode i, with right
+    and left eigenvectors v_i and w_i, is ||C v_i|| ||w_i B|| / |Re(lambda_i)|,
+    so that marginally stable modes (e.g., the one at zero) are always kept.
+
+    Parameters
+    ----------
+    A, B, C, D : arrays
+        The full model. D can be None, i.e., zero.
+    order : int, optional
+        Order of the reduced model. Since complex conjugate modes are kept
+        in pairs, the actual order can be order+1.
+    tol : float, optional
+        Largest acceptable error bound, used to choose the order if order is None.
+    max_cond : float, optional
+        Largest acceptable condition number of the eigenvectors of A.
+
+    Returns
+    -------
+    ROM : tuple
+        The matrices (Ar, Br, Cr, Dr) of the reduced model.
+    error_bound : float
+        Upper bound of the H-infinity norm of the error, i.e., the sum of
+        ||C v_i w_i B|| / |Re(lambda_i)| over the discarded modes.
+    dominance : array
+        Dominance of all the modes of A, in decreasing order.
+
+    """
+    n = A.shape[0]
+    _check_order(order, tol, n)
+    decomp = _eig_decomposition(A, max_cond)
+    if decomp is None:
+        raise Exception('The eigenvectors of A are ill-conditioned: use balanced truncation instead')
+    lam,V = decomp
+    W = np.linalg.inv(V)
+    residue_norm = np.array([np.linalg.norm(np.outer(C @ V[:,i], W[i] @ B), 2) for i in range(n)])
+    with np.errstate(divide='ignore'):
+        dominance = residue_norm / np.abs(lam.real)
+    # each complex pair is represented by the eigenvalue with positive imaginary part
+    modes = np.nonzero(lam.imag >= 0)[0]
+    modes = modes[np.argsort(-dominance[modes], kind='stable')]
+    size = np.where(lam[modes].imag > 0, 2, 1)
+    # error bound if only the first i modes are kept
+    errors = np.zeros(modes.size+1)
+    errors[:-1] = np.cumsum((size * dominance[modes])[::-1])[::-1]
+    if order is not None:
+        n_modes = np.searchsorted(np.cumsum(size), order) + 1
+    else:
+        n_modes = np.nonzero(errors <= tol)[0][0]
+    keep = modes[:n_modes]
+    # real basis: a pair (v,conj(v)) is replaced by (2 Re(v), -2 Im(v)) and
+    # the corresponding left eigenvectors by (Re(w), Im(w))
+    T,Ti = [],[]
+    for i in keep:
+        if lam[i].imag > 0:
+            T += [2*V[:,i].real, -2*V[:,i].imag]
+            Ti += [W[i].real, W[i].imag]
+        else:
+            T.append(V[:,i].real)
+            Ti.append(W[i].real)
+    T,Ti = np.array(T).T,np.array(Ti)
+    ROM = Ti @ A @ T, Ti @ B, C @ T, np.zeros((C.shape[0],B.shape[1])) if D is None else D
+    return ROM, errors[n_modes], np.sort(dominance)[::-1]
+
+
+def _split_unstable(A, B, C, margin):
+    # block-diagonalizes A with an ordered real Schur decomposition followed by
+    # the solution of a Sylvester equation, so that the first block contains
+    # the eigenvalues with Re(lambda) < -margin and the second all the others
+    from scipy.linalg import schur, solve_sylvester
+    T,Z,k = schur(A, output='real', sort=lambda re,im: re < -margin)
+    if k == A.shape[0]:
+        return (A, B, C), None
+    T11,T12,T22 = T[:k,:k],T[:k,k:],T[k:,k:]
+    # [I X; 0 I]^-1 T [I X; 0 I] is block diagonal if T11 X - X T22 = -T12
+    X = solve_sylvester(T11, -T22, -T12)
+    ZB,CZ = Z.T @ B,C @ Z
+    stable = T11, ZB[:k] - X @ ZB[k:], CZ[:,:k]
+    unstable = T22, ZB[k:], CZ[:,:k] @ X + CZ[:,k:]
+    return stable, unstable
+
+
+def _psd_factor(P):
+    # L such that P = L L^T, also when P is (numerically) singular
+    s,U = np.linalg.eigh((P + P.T) / 2)
+    return U * np.sqrt(np.maximum(s, 0))
+
+
+def balanced_truncation(A, B, C, D=None, order=None, tol=None, margin=1e-8):
+    """
+    balanced_truncation builds a reduced-order model of (A,B,C,D) with the
+    square-root balanced truncation algorithm. The modes of A with
+    Re(lambda) >= -margin*max(|lambda|) (e.g., the one at zero of the rotor
+    angles) are separated from the others and kept in the reduced model
+    unchanged, while the asymptotically stable part is balanced and truncated.
+
+    Parameters
+    ----------
+    A, B, C, D : arrays
+        The full model. D can be None, i.e., zero.
+    order : int, optional
+        Order of the reduced model, including the unreduced modes.
+    tol : float, optional
+        Largest acceptable error bound, used to choose the order if order is None.
+    margin : float, optional
+        Relative stability margin used to separate the modes that are kept.
+        The default is 1e-8.
+
+    Returns
+    -------
+    ROM : tuple
+        The matrices (Ar, Br, Cr, Dr) of the reduced model.
+    error_bound : float
+        Upper bound of the H-infinity norm of the error, i.e., twice the
+        sum of the discarded Hankel singular values.
+    hsv : array
+        Hankel singular values of the stable part, in decreasing order.
+
+    """
+    from scipy.linalg import solve_continuous_lyapunov, block_diag
+    n = A.shape[0]
+    _check_order(order, tol, n)
+    margin *= np.abs(np.linalg.eigvals(A)).max()
+    (As,Bs,Cs),unstable = _split_unstable(A, B, C, margin)
+    n_unstable = 0 if unstable is None else unstable[0].shape[0]
+    # controllability and observability gramians of the stable part
+    P = solve_continuous_lyapunov(As, -Bs @ Bs.T)
+    Q = solve_continuous_lyapunov(As.T, -Cs.T @ Cs)
+    Lp,Lq = _psd_factor(P),_psd_factor(Q)
+    U,hsv,Vh = np.linalg.svd(Lq.T @ Lp)
+    errors = 2 * np.r_[np.cumsum(hsv[::-1])[::-1], 0]
+    if order is not None:
+        if order < n_unstable:
+            raise Exception(f'A has {n_unstable} modes that are not asymptotically stable: ' +
+                            f'order must be at least {n_unstable}')
+        r = order - n_unstable
+    else:
+        r = np.nonzero(errors <= tol)[0][0]
+    # states with a zero Hankel singular value are neither controllable nor observable
+    r = min(r, np.sum(hsv > hsv[0] * np.finfo(float).eps)) if hsv.size > 0 else 0
+    S = 1 / np.sqrt(hsv[:r])
+    T = Lp @ Vh[:r].T * S
+    Ti = (U[:,:r] * S).T @ Lq.T
+    Ar,Br,Cr = Ti @ As @ T, Ti @ Bs, Cs @ T
+    if unstable is not None:
+        Ar = block_diag(Ar, unstable[0])
+        Br = np.concatenate((Br, unstable[1]))
+        Cr = np.concatenate((Cr, unstable[2]), axis=1)
+    ROM = Ar, Br, Cr, np.zeros((C.shape[0],B.shape[1])) if D is None else D
+    return ROM, errors[r], hsv